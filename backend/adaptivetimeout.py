@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import deque, OrderedDict
+
+# pylint: disable=E0402
+from .percentile import percentile
+
+
+class AdaptiveTimeout:
+    """
+    Compute command timeouts from observed command durations
+
+    Durations are kept per (peer, command). Timeout is the 99th percentile of samples multiplied
+    by a safety factor, clamped between min and max. Default timeout is used until enough samples
+    are collected. A timed out command is a censored sample (duration is at least the timeout):
+    it is added to samples and timeout is doubled until enough samples are collected.
+    """
+
+    MAX_SAMPLES = 50
+    MIN_SAMPLES = 5
+    MAX_KEYS = 512
+
+    def __init__(self, default, minimum, maximum, factor=3.0):
+        """
+        Constructor
+
+        Args:
+            default (float): timeout used when there is not enough samples (seconds)
+            minimum (float): min timeout (seconds)
+            maximum (float): max timeout (seconds)
+            factor (float): factor applied to observed 99th percentile. Default 3.0
+        """
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        # samples by key (peer, command), least recently used first
+        self.__samples = OrderedDict()
+        # timeout after a timed out command by key, until enough samples are collected
+        self.__censored = {}
+
+    def add_sample(self, peer, command, duration):
+        """
+        Add command duration sample
+
+        Args:
+            peer (string): peer identifier
+            command (string): command name
+            duration (float): command duration (seconds)
+        """
+        samples = self._get_samples((peer, command))
+        samples.append(duration)
+        if len(samples) >= self.MIN_SAMPLES:
+            self.__censored.pop((peer, command), None)
+
+    def add_timeout(self, peer, command, timeout):
+        """
+        Add timed out command: its duration is at least the timeout
+
+        Args:
+            peer (string): peer identifier
+            command (string): command name
+            timeout (float): command timeout (seconds)
+        """
+        key = (peer, command)
+        self._get_samples(key).append(timeout)
+        self.__censored[key] = min(self.maximum, timeout * 2)
+
+    def _get_samples(self, key):
+        """
+        Return samples of key, created if needed
+
+        Args:
+            key (tuple): (peer, command)
+
+        Returns:
+            deque: samples
+        """
+        samples = self.__samples.get(key)
+        if samples is None:
+            if len(self.__samples) >= self.MAX_KEYS:
+                oldest, _ = self.__samples.popitem(last=False)
+                self.__censored.pop(oldest, None)
+            samples = self.__samples[key] = deque(maxlen=self.MAX_SAMPLES)
+        else:
+            self.__samples.move_to_end(key)
+        return samples
+
+    def forget(self, peer):
+        """
+        Remove all samples of peer
+
+        Args:
+            peer (string): peer identifier
+        """
+        for key in [key for key in self.__samples if key[0] == peer]:
+            del self.__samples[key]
+            self.__censored.pop(key, None)
+
+    def get_timeout(self, peer, command):
+        """
+        Return timeout for command sent to peer
+
+        Args:
+            peer (string): peer identifier
+            command (string): command name
+
+        Returns:
+            float: timeout (seconds)
+        """
+        key = (peer, command)
+        timeout = self.default
+        samples = self.__samples.get(key)
+        if samples and len(samples) >= self.MIN_SAMPLES:
+            expected = percentile(sorted(samples), 99)
+            timeout = min(self.maximum, max(self.minimum, expected * self.factor))
+
+        return max(timeout, self.__censored.get(key, 0.0))
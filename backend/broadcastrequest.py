@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import threading
+
+
+class BroadcastRequest:
+    """
+    Command sent once to all peers of a channel, collecting their responses
+
+    Request completes when all expected peers answered, when quorum is reached or when peers
+    deadlines are over. Responses can be handled with callbacks (called from bus thread) or by
+    iterating over request (blocking, responses are yielded as they arrive).
+    """
+
+    # extra time given to bus to expire request before iteration gives up waiting (seconds)
+    WAIT_MARGIN = 1.0
+
+    def __init__(
+        self, request_id, deadlines, quorum=None, on_response=None, wait_for=None
+    ):
+        """
+        Constructor
+
+        Args:
+            request_id (int): request identifier
+            deadlines (dict): response deadline (timestamp) by expected peer identifier
+            quorum (int): complete request after this number of responses. Default None (all peers)
+            on_response (function): function called for each response: on_response(peer_id, response)
+            wait_for (function): function waiting for a predicate while processing bus if called
+                                 from bus thread: wait_for(predicate, timeout). Default None
+        """
+        self.request_id = request_id
+        self.deadlines = dict(deadlines)
+        self.quorum = quorum
+        self.on_response = on_response
+        self.wait_for = wait_for
+        # iteration never waits after this timestamp, even if bus does not expire request
+        self.expires_at = max(self.deadlines.values(), default=0.0) + self.WAIT_MARGIN
+        # responses by peer identifier
+        self.responses = {}
+        # peers that did not answer in time or left
+        self.missing = []
+        self.__queue = queue.Queue()
+        self.__completed = threading.Event()
+
+    @property
+    def completed(self):
+        """
+        Return True if request is completed
+
+        Returns:
+            bool: True if request is completed
+        """
+        return self.__completed.is_set()
+
+    def add_response(self, peer_id, response):
+        """
+        Add peer response
+
+        Args:
+            peer_id (string): peer identifier
+            response (dict): peer response
+
+        Returns:
+            bool: True if request is completed
+        """
+        if self.completed or self.deadlines.pop(peer_id, None) is None:
+            return self.completed
+
+        self.responses[peer_id] = response
+        self.__queue.put((peer_id, response))
+        if self.on_response:
+            self.on_response(peer_id, response)
+        if not self.deadlines or (
+            self.quorum is not None and len(self.responses) >= self.quorum
+        ):
+            self.complete()
+        return self.completed
+
+    def remove_peer(self, peer_id):
+        """
+        Stop waiting for peer response (peer left)
+
+        Args:
+            peer_id (string): peer identifier
+
+        Returns:
+            bool: True if request is completed
+        """
+        if self.deadlines.pop(peer_id, None) is not None:
+            self.missing.append(peer_id)
+            if not self.deadlines:
+                self.complete()
+        return self.completed
+
+    def expire(self, now):
+        """
+        Stop waiting for peers whose deadline is over
+
+        Args:
+            now (float): current timestamp
+
+        Returns:
+            bool: True if request is completed
+        """
+        for peer_id, deadline in list(self.deadlines.items()):
+            if deadline <= now:
+                self.remove_peer(peer_id)
+        return self.completed
+
+    def complete(self):
+        """
+        Complete request: peers still expected are considered missing
+        """
+        if self.completed:
+            return
+        self.missing.extend(self.deadlines.keys())
+        self.deadlines.clear()
+        self.__completed.set()
+        self.__queue.put(None)
+
+    def wait(self, timeout=None):
+        """
+        Wait for request completion
+
+        Args:
+            timeout (float): max waiting duration (seconds). Default None (until completion)
+
+        Returns:
+            bool: True if request is completed
+        """
+        return self.__completed.wait(timeout)
+
+    def __iter__(self):
+        """
+        Yield responses as they arrive, until request is completed or all deadlines are over.
+        When iterated from bus thread, bus is processed while waiting (see wait_for)
+
+        Yields:
+            tuple: peer identifier and response
+        """
+        while True:
+            if self.wait_for is not None and self.__queue.empty():
+                self.wait_for(
+                    lambda: not self.__queue.empty(),
+                    max(0.0, self.expires_at - time.time()),
+                )
+            try:
+                item = self.__queue.get(timeout=max(0.0, self.expires_at - time.time()))
+            except queue.Empty:
+                self.complete()
+                continue
+            if item is None:
+                return
+            yield item
+
+    def to_dict(self):
+        """
+        Return request result
+
+        Returns:
+            dict: request result::
+
+            {
+                responses (dict): response by peer identifier
+                missing (list): peers that did not answer
+                completed (bool): True if request is completed
+            }
+
+        """
+        return {
+            "responses": dict(self.responses),
+            "missing": list(self.missing),
+            "completed": self.completed,
+        }
+
+    @staticmethod
+    def make_deadlines(peer_ids, timeout, now=None):
+        """
+        Build deadlines of expected peers
+
+        Args:
+            peer_ids (list): expected peers identifiers
+            timeout (float|function): response timeout (seconds) or function returning timeout of a peer
+            now (float): current timestamp. Default time.time()
+
+        Returns:
+            dict: deadline by peer identifier
+        """
+        now = time.time() if now is None else now
+        return {
+            peer_id: now + (timeout(peer_id) if callable(timeout) else timeout)
+            for peer_id in peer_ids
+        }
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from collections import deque
+
+# pylint: disable=E0402
+from .percentile import percentile
+
+
+class BusProfiler:
+    """
+    Low overhead bus profiler recording time spent in each bus loop stage
+
+    Profiling is disabled by default. When enabled, one bus loop iteration every sample_every
+    is profiled: stage durations are stored in fixed size ring buffers and accumulated by stack
+    to be exported in folded format (flamegraph.pl, speedscope...).
+    """
+
+    # stage stacks in bus loop
+    STACKS = {
+        "poll": "run_once;poll",
+        "recv": "run_once;receive;recv",
+        "decode": "run_once;receive;decode",
+        "callback": "run_once;receive;callback",
+        "handler": "run_once;receive;callback;handler",
+        "encode": "run_once;send;encode",
+        "send": "run_once;send;send",
+    }
+    BUFFER_SIZE = 1024
+    MAX_STACKS = 1024
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.enabled = False
+        self.sample_every = 1
+        self.active = False
+        self.__iterations = 0
+        self.__timings = {}
+        self.__stacks = {}
+        self.__stage_stacks = frozenset(self.STACKS.values())
+        self.reset()
+
+    def enable(self, sample_every=1):
+        """
+        Enable profiling
+
+        Args:
+            sample_every (int): profile one loop iteration every sample_every iterations. Default 1
+        """
+        self.sample_every = max(1, sample_every)
+        self.enabled = True
+
+    def disable(self):
+        """
+        Disable profiling. Recorded timings are kept until reset
+        """
+        self.enabled = False
+        self.active = False
+
+    def reset(self):
+        """
+        Clear recorded timings
+        """
+        self.__timings = {
+            stage: deque(maxlen=self.BUFFER_SIZE) for stage in self.STACKS
+        }
+        self.__stacks = {}
+
+    def begin(self):
+        """
+        Start new loop iteration, decide if it is profiled
+        """
+        if not self.enabled:
+            self.active = False
+            return
+
+        self.__iterations += 1
+        self.active = self.__iterations % self.sample_every == 0
+
+    def start(self):
+        """
+        Start stage timing
+
+        Returns:
+            float: start time, None if current iteration is not profiled
+        """
+        return time.perf_counter() if self.active else None
+
+    def record(self, stage, start, label=None):
+        """
+        Record stage duration
+
+        Args:
+            stage (string): stage name (see STACKS)
+            start (float): value returned by start. Nothing is recorded if None
+            label (string): stage label appended to stage stack (event or command name). Default None
+        """
+        if start is None:
+            return
+
+        duration = time.perf_counter() - start
+        self.__timings[stage].append(duration)
+        stack = self.STACKS[stage] if label is None else f"{self.STACKS[stage]};{label}"
+        if stack in self.__stacks or len(self.__stacks) < self.MAX_STACKS:
+            self.__stacks[stack] = self.__stacks.get(stack, 0.0) + duration
+            # folded stacks hold self time: remove nested stage duration from parent stage
+            parent = self.STACKS[stage].rpartition(";")[0]
+            if parent in self.__stage_stacks:
+                self.__stacks[parent] = self.__stacks.get(parent, 0.0) - duration
+
+    def get_summary(self):
+        """
+        Return timings summary of each stage over last recorded durations
+
+        Returns:
+            dict: summary by stage::
+
+            {
+                stage (string): {
+                    count (int): number of recorded durations
+                    total (float): total duration (seconds)
+                    mean (float): mean duration (seconds)
+                    p50 (float): median duration (seconds)
+                    p99 (float): 99th percentile duration (seconds)
+                    max (float): max duration (seconds)
+                },
+                ...
+            }
+
+        """
+        summary = {}
+        for stage, timings in self.__timings.items():
+            if not timings:
+                continue
+            ordered = sorted(timings)
+            count = len(ordered)
+            total = sum(ordered)
+            summary[stage] = {
+                "count": count,
+                "total": total,
+                "mean": total / count,
+                "p50": percentile(ordered, 50),
+                "p99": percentile(ordered, 99),
+                "max": ordered[-1],
+            }
+
+        return summary
+
+    def get_stacks(self):
+        """
+        Return accumulated stage durations as folded stacks (one "stack duration_in_us" per line)
+
+        Returns:
+            string: folded stacks
+        """
+        return "\n".join(
+            f"{stack} {int(round(duration * 1000000))}"
+            for stack, duration in sorted(self.__stacks.items())
+        )
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+
+
+class BusStreamError(Exception):
+    """
+    Stream transfer error (timeout, aborted by peer...)
+    """
+
+
+class BusOutgoingStream:
+    """
+    Sender side of a stream: keep track of acknowledged chunks to respect window
+    """
+
+    def __init__(self, stream_id, peer_ident, window):
+        """
+        Constructor
+
+        Args:
+            stream_id (string): stream identifier
+            peer_ident (string): recipient peer identifier
+            window (int): max number of unacknowledged chunks
+        """
+        self.stream_id = stream_id
+        self.peer_ident = peer_ident
+        self.window = window
+        self.sent = 0
+        self.acked = 0
+        self.aborted = False
+
+    def can_send(self):
+        """
+        Check if another chunk can be sent without exceeding window
+
+        Returns:
+            bool: True if chunk can be sent
+        """
+        return self.aborted or self.sent - self.acked < self.window
+
+    def is_acked(self):
+        """
+        Check if all sent chunks were acknowledged
+
+        Returns:
+            bool: True if all chunks acknowledged
+        """
+        return self.aborted or self.acked >= self.sent
+
+    def ack(self, seq):
+        """
+        Acknowledge chunks (cumulative)
+
+        Args:
+            seq (int): last consumed chunk sequence
+        """
+        self.acked = max(self.acked, seq)
+
+
+class BusStream:
+    """
+    Receiver side of a stream. Iterate over instance to get chunks (bytes)
+
+    Chunks are buffered in a queue bounded by sender window, consumed chunks are acknowledged
+    to sender that can send new ones, so memory stays bounded whatever the stream size.
+    """
+
+    END = object()
+    ABORT = object()
+
+    def __init__(self, stream_id, peer_id, infos, window, timeout, send_ack):
+        """
+        Constructor
+
+        Args:
+            stream_id (string): stream identifier
+            peer_id (string): sender peer identifier
+            infos (dict): stream infos sent by sender (name, size...)
+            window (int): sender window
+            timeout (float): max time to wait for a chunk (seconds)
+            send_ack (function): function to acknowledge consumed chunks (seq)
+        """
+        self.stream_id = stream_id
+        self.peer_id = peer_id
+        self.infos = infos
+        self.timeout = timeout
+        self.__send_ack = send_ack
+        self.__ack_every = max(1, window // 2)
+        self.__chunks = queue.Queue(maxsize=window + 1)
+        self.__last_seq = 0
+        self.__consumed = 0
+        self.__acked = 0
+        self.closed = False
+        self.updated_at = time.time()
+
+    def push(self, seq, chunk, end=False):
+        """
+        Push received chunk (called by bus)
+
+        Args:
+            seq (int): chunk sequence
+            chunk (bytes): chunk data
+            end (bool): True if it is the last chunk
+
+        Returns:
+            bool: False if chunk is invalid (out of order or window exceeded)
+        """
+        self.updated_at = time.time()
+        if seq != self.__last_seq + 1:
+            return False
+        self.__last_seq = seq
+
+        try:
+            if chunk:
+                self.__chunks.put_nowait((seq, chunk))
+            if end:
+                self.__chunks.put_nowait((seq, self.END))
+        except queue.Full:
+            return False
+
+        return True
+
+    def abort(self):
+        """
+        Abort stream (called by bus)
+        """
+        try:
+            self.__chunks.put_nowait((self.__last_seq, self.ABORT))
+        except queue.Full:
+            self.closed = True
+
+    def cancel(self):
+        """
+        Stop consuming stream (called by consumer). Bus drops stream and notifies sender
+        """
+        self.closed = True
+
+    def is_expired(self, now):
+        """
+        Check if stream must be dropped by bus: cancelled by consumer or idle for too long
+
+        Args:
+            now (float): current timestamp
+
+        Returns:
+            bool: True if stream is expired
+        """
+        return self.closed or now - self.updated_at > self.timeout
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+
+        try:
+            seq, chunk = self.__chunks.get(timeout=self.timeout)
+        except queue.Empty as error:
+            self.closed = True
+            raise BusStreamError(f'Stream "{self.stream_id}" timed out') from error
+
+        self.updated_at = time.time()
+        if chunk is self.ABORT:
+            self.closed = True
+            raise BusStreamError(f'Stream "{self.stream_id}" aborted by peer')
+
+        self.__consumed = seq
+        if chunk is self.END:
+            self.closed = True
+            self.__send_ack(self.__consumed)
+            raise StopIteration
+
+        if self.__consumed - self.__acked >= self.__ack_every:
+            self.__acked = self.__consumed
+            self.__send_ack(self.__consumed)
+
+        return chunk
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import binascii
+import threading
+from collections import deque
+
+
+class BusTracer:
+    """
+    Record message spans across devices
+
+    Trace context (trace id, span id and send timestamp) is added to messages sent on bus and
+    read back on receiving peer, so spans of all hops of a message share the same trace id.
+    Spans are kept in a bounded buffer.
+    """
+
+    BUFFER_SIZE = 1000
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.enabled = False
+        self.spans = deque(maxlen=self.BUFFER_SIZE)
+        self.__local = threading.local()
+
+    @staticmethod
+    def new_id(size=8):
+        """
+        Generate random identifier
+
+        Args:
+            size (int): identifier size in bytes. Default 8
+
+        Returns:
+            string: hex identifier
+        """
+        return binascii.hexlify(os.urandom(size)).decode("utf-8")
+
+    def new_context(self, parent=None):
+        """
+        Create new span trace context
+
+        Args:
+            parent (dict): parent trace context. Default current context (see activate)
+
+        Returns:
+            dict: trace context::
+
+            {
+                trace_id (string): trace identifier
+                span_id (string): span identifier
+                parent_id (string): parent span identifier. None if message starts new trace
+            }
+
+        """
+        parent = parent or self.get_current()
+        return {
+            "trace_id": parent["trace_id"] if parent else BusTracer.new_id(16),
+            "span_id": BusTracer.new_id(),
+            "parent_id": parent["span_id"] if parent else None,
+        }
+
+    def activate(self, context):
+        """
+        Set current trace context of calling thread. Messages sent while context is active belong to the same trace
+
+        Args:
+            context (dict): trace context. None to clear current context
+        """
+        self.__local.context = context
+
+    def get_current(self):
+        """
+        Return current trace context of calling thread
+
+        Returns:
+            dict: trace context or None
+        """
+        return getattr(self.__local, "context", None)
+
+    def record(self, context, kind, name, start, peer=None, **extra):
+        """
+        Record span
+
+        Args:
+            context (dict): trace context the span belongs to
+            kind (string): span kind (send, receive, handler)
+            name (string): event or command name
+            start (float): span start timestamp
+            peer (string): remote peer identifier. Default None
+            extra (dict): extra span fields
+        """
+        span = {
+            "trace_id": context["trace_id"],
+            "span_id": context["span_id"],
+            "parent_id": context.get("parent_id"),
+            "kind": kind,
+            "name": name,
+            "peer": peer,
+            "start": start,
+            "duration": time.time() - start,
+        }
+        span.update(extra)
+        self.spans.append(span)
+
+    def get_spans(self, trace_id=None):
+        """
+        Return recorded spans
+
+        Args:
+            trace_id (string): return only spans of this trace. Default None (all spans)
+
+        Returns:
+            list: list of spans (json serializable), oldest first
+        """
+        return [
+            dict(span)
+            for span in self.spans
+            if trace_id is None or span["trace_id"] == trace_id
+        ]
@@ -1,17 +1,29 @@
 # !/usr/bin/env python
 #  -*- coding: utf-8 -*-
 
+import os
+import re
 import json
+import logging
+import time
 import uuid
+import heapq
+import tempfile
+import threading
 from str2bool import str2bool
 from cleep.core import CleepExternalBus
 from cleep.libs.configs.hostname import Hostname
 from cleep import __version__ as VERSION
-from cleep.common import MessageRequest, PeerInfos
+from cleep.common import MessageRequest
+from cleep.exception import CommandError
 import cleep.libs.internals.tools as Tools
 
 # pylint: disable=E0402
 from .pyrebus import PyreBus
+from .loopbackbus import LoopbackBus
+from .adaptivetimeout import AdaptiveTimeout
+from .eventmatcher import EventMatcher
+from .compactpeerinfos import CompactPeerInfos, PeerInfosPool
 
 __all__ = ["Cleepbus"]
 
@@ -34,7 +46,62 @@ class Cleepbus(CleepExternalBus):
     MODULE_URLBUGS = "https://github.com/CleepDevice/cleepapp-cleepbus/issues"
 
     MODULE_CONFIG_FILE = "cleepbus.conf"
-    DEFAULT_CONFIG = {"uuid": None}
+    DEFAULT_CONFIG = {
+        "uuid": None,
+        "subscriptions": ["*"],
+        "channels": ["CLEEP"],
+        "channel_routes": {},
+        "offline_peer_ttl": 604800,
+        "max_offline_peers": 200,
+        "ping_interval": 0,
+        "inbound_rate": 0,
+        "inbound_burst": 100,
+        "message_log_sampling": 0,
+        "propagation_allow": ["*"],
+        "propagation_deny": [],
+        "static_peers": [],
+        "static_port": 5680,
+        "discovery_profile": "default",
+        "beacon_interval": 1.0,
+        "peer_evasive": 10.0,
+        "peer_expired": 30.0,
+        "replay_window": 0,
+        "reliable_events": [],
+    }
+
+    # set CLEEPBUS_TRANSPORT=loopback to use in-process transport (tests, load tests) instead of network
+    TRANSPORT_ENV = "CLEEPBUS_TRANSPORT"
+    TRANSPORT_LOOPBACK = "loopback"
+
+    # discovery timers profiles (seconds): beacon interval, silence before peer is pinged (evasive)
+    # and silence before peer is disconnected (expired). See README for their overhead
+    DISCOVERY_PROFILES = {
+        "default": {"interval": 1.0, "evasive": 10.0, "expired": 30.0},
+        "dense_lan": {"interval": 5.0, "evasive": 20.0, "expired": 60.0},
+        "low_power": {"interval": 10.0, "evasive": 40.0, "expired": 120.0},
+        "fast_failover": {"interval": 0.5, "evasive": 2.0, "expired": 5.0},
+    }
+    DISCOVERY_PROFILE_CUSTOM = "custom"
+
+    # max number of sent messages kept by stream to answer replay requests
+    MAX_REPLAY_WINDOW = 256
+
+    # max size of files received from peers (bytes)
+    MAX_RECEIVED_FILE_SIZE = 104857600
+
+    # static peer endpoint (tcp://ip:port)
+    STATIC_PEER_PATTERN = re.compile(r"^tcp://[^:/\s]+:\d{1,5}$")
+
+    # command timeouts (seconds): default one is used until enough command durations are observed
+    COMMAND_TIMEOUT = 8.0
+    COMMAND_TIMEOUT_MIN = 3.5
+    COMMAND_TIMEOUT_MAX = 30.0
+    COMMAND_TIMEOUT_FACTOR = 3.0
+    # timeout of commands received from peers, reduced by network margin to answer in time
+    LOCAL_COMMAND_TIMEOUT = 5.0
+    LOCAL_COMMAND_TIMEOUT_MIN = 3.0
+    NETWORK_MARGIN = 2.0
+    NETWORK_MARGIN_MIN = 0.5
 
     def __init__(self, bootstrap, debug_enabled):
         """
@@ -47,7 +114,12 @@ class Cleepbus(CleepExternalBus):
         CleepExternalBus.__init__(self, bootstrap, debug_enabled)
 
         # members
-        self.external_bus = PyreBus(
+        bus_class = (
+            LoopbackBus
+            if os.environ.get(self.TRANSPORT_ENV) == self.TRANSPORT_LOOPBACK
+            else PyreBus
+        )
+        self.external_bus = bus_class(
             self._on_message_received,
             self._on_peer_connected,
             self._on_peer_disconnected,
@@ -65,8 +137,32 @@ class Cleepbus(CleepExternalBus):
         #       ...
         #   }
         self.peers = {}
+        # last time something was received from peers::
+        #   {
+        #       peer uuid (string): timestamp (float)
+        #   }
+        self.peers_last_seen = {}
+        # offline peers expiry: heap of (offline since, peer uuid) and offline since by peer uuid
+        # heap entries not matching current offline since are outdated and skipped
+        self.__peers_expiry = []
+        self.__peers_offline_since = {}
+        self.command_timeouts = AdaptiveTimeout(
+            self.COMMAND_TIMEOUT,
+            self.COMMAND_TIMEOUT_MIN,
+            self.COMMAND_TIMEOUT_MAX,
+            self.COMMAND_TIMEOUT_FACTOR,
+        )
+        # commands sent to peers waiting for response: (peer uuid, command, timeout, deadline) by token
+        self.__pending_commands = {}
+        # events allowed to leave device (EventMatcher instances)
+        self.propagation_allow = EventMatcher(["*"])
+        self.propagation_deny = EventMatcher([])
         self.hostname = Hostname(self.cleep_filesystem)
         self.uuid = None
+        self.external_bus.on_stream_received = self._on_stream_received
+
+        # events
+        self.file_received_event = self._get_event("cleepbus.file.received")
 
     def _configure(self):
         """
@@ -79,6 +175,35 @@ class Cleepbus(CleepExternalBus):
             self.uuid = str(uuid.uuid4())
             self._set_config_field("uuid", self.uuid)
 
+        # events allowed to leave device
+        self.propagation_allow = EventMatcher(
+            self._get_config_field("propagation_allow")
+        )
+        self.propagation_deny = EventMatcher(self._get_config_field("propagation_deny"))
+
+        # drop events this device did not subscribe to
+        self.external_bus.set_event_filter(self._get_config_field("subscriptions"))
+        self.external_bus.set_channel_routes(self._get_config_field("channel_routes"))
+        self.external_bus.set_ping_interval(self._get_config_field("ping_interval"))
+        self.external_bus.set_rate_limit(
+            self._get_config_field("inbound_rate"),
+            self._get_config_field("inbound_burst"),
+        )
+        self.external_bus.set_message_log_sampling(
+            self._get_config_field("message_log_sampling")
+        )
+        self.external_bus.set_static_peers(
+            self._get_config_field("static_peers"),
+            self._get_config_field("static_port"),
+        )
+        self.external_bus.set_discovery_timers(
+            self._get_config_field("beacon_interval"),
+            self._get_config_field("peer_evasive"),
+            self._get_config_field("peer_expired"),
+        )
+        self.external_bus.set_replay_window(self._get_config_field("replay_window"))
+        self.external_bus.set_reliable_events(self._get_config_field("reliable_events"))
+
     def get_peer_infos(self):
         """
         Current peer infos to set at bus init (values must be in string format)
@@ -103,6 +228,7 @@ class Cleepbus(CleepExternalBus):
                 hwethernet (string): "1" if ethernet on the board
                 hwwireless (string): "1" if wireless on the board
                 hwrevision (string): board revision
+                subscriptions (string): list of event patterns this device wants to receive
             }
 
         """
@@ -135,6 +261,7 @@ class Cleepbus(CleepExternalBus):
             "hwwireless": "1" if hardware["wireless"] else "0",
             "hwethernet": "1" if hardware["ethernet"] else "0",
             "hwrevision": f"{hardware['revision']}",
+            "subscriptions": json.dumps(self._get_config_field("subscriptions")),
         }
 
     @staticmethod
@@ -148,9 +275,9 @@ class Cleepbus(CleepExternalBus):
             infos (dict): dict of decoded values
 
         Returns:
-            PeerInfos: peer informations
+            CompactPeerInfos: peer informations
         """
-        peer_infos = PeerInfos()
+        peer_infos = CompactPeerInfos()
         peer_infos.uuid = infos.get("uuid", None)
         peer_infos.hostname = infos.get("hostname", None)
         peer_infos.port = int(infos.get("port", peer_infos.port))
@@ -159,11 +286,24 @@ class Cleepbus(CleepExternalBus):
             str2bool(infos.get("cleepdesktop", f"{peer_infos.cleepdesktop}"))
         )
         peer_infos.macs = json.loads(infos.get("macs", "[]"))
-        peer_infos.extra = {
-            key: value
-            for key, value in infos.items()
-            if key not in ["uuid", "hostname", "port", "ssl", "cleepdesktop", "macs"]
-        }
+        # extra infos (version, apps, hardware...) are mostly identical between peers: share them
+        peer_infos.extra = PeerInfosPool.get_default().share_extra(
+            {
+                key: value
+                for key, value in infos.items()
+                if key
+                not in [
+                    "uuid",
+                    "hostname",
+                    "port",
+                    "ssl",
+                    "cleepdesktop",
+                    "macs",
+                    "subscriptions",
+                    "busfeatures",
+                ]
+            }
+        )
 
         return peer_infos
 
@@ -174,6 +314,7 @@ class Cleepbus(CleepExternalBus):
         # stop bus
         self.logger.trace("Stop module requested")
         self._stop_external_bus()
+        self.external_bus.close()
 
     def _on_process(self):
         """
@@ -182,11 +323,17 @@ class Cleepbus(CleepExternalBus):
         if self.external_bus.is_running():
             self.external_bus.run_once()
 
+        self._expire_peers()
+        if self.__pending_commands:
+            self._expire_pending_commands()
+
     def _start_external_bus(self):
         """
         Start external bus
         """
-        self.external_bus.start(self.get_peer_infos())
+        self.external_bus.start(
+            self.get_peer_infos(), bus_channel=self._get_config_field("channels")
+        )
 
     def _stop_external_bus(self):
         """
@@ -195,6 +342,181 @@ class Cleepbus(CleepExternalBus):
         self.logger.debug("Stop external bus")
         self.external_bus.stop()
 
+    def _restart_external_bus(self):
+        """
+        Restart external bus to publish new peer infos (headers are only sent at bus start)
+        """
+        if not self.external_bus.is_running():
+            return
+
+        self._stop_external_bus()
+        self._start_external_bus()
+
+    def set_subscriptions(self, subscriptions):
+        """
+        Set events this device wants to receive from other peers
+
+        Subscriptions are advertised to peers that only send matching events to this device.
+
+        Args:
+            subscriptions (list): list of event name patterns (glob syntax, "*" for all events)
+        """
+        self._check_parameters(
+            [
+                {
+                    "name": "subscriptions",
+                    "type": list,
+                    "value": subscriptions,
+                    "validator": lambda val: all(
+                        isinstance(pattern, str) and len(pattern) > 0 for pattern in val
+                    ),
+                    "message": "Subscriptions must be a list of event patterns",
+                },
+            ]
+        )
+
+        self._set_config_field("subscriptions", subscriptions)
+        self.external_bus.set_event_filter(subscriptions)
+        self._restart_external_bus()
+
+    @staticmethod
+    def _are_valid_event_patterns(patterns):
+        """
+        Check list of event name patterns
+
+        Args:
+            patterns (list): list of event name patterns
+
+        Returns:
+            bool: True if all patterns are valid
+        """
+        if not all(
+            isinstance(pattern, str) and len(pattern) > 0 for pattern in patterns
+        ):
+            return False
+        try:
+            EventMatcher(patterns)
+        except re.error:
+            return False
+        return True
+
+    def set_propagation(self, allow, deny=None):
+        """
+        Set events allowed to leave device. Event must match allow list and must not match deny list
+
+        Args:
+            allow (list): list of event name patterns (glob syntax or regular expression prefixed by "re:")
+            deny (list): list of event name patterns. Default None (no event denied)
+        """
+        deny = deny or []
+        is_valid = Cleepbus._are_valid_event_patterns
+        self._check_parameters(
+            [
+                {
+                    "name": "allow",
+                    "type": list,
+                    "value": allow,
+                    "validator": is_valid,
+                    "message": "Allow must be a list of valid event patterns",
+                },
+                {
+                    "name": "deny",
+                    "type": list,
+                    "value": deny,
+                    "validator": is_valid,
+                    "message": "Deny must be a list of valid event patterns",
+                },
+            ]
+        )
+
+        self._update_config({"propagation_allow": allow, "propagation_deny": deny})
+        self.propagation_allow = EventMatcher(allow)
+        self.propagation_deny = EventMatcher(deny)
+
+    def set_reliable_events(self, patterns):
+        """
+        Set propagated events that must arrive (alarms, door state...). They are sent to each
+        peer and sent again until peer acknowledges them (at-least-once delivery)
+
+        Args:
+            patterns (list): list of event name patterns (glob syntax or regular expression prefixed
+                             by "re:"). Empty list to disable reliable delivery
+        """
+        self._check_parameters(
+            [
+                {
+                    "name": "patterns",
+                    "type": list,
+                    "value": patterns,
+                    "validator": Cleepbus._are_valid_event_patterns,
+                    "message": "Patterns must be a list of valid event patterns",
+                },
+            ]
+        )
+
+        self._set_config_field("reliable_events", patterns)
+        self.external_bus.set_reliable_events(patterns)
+
+    def _is_event_propagated(self, event_name):
+        """
+        Check if event is allowed to leave device
+
+        Args:
+            event_name (string): event name
+
+        Returns:
+            bool: True if event can be sent to other peers
+        """
+        return self.propagation_allow.match(
+            event_name
+        ) and not self.propagation_deny.match(event_name)
+
+    def set_channels(self, channels, routes=None):
+        """
+        Set bus channels this device joins
+
+        Events are sent to the channel of the first matching route, or to the first (default)
+        channel if no route matches, so broadcast is limited to devices of this channel.
+
+        Args:
+            channels (list): list of channel names. First one is the default channel
+            routes (dict): event name patterns by channel. Default None::
+
+            {
+                channel (string): list of event name patterns
+                ...
+            }
+
+        """
+        self._check_parameters(
+            [
+                {
+                    "name": "channels",
+                    "type": list,
+                    "value": channels,
+                    "validator": lambda val: len(val) > 0
+                    and all(isinstance(channel, str) and channel for channel in val),
+                    "message": "Channels must be a non empty list of channel names",
+                },
+                {
+                    "name": "routes",
+                    "type": dict,
+                    "value": routes,
+                    "none": True,
+                    "validator": lambda val: all(
+                        channel in channels and isinstance(patterns, list)
+                        for channel, patterns in val.items()
+                    ),
+                    "message": "Routes must be a list of event patterns by joined channel",
+                },
+            ]
+        )
+
+        routes = routes or {}
+        self._update_config({"channels": channels, "channel_routes": routes})
+        self.external_bus.set_channel_routes(routes)
+        self._restart_external_bus()
+
     def _find_existing_peer(self, peer_infos):
         """
         Based on specified peer_infos content mac adresses) this function tries to find an exiting peer.
@@ -224,16 +546,538 @@ class Cleepbus(CleepExternalBus):
                     peer infos formatted fields
                     online (bool): True if peer is online
                     peer_id (string): peer id. Volatile, renewed after device connection
+                    last_seen (float): last time something was received from peer (timestamp)
+                    link (dict): link quality stats (rtt, jitter, loss...). None if peer is offline
                 },
                 ...
             }
 
         """
+        peers = {}
+        for peer_uuid, peer_infos in self.peers.items():
+            peers[peer_uuid] = peer_infos.to_dict()
+            peers[peer_uuid]["last_seen"] = self._get_peer_last_seen(peer_infos)
+            peers[peer_uuid]["link"] = self._get_peer_link_stats(peer_infos)
+
+        return peers
+
+    def _get_peer_link_stats(self, peer_infos):
+        """
+        Return link quality stats of peer
+
+        Args:
+            peer_infos (PeerInfos): peer informations
+
+        Returns:
+            dict: link stats or None if peer is offline
+        """
+        if not peer_infos.online:
+            return None
+
+        link = self.external_bus.get_peer_link_stats(peer_infos.ident)
+        return link if isinstance(link, dict) else None
+
+    def get_bus_stats(self):
+        """
+        Return bus statistics and link quality of online peers
+
+        Returns:
+            dict: bus stats::
+
+            {
+                bus (dict): external bus stats (filtered events, compression, channels)
+                peers (dict): link quality stats by peer uuid::
+                    {
+                        peer uuid (string): {
+                            rtt (float): smoothed round trip time (seconds)
+                            jitter (float): round trip time jitter (seconds)
+                            min_rtt (float): min round trip time (seconds)
+                            max_rtt (float): max round trip time (seconds)
+                            p99_rtt (float): round trip time 99th percentile (seconds)
+                            sent (int): number of sent pings
+                            received (int): number of received pongs
+                            lost (int): number of lost pings
+                            loss (float): loss ratio (0-1)
+                            throttled (int): number of messages dropped because peer exceeded its rate limit
+                            sequence (dict): received messages sequence stats (received, lost,
+                                             duplicated, reordered, recovered)
+                        },
+                        ...
+                    }
+            }
+
+        """
+        peers = {}
+        for peer_uuid, peer_infos in self.peers.items():
+            link = self._get_peer_link_stats(peer_infos)
+            if link is not None:
+                throttled = self.external_bus.get_peer_throttled(peer_infos.ident)
+                sequence = self.external_bus.get_peer_sequence_stats(peer_infos.ident)
+                peers[peer_uuid] = dict(
+                    link,
+                    throttled=throttled if isinstance(throttled, int) else 0,
+                    sequence=sequence if isinstance(sequence, dict) else None,
+                )
+
         return {
-            peer_uuid: peer_infos.to_dict()
-            for peer_uuid, peer_infos in self.peers.items()
+            "bus": self.external_bus.get_stats(),
+            "peers": peers,
         }
 
+    def set_inbound_rate_limit(self, rate, burst):
+        """
+        Limit number of messages accepted from each peer. Messages exceeding limit are dropped
+
+        Args:
+            rate (int): messages per second allowed per peer. 0 to disable rate limit
+            burst (int): max number of messages accepted at once
+        """
+        self._check_parameters(
+            [
+                {
+                    "name": "rate",
+                    "type": int,
+                    "value": rate,
+                    "validator": lambda val: val >= 0,
+                    "message": "Rate must be positive",
+                },
+                {
+                    "name": "burst",
+                    "type": int,
+                    "value": burst,
+                    "validator": lambda val: val > 0,
+                    "message": "Burst must be greater than 0",
+                },
+            ]
+        )
+
+        self._update_config({"inbound_rate": rate, "inbound_burst": burst})
+        self.external_bus.set_rate_limit(rate, burst)
+
+    def set_profiling(self, enabled, sample_every=1):
+        """
+        Enable or disable bus loop profiling
+
+        Args:
+            enabled (bool): True to enable profiling
+            sample_every (int): profile one bus loop iteration every sample_every iterations. Default 1
+        """
+        self._check_parameters(
+            [
+                {"name": "enabled", "type": bool, "value": enabled},
+                {
+                    "name": "sample_every",
+                    "type": int,
+                    "value": sample_every,
+                    "validator": lambda val: val > 0,
+                    "message": "Sample every must be greater than 0",
+                },
+            ]
+        )
+
+        profiler = self.external_bus.profiler
+        if enabled:
+            profiler.reset()
+            profiler.enable(sample_every)
+        else:
+            profiler.disable()
+
+    def get_profiling(self, output="summary"):
+        """
+        Return bus loop profiling results
+
+        Args:
+            output (string): summary (timings by stage) or stacks (folded stacks for flamegraph tools). Default summary
+
+        Returns:
+            dict|string: timings summary by stage (poll, recv, decode, callback, handler, encode, send) or folded stacks
+        """
+        self._check_parameters(
+            [
+                {
+                    "name": "output",
+                    "type": str,
+                    "value": output,
+                    "validator": lambda val: val in ("summary", "stacks"),
+                    "message": 'Output must be "summary" or "stacks"',
+                },
+            ]
+        )
+
+        profiler = self.external_bus.profiler
+        return profiler.get_summary() if output == "summary" else profiler.get_stacks()
+
+    def set_tracing(self, enabled):
+        """
+        Enable or disable messages tracing. When enabled, trace context is added to sent messages
+        and spans of sent and received messages are recorded
+
+        Args:
+            enabled (bool): True to enable tracing
+        """
+        self._check_parameters([{"name": "enabled", "type": bool, "value": enabled}])
+
+        self.external_bus.tracer.enabled = enabled
+
+    def get_traces(self, trace_id=None):
+        """
+        Return recorded message spans
+
+        Args:
+            trace_id (string): return only spans of specified trace. Default None (all spans)
+
+        Returns:
+            list: list of spans, oldest first::
+
+            [
+                {
+                    trace_id (string): trace identifier, shared by all hops of a message
+                    span_id (string): span identifier
+                    parent_id (string): parent span identifier
+                    kind (string): send, receive or handler
+                    name (string): event or command name
+                    peer (string): remote peer identifier (or channel for broadcast messages)
+                    start (float): span start timestamp
+                    duration (float): span duration (seconds). Receive span duration includes network transit
+                },
+                ...
+            ]
+
+        """
+        self._check_parameters(
+            [{"name": "trace_id", "type": str, "value": trace_id, "none": True}]
+        )
+
+        return self.external_bus.tracer.get_spans(trace_id)
+
+    def set_message_log_sampling(self, every):
+        """
+        Log one message every N messages sent or received on bus, even if debug is disabled
+
+        Args:
+            every (int): log one message every specified number of messages. 0 to disable sampled log
+        """
+        self._check_parameters(
+            [
+                {
+                    "name": "every",
+                    "type": int,
+                    "value": every,
+                    "validator": lambda val: val >= 0,
+                    "message": "Sampling must be positive",
+                },
+            ]
+        )
+
+        self._set_config_field("message_log_sampling", every)
+        self.external_bus.set_message_log_sampling(every)
+
+    def set_replay_window(self, window):
+        """
+        Set number of sent messages kept to send them again to peers that missed them. Replay
+        must be enabled on both devices
+
+        Args:
+            window (int): number of messages kept by peer and by channel. 0 to disable replay
+        """
+        self._check_parameters(
+            [
+                {
+                    "name": "window",
+                    "type": int,
+                    "value": window,
+                    "validator": lambda val: 0 <= val <= self.MAX_REPLAY_WINDOW,
+                    "message": f"Replay window must be between 0 and {self.MAX_REPLAY_WINDOW}",
+                },
+            ]
+        )
+
+        self._set_config_field("replay_window", window)
+        self.external_bus.set_replay_window(window)
+
+    def set_ping_interval(self, interval):
+        """
+        Set interval between two pings sent to peers to measure link quality
+
+        Args:
+            interval (int): ping interval (seconds). 0 to disable pings
+        """
+        self._check_parameters(
+            [
+                {
+                    "name": "interval",
+                    "type": int,
+                    "value": interval,
+                    "validator": lambda val: val >= 0,
+                    "message": "Ping interval must be positive",
+                },
+            ]
+        )
+
+        self._set_config_field("ping_interval", interval)
+        self.external_bus.set_ping_interval(interval)
+
+    def set_static_peers(self, endpoints, port=5680):
+        """
+        Discover peers from a static list of endpoints instead of UDP beacons
+
+        Use it when UDP broadcast is filtered on network. Peers share endpoints they know, so
+        only a few seeds are needed.
+
+        Args:
+            endpoints (list): list of peers endpoints (tcp://ip:port). Empty list to use beacons
+            port (int): listening port of this device. Default 5680
+        """
+        self._check_parameters(
+            [
+                {
+                    "name": "endpoints",
+                    "type": list,
+                    "value": endpoints,
+                    "validator": lambda val: all(
+                        isinstance(endpoint, str)
+                        and self.STATIC_PEER_PATTERN.match(endpoint)
+                        for endpoint in val
+                    ),
+                    "message": "Endpoints must be a list of tcp://ip:port endpoints",
+                },
+                {
+                    "name": "port",
+                    "type": int,
+                    "value": port,
+                    "validator": lambda val: 0 < val < 65536,
+                    "message": "Port must be a valid port number",
+                },
+            ]
+        )
+
+        self._update_config({"static_peers": endpoints, "static_port": port})
+        self.external_bus.set_static_peers(endpoints, port)
+        self._restart_external_bus()
+
+    def get_discovery_profiles(self):
+        """
+        Return discovery timers profiles
+
+        Returns:
+            dict: timers by profile name::
+
+            {
+                profile (string): {
+                    interval (float): beacon interval (seconds)
+                    evasive (float): silence duration before peer is pinged (seconds)
+                    expired (float): silence duration before peer is disconnected (seconds)
+                },
+                ...
+            }
+
+        """
+        return {
+            profile: dict(timers) for profile, timers in self.DISCOVERY_PROFILES.items()
+        }
+
+    def set_discovery_profile(self, profile):
+        """
+        Set discovery timers from profile
+
+        Profiles: "dense_lan" reduces beacons traffic on networks with many devices, "low_power"
+        reduces wake ups and traffic at the cost of slower peer loss detection, "fast_failover"
+        detects lost peers in a few seconds at the cost of more traffic.
+
+        Args:
+            profile (string): profile name (see get_discovery_profiles)
+        """
+        self._check_parameters(
+            [
+                {
+                    "name": "profile",
+                    "type": str,
+                    "value": profile,
+                    "validator": lambda val: val in self.DISCOVERY_PROFILES,
+                    "message": "Profile must be one of "
+                    + ", ".join(sorted(self.DISCOVERY_PROFILES)),
+                },
+            ]
+        )
+
+        timers = self.DISCOVERY_PROFILES[profile]
+        self._set_discovery_timers(
+            profile, timers["interval"], timers["evasive"], timers["expired"]
+        )
+
+    def set_discovery_timers(self, interval, evasive, expired):
+        """
+        Set custom discovery timers
+
+        Args:
+            interval (float): beacon interval (seconds)
+            evasive (float): silence duration before peer is pinged (seconds)
+            expired (float): silence duration before peer is disconnected (seconds)
+        """
+        self._check_parameters(
+            [
+                {
+                    "name": "interval",
+                    "type": float,
+                    "value": interval,
+                    "validator": lambda val: val > 0,
+                    "message": "Interval must be greater than 0",
+                },
+                {
+                    "name": "evasive",
+                    "type": float,
+                    "value": evasive,
+                    "validator": lambda val: val >= interval,
+                    "message": "Evasive must be greater or equal than interval",
+                },
+                {
+                    "name": "expired",
+                    "type": float,
+                    "value": expired,
+                    "validator": lambda val: val > evasive,
+                    "message": "Expired must be greater than evasive",
+                },
+            ]
+        )
+
+        self._set_discovery_timers(
+            self.DISCOVERY_PROFILE_CUSTOM, interval, evasive, expired
+        )
+
+    def _set_discovery_timers(self, profile, interval, evasive, expired):
+        """
+        Save discovery timers and restart bus to apply them
+
+        Args:
+            profile (string): profile name
+            interval (float): beacon interval (seconds)
+            evasive (float): silence duration before peer is pinged (seconds)
+            expired (float): silence duration before peer is disconnected (seconds)
+        """
+        self._update_config(
+            {
+                "discovery_profile": profile,
+                "beacon_interval": interval,
+                "peer_evasive": evasive,
+                "peer_expired": expired,
+            }
+        )
+        self.external_bus.set_discovery_timers(interval, evasive, expired)
+        self._restart_external_bus()
+
+    def _get_peer_last_seen(self, peer_infos):
+        """
+        Return last time something was received from peer
+
+        Args:
+            peer_infos (PeerInfos): peer informations
+
+        Returns:
+            float: timestamp or None if never seen
+        """
+        last_seen = self.peers_last_seen.get(peer_infos.uuid)
+        if peer_infos.online:
+            bus_last_seen = self.external_bus.get_peer_last_seen(peer_infos.ident)
+            if isinstance(bus_last_seen, float) and (
+                last_seen is None or bus_last_seen > last_seen
+            ):
+                last_seen = bus_last_seen
+
+        return last_seen
+
+    def set_peers_expiry(self, offline_peer_ttl, max_offline_peers):
+        """
+        Configure how long offline peers are kept
+
+        Args:
+            offline_peer_ttl (int): duration offline peers are kept (seconds). 0 to keep them until max is reached
+            max_offline_peers (int): max number of offline peers kept. Oldest are removed first
+        """
+        self._check_parameters(
+            [
+                {
+                    "name": "offline_peer_ttl",
+                    "type": int,
+                    "value": offline_peer_ttl,
+                    "validator": lambda val: val >= 0,
+                    "message": "Offline peer ttl must be positive",
+                },
+                {
+                    "name": "max_offline_peers",
+                    "type": int,
+                    "value": max_offline_peers,
+                    "validator": lambda val: val >= 0,
+                    "message": "Max offline peers must be positive",
+                },
+            ]
+        )
+
+        self._update_config(
+            {
+                "offline_peer_ttl": offline_peer_ttl,
+                "max_offline_peers": max_offline_peers,
+            }
+        )
+
+        self._expire_peers()
+
+    def _schedule_peer_expiry(self, peer_uuid, offline_since):
+        """
+        Schedule offline peer removal
+
+        Args:
+            peer_uuid (string): peer uuid
+            offline_since (float): timestamp peer went offline
+        """
+        self.__peers_offline_since[peer_uuid] = offline_since
+        heapq.heappush(self.__peers_expiry, (offline_since, peer_uuid))
+        self._compact_peers_expiry()
+
+    def _cancel_peer_expiry(self, peer_uuid):
+        """
+        Cancel offline peer removal (heap entry is dropped lazily)
+
+        Args:
+            peer_uuid (string): peer uuid
+        """
+        if self.__peers_offline_since.pop(peer_uuid, None) is not None:
+            self._compact_peers_expiry()
+
+    def _compact_peers_expiry(self):
+        """
+        Rebuild expiry heap when outdated entries outnumber current ones (flapping peers)
+        """
+        if len(self.__peers_expiry) > 2 * len(self.__peers_offline_since):
+            self.__peers_expiry = [
+                (offline_since, peer_uuid)
+                for peer_uuid, offline_since in self.__peers_offline_since.items()
+            ]
+            heapq.heapify(self.__peers_expiry)
+
+    def _expire_peers(self):
+        """
+        Remove offline peers whose ttl is over, and oldest offline peers if there are too many
+        """
+        now = time.time()
+        ttl = self._get_config_field("offline_peer_ttl")
+        max_offline_peers = self._get_config_field("max_offline_peers")
+        while self.__peers_expiry:
+            offline_since, peer_uuid = self.__peers_expiry[0]
+            if self.__peers_offline_since.get(peer_uuid) != offline_since:
+                # outdated entry
+                heapq.heappop(self.__peers_expiry)
+                continue
+            expired = ttl > 0 and offline_since + ttl <= now
+            if not expired and len(self.__peers_offline_since) <= max_offline_peers:
+                break
+
+            heapq.heappop(self.__peers_expiry)
+            del self.__peers_offline_since[peer_uuid]
+            self.peers.pop(peer_uuid, None)
+            self.peers_last_seen.pop(peer_uuid, None)
+            self.command_timeouts.forget(peer_uuid)
+            self.logger.debug("Offline peer %s removed", peer_uuid)
+
     def _on_message_received(self, peer_id, message):
         """
         Handle received message from external bus
@@ -245,7 +1089,9 @@ class Cleepbus(CleepExternalBus):
         Returns:
             MessageResponse if message is a command
         """
-        self.logger.trace("Raw message received on external bus: %s", message)
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.trace("Raw message received on external bus: %s", message)
         # fill message with peer infos
         peer_infos = self._get_peer_infos_from_peer_id(peer_id)
         if not peer_infos:
@@ -254,23 +1100,61 @@ class Cleepbus(CleepExternalBus):
             )
             return None
         message.peer_infos = peer_infos
-        self.logger.debug("Message received on external bus: %s", message)
+        self.peers_last_seen[peer_infos.uuid] = time.time()
+        if debug:
+            self.logger.debug("Message received on external bus: %s", message)
 
+        profiler = self.external_bus.profiler
+        start = profiler.start()
         if message.is_command():
             # send command and return response
-            return self.send_command(
+            response = self.send_command(
                 message.command,
                 message.to,
                 message.params,
-                (message.timeout - 2.0)
-                if message.timeout is not None and message.timeout >= 5.0
-                else 5.0,
+                self._get_local_command_timeout(peer_infos, message.timeout),
             )
+            profiler.record("handler", start, f"{message.to}.{message.command}")
+            return response
 
         # send event
         self.send_event(message.event, message.params, to=message.to)
+        profiler.record("handler", start, message.event)
         return None
 
+    def _get_local_command_timeout(self, peer_infos, timeout):
+        """
+        Return timeout of command received from peer. Peer timeout is reduced by a network margin
+        computed from peer round trip time to leave time to send response back
+
+        Args:
+            peer_infos (PeerInfos): peer informations
+            timeout (float): command timeout set by peer
+
+        Returns:
+            float: local command timeout (seconds)
+        """
+        if timeout is None:
+            return self.LOCAL_COMMAND_TIMEOUT
+
+        margin = self.NETWORK_MARGIN
+        link = self.external_bus.get_peer_link_stats(peer_infos.ident)
+        if isinstance(link, dict) and link.get("p99_rtt") is not None:
+            margin = min(
+                self.NETWORK_MARGIN,
+                max(
+                    self.NETWORK_MARGIN_MIN,
+                    link["p99_rtt"] * self.COMMAND_TIMEOUT_FACTOR,
+                ),
+            )
+
+        local_timeout = timeout - margin
+        return (
+            local_timeout
+            if local_timeout >= self.LOCAL_COMMAND_TIMEOUT_MIN
+            else self.LOCAL_COMMAND_TIMEOUT
+        )
+
     def _on_peer_connected(self, peer_id, peer_infos):
         """
         Device is connected
@@ -285,10 +1169,14 @@ class Cleepbus(CleepExternalBus):
         if existing_peer_uuid:
             # remove existing one
             del self.peers[existing_peer_uuid]
+            self.peers_last_seen.pop(existing_peer_uuid, None)
+            self._cancel_peer_expiry(existing_peer_uuid)
 
         # save new one
         peer_infos.online = True
         self.peers[peer_infos.uuid] = peer_infos
+        self.peers_last_seen[peer_infos.uuid] = time.time()
+        self._cancel_peer_expiry(peer_infos.uuid)
         self.logger.debug("Peer %s connected: %s", peer_id, str(peer_infos))
 
     def _on_peer_disconnected(self, peer_id):
@@ -302,6 +1190,9 @@ class Cleepbus(CleepExternalBus):
             return
 
         peer_infos.online = False
+        now = time.time()
+        self.peers_last_seen[peer_infos.uuid] = now
+        self._schedule_peer_expiry(peer_infos.uuid, now)
 
     def _get_peer_infos_from_peer_id(self, peer_id):
         """
@@ -324,7 +1215,13 @@ class Cleepbus(CleepExternalBus):
             event (MessageRequest): event data
         """
         # handle received event and transfer it to external buf if necessary
-        self.logger.debug("Received event %s", event)
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug("Received event %s", event)
+
+        # network changed, mac addresses must be computed again
+        if event["event"] in ("network.status.up", "network.status.down"):
+            self.external_bus.invalidate_mac_addresses()
 
         # network events to start or stop bus properly and avoid invalid ip address in pyre bus (workaround)
         if event["event"] == "network.status.up" and not self.external_bus.is_running():
@@ -338,22 +1235,22 @@ class Cleepbus(CleepExternalBus):
             self._stop_external_bus()
             return
 
-        if (not event["startup"] if "startup" in event else True) and (
-            event["propagate"] if "propagate" in event else False
+        if (
+            (not event["startup"] if "startup" in event else True)
+            and (event["propagate"] if "propagate" in event else False)
+            and self._is_event_propagated(event["event"])
         ):
             # broadcast events to external bus that are allowed to go outside of the device
-            message = MessageRequest()
-            message.event = event.get("event")
-            message.params = event.get("params")
-            message.sender = event.get("sender")
-            self.external_bus.send_message(message)
+            self.external_bus.send_event(
+                event.get("event"), event.get("params"), event.get("sender")
+            )
 
-        else:
+        elif debug:
             # drop current event
             self.logger.debug("Received event %s dropped", event["event"])
 
     def _send_command_to_peer(
-        self, command, to, peer_uuid, params=None, timeout=8.0, manual_response=None
+        self, command, to, peer_uuid, params=None, timeout=None, manual_response=None
     ):
         """
         Send command to specified peer
@@ -363,7 +1260,8 @@ class Cleepbus(CleepExternalBus):
             to (string): module name to send command to
             peer_uuid (string): peer uuid to send command to
             params (dict): command parameters. Default None
-            timeout (float): command timeout. Should be greater than 3.0 seconds. Default 8.0
+            timeout (float): command timeout. Should be greater than 3.0 seconds. Default computed from
+                             observed peer command durations (COMMAND_TIMEOUT until enough durations are known)
             manual_response (function): function to call after command response was received
         """
         # check parameters
@@ -391,6 +1289,7 @@ class Cleepbus(CleepExternalBus):
                     "name": "timeout",
                     "type": float,
                     "value": timeout,
+                    "none": True,
                     "validator": lambda val: val > 3.0,
                     "message": "Timeout must be greater than 3.0 seconds",
                 },
@@ -403,10 +1302,252 @@ class Cleepbus(CleepExternalBus):
         message.command = command
         message.params = params
         message.peer_infos = self.peers[peer_uuid]
+        if timeout is None:
+            timeout = self.command_timeouts.get_timeout(peer_uuid, command)
         message.timeout = timeout
 
+        if manual_response is not None:
+            token = uuid.uuid4().hex
+            on_response = self._measure_command_response(
+                token, peer_uuid, command, manual_response, timeout
+            )
+            if self.external_bus.send_command_to_peer(message, timeout, on_response):
+                return
+            # peer does not answer commands, command duration can not be measured
+            self.__pending_commands.pop(token, None)
         self.external_bus.send_message(message, timeout, manual_response)
 
+    def send_command_to_all(self, command, to, params=None, timeout=None, quorum=None):
+        """
+        Send command once to all online peers (single broadcast instead of one message per peer)
+        and collect their responses
+
+        Args:
+            command (string): command name
+            to (string): module name to send command to
+            params (dict): command parameters. Default None
+            timeout (float): command timeout. Should be greater than 3.0 seconds. Default computed from
+                             observed command durations of each peer
+            quorum (int): stop waiting after this number of responses. Default None (all peers)
+
+        Returns:
+            dict: responses::
+
+            {
+                responses (dict): command response by peer uuid
+                missing (list): uuids of peers that did not respond in time
+            }
+
+        """
+        self._check_parameters(
+            [
+                {"name": "command", "type": str, "value": command},
+                {"name": "to", "type": str, "value": to},
+                {"name": "params", "type": dict, "value": params, "none": True},
+                {
+                    "name": "timeout",
+                    "type": float,
+                    "value": timeout,
+                    "none": True,
+                    "validator": lambda val: val > 3.0,
+                    "message": "Timeout must be greater than 3.0 seconds",
+                },
+                {
+                    "name": "quorum",
+                    "type": int,
+                    "value": quorum,
+                    "none": True,
+                    "validator": lambda val: val > 0,
+                    "message": "Quorum must be greater than 0",
+                },
+            ]
+        )
+
+        def get_peer_uuid(peer_id):
+            peer_infos = self._get_peer_infos_from_peer_id(peer_id)
+            return peer_infos.uuid if peer_infos else peer_id
+
+        def get_timeout(peer_id):
+            if timeout is not None:
+                return timeout
+            return self.command_timeouts.get_timeout(get_peer_uuid(peer_id), command)
+
+        start = time.time()
+
+        def on_response(peer_id, _response):
+            self.command_timeouts.add_sample(
+                get_peer_uuid(peer_id), command, time.time() - start
+            )
+
+        message = MessageRequest()
+        message.to = to
+        message.command = command
+        message.params = params
+        message.timeout = timeout
+        request = self.external_bus.send_command_to_all(
+            message, get_timeout, quorum, on_response
+        )
+        # responses are yielded as they arrive, until request completes
+        responses = {get_peer_uuid(peer_id): response for peer_id, response in request}
+
+        for peer_id in request.missing:
+            self.command_timeouts.add_timeout(
+                get_peer_uuid(peer_id), command, get_timeout(peer_id)
+            )
+
+        return {
+            "responses": responses,
+            "missing": [get_peer_uuid(peer_id) for peer_id in request.missing],
+        }
+
+    def _measure_command_response(
+        self, token, peer_uuid, command, manual_response, timeout
+    ):
+        """
+        Wrap command response callback to record command duration. Command without response
+        before timeout is recorded as timed out
+
+        Args:
+            token (string): pending command identifier
+            peer_uuid (string): peer uuid command is sent to
+            command (string): command name
+            manual_response (function): function to call after command response was received
+            timeout (float): command timeout (seconds)
+
+        Returns:
+            function: bus response callback: on_response(peer_id, response)
+        """
+        start = time.time()
+        self.__pending_commands[token] = (peer_uuid, command, timeout, start + timeout)
+
+        def on_response(_peer_id, response):
+            # response received after timeout was already recorded as timed out
+            if self.__pending_commands.pop(token, None) is not None:
+                self.command_timeouts.add_sample(
+                    peer_uuid, command, time.time() - start
+                )
+            return manual_response(response)
+
+        return on_response
+
+    def _expire_pending_commands(self):
+        """
+        Record commands sent to peers without response before their timeout
+        """
+        now = time.time()
+        for token, (peer_uuid, command, timeout, deadline) in list(
+            self.__pending_commands.items()
+        ):
+            if deadline <= now:
+                del self.__pending_commands[token]
+                self.command_timeouts.add_timeout(peer_uuid, command, timeout)
+
+    def send_file_to_peer(self, peer_uuid, filepath):
+        """
+        Send file to specified peer. File is streamed by chunks so memory usage stays low
+        whatever the file size. Peer sends cleepbus.file.received event when file is received.
+
+        Args:
+            peer_uuid (string): peer uuid
+            filepath (string): path of file to send
+
+        Returns:
+            int: number of sent chunks
+        """
+        self._check_parameters(
+            [
+                {
+                    "name": "peer_uuid",
+                    "type": str,
+                    "value": peer_uuid,
+                    "validator": lambda val: val in self.peers
+                    and self.peers[val].online,
+                    "message": f'Specified peer "{peer_uuid}" does not exist or is not online',
+                },
+                {
+                    "name": "filepath",
+                    "type": str,
+                    "value": filepath,
+                    "validator": os.path.isfile,
+                    "message": f'File "{filepath}" does not exist',
+                },
+            ]
+        )
+
+        def read_chunks():
+            with open(filepath, "rb") as file_descriptor:
+                while True:
+                    chunk = file_descriptor.read(self.external_bus.STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        infos = {
+            "name": os.path.basename(filepath),
+            "size": os.path.getsize(filepath),
+        }
+        try:
+            return self.external_bus.send_stream(
+                self.peers[peer_uuid].ident, read_chunks(), infos
+            )
+        except Exception as error:
+            raise CommandError(f"Unable to send file: {error}") from error
+
+    def _on_stream_received(self, peer_id, stream):
+        """
+        Peer opened a stream: save it to a file from a dedicated thread to not block the bus
+
+        Args:
+            peer_id (string): peer identifier
+            stream (BusStream): stream to consume
+        """
+        peer_infos = self._get_peer_infos_from_peer_id(peer_id)
+        if not peer_infos:
+            raise Exception(f'Stream from unknown peer "{peer_id}" refused')
+        size = stream.infos.get("size") or 0
+        if not isinstance(size, int) or size > self.MAX_RECEIVED_FILE_SIZE:
+            raise Exception(f'Stream from peer "{peer_id}" is too big ({size} bytes)')
+
+        thread = threading.Thread(
+            target=self._receive_stream_to_file,
+            args=(peer_infos.uuid, stream),
+            daemon=True,
+        )
+        thread.start()
+
+    def _receive_stream_to_file(self, peer_uuid, stream):
+        """
+        Write received stream to temporary file and send cleepbus.file.received event. Stream is
+        cancelled and file removed if it exceeds MAX_RECEIVED_FILE_SIZE
+
+        Args:
+            peer_uuid (string): sender peer uuid
+            stream (BusStream): stream to consume
+        """
+        filepath = os.path.join(tempfile.gettempdir(), f"cleepbus_{uuid.uuid4().hex}")
+        file_descriptor = None
+        try:
+            file_descriptor = self.cleep_filesystem.open(filepath, "wb")
+            size = 0
+            for chunk in stream:
+                size += len(chunk)
+                if size > self.MAX_RECEIVED_FILE_SIZE:
+                    raise Exception(f"File exceeds {self.MAX_RECEIVED_FILE_SIZE} bytes")
+                file_descriptor.write(chunk)
+        except Exception:
+            self.logger.exception('Error receiving stream from peer "%s"', peer_uuid)
+            stream.cancel()
+            if file_descriptor is not None:
+                self.cleep_filesystem.close(file_descriptor)
+                self.cleep_filesystem.rm(filepath)
+            return
+        self.cleep_filesystem.close(file_descriptor)
+
+        self.logger.debug('File received from peer "%s": %s', peer_uuid, filepath)
+        self.file_received_event.send(
+            {"peer_uuid": peer_uuid, "filepath": filepath, "infos": stream.infos}
+        )
+
     def _send_event_to_peer(self, event_name, peer_uuid, params=None):
         """
         Send event to specified peer through external bus implementation
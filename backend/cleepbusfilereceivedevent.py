@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from cleep.libs.internals.event import Event
+
+
+class CleepbusFileReceivedEvent(Event):
+    """
+    Cleepbus.file.received event
+    """
+
+    EVENT_NAME = "cleepbus.file.received"
+    EVENT_PROPAGATE = False
+    EVENT_PARAMS = ["peer_uuid", "filepath", "infos"]
+
+    def __init__(self, params):
+        """
+        Constructor
+
+        Args:
+            params (dict): event parameters
+        """
+        Event.__init__(self, params)
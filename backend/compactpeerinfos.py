@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import types
+import weakref
+from cleep.common import PeerInfos
+
+
+class SharedExtra(dict):
+    """
+    Read-only peer extra infos, shared by all peers advertising the same values
+    """
+
+    __slots__ = ("__weakref__", "_apps")
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError("Shared peer extra infos are read-only")
+
+    __setitem__ = __readonly
+    __delitem__ = __readonly
+    clear = __readonly
+    pop = __readonly
+    popitem = __readonly
+    setdefault = __readonly
+    update = __readonly
+
+    @property
+    def apps(self):
+        """
+        Return peer installed applications, decoded once for all peers sharing these infos
+
+        Returns:
+            tuple: applications names
+        """
+        try:
+            return self._apps
+        except AttributeError:
+            try:
+                apps = tuple(sys.intern(app) for app in json.loads(self.get("apps")))
+            except Exception:
+                apps = ()
+            self._apps = apps
+            return apps
+
+    def __reduce__(self):
+        """
+        Copies and pickles of shared extra infos are plain dicts
+        """
+        return (dict, (dict(self),))
+
+
+class CompactPeerInfos(PeerInfos):
+    """
+    PeerInfos storing its fields in slots with extra infos shared between peers, to keep memory
+    low when tracking hundreds of devices. PeerInfos is not slotted so instances still have an
+    instance dict, which stays empty
+
+    Shared extra infos are copy-on-write: extra attribute returns a read-only view of them and
+    update_extra copies them to a peer own dict before modifying it, without affecting other peers
+    """
+
+    __slots__ = (
+        "uuid",
+        "ident",
+        "hostname",
+        "ip",
+        "port",
+        "ssl",
+        "macs",
+        "cleepdesktop",
+        "online",
+        "_extra",
+    )
+
+    @property
+    def extra(self):
+        """
+        Return peer extra infos
+
+        Returns:
+            dict: peer extra infos, read-only view if they are shared (see update_extra)
+        """
+        if isinstance(self._extra, SharedExtra):
+            return types.MappingProxyType(self._extra)
+        return self._extra
+
+    @extra.setter
+    def extra(self, extra):
+        """
+        Set peer extra infos
+
+        Args:
+            extra (dict): peer extra infos (SharedExtra to share them with other peers)
+        """
+        self._extra = extra
+
+    def update_extra(self, values):
+        """
+        Update peer extra infos. Shared extra infos are copied to a peer own dict first
+
+        Args:
+            values (dict): extra infos to add or replace
+        """
+        if isinstance(self._extra, SharedExtra):
+            self._extra = dict(self._extra)
+        self._extra.update(values)
+
+    @property
+    def apps(self):
+        """
+        Return peer installed applications
+
+        Returns:
+            tuple: applications names
+        """
+        return self._extra.apps if isinstance(self._extra, SharedExtra) else ()
+
+    def to_dict(self, with_extra=False):
+        """
+        Return peer infos as dict. Shared extra infos are returned as is (read-only dict)
+
+        Args:
+            with_extra (bool): add extra infos. Default False
+
+        Returns:
+            dict: peer infos
+        """
+        infos = PeerInfos.to_dict(self)
+        if with_extra:
+            infos["extra"] = self._extra
+        return infos
+
+
+class PeerInfosPool:
+    """
+    Pool of extra infos shared between peers. Keys and values are interned and identical extra
+    infos are stored once. Entries are released when no peer uses them anymore
+    """
+
+    __default = None
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.__extras = weakref.WeakValueDictionary()
+
+    @classmethod
+    def get_default(cls):
+        """
+        Return process wide pool
+
+        Returns:
+            PeerInfosPool: default pool
+        """
+        if cls.__default is None:
+            cls.__default = PeerInfosPool()
+        return cls.__default
+
+    def __len__(self):
+        """
+        Return number of distinct extra infos in pool
+
+        Returns:
+            int: number of entries
+        """
+        return len(self.__extras)
+
+    @staticmethod
+    def intern(value):
+        """
+        Intern string value
+
+        Args:
+            value (any): value
+
+        Returns:
+            any: interned value if value is a string, value otherwise
+        """
+        return sys.intern(value) if isinstance(value, str) else value
+
+    def share_extra(self, extra):
+        """
+        Return shared extra infos with the same content than specified ones
+
+        Args:
+            extra (dict): peer extra infos
+
+        Returns:
+            SharedExtra: shared read-only extra infos
+        """
+        try:
+            items = frozenset(
+                (self.intern(key), self.intern(value)) for key, value in extra.items()
+            )
+        except TypeError:
+            # unhashable value, do not share it
+            return SharedExtra(extra)
+        shared = self.__extras.get(items)
+        if shared is None:
+            shared = SharedExtra(items)
+            self.__extras[items] = shared
+        return shared
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import fnmatch
+
+
+class EventMatcher:
+    """
+    Match event names against a list of patterns (glob syntax like "system.device.*", or regular
+    expression prefixed by "re:" like "re:system\\.(device|alert)\\..*")
+
+    Patterns are compiled once: exact names are stored in a set and wildcard patterns are
+    merged into a single regular expression. Match results are cached per event name.
+    """
+
+    MATCH_ALL = "*"
+    REGEX_PREFIX = "re:"
+    CACHE_SIZE = 512
+
+    def __init__(self, patterns):
+        """
+        Constructor
+
+        Args:
+            patterns (list): list of event name patterns
+        """
+        self.patterns = list(patterns or [])
+        self.match_all = self.MATCH_ALL in self.patterns
+
+        wildcards = [
+            EventMatcher.to_regex(pattern)
+            for pattern in self.patterns
+            if EventMatcher.is_wildcard(pattern)
+        ]
+        self.__names = frozenset(
+            pattern
+            for pattern in self.patterns
+            if not EventMatcher.is_wildcard(pattern)
+        )
+        self.__regex = re.compile("|".join(wildcards)) if wildcards else None
+        self.__cache = {}
+
+    @staticmethod
+    def is_wildcard(pattern):
+        """
+        Return True if pattern contains glob special chars
+
+        Args:
+            pattern (string): pattern
+
+        Returns:
+            bool: True if pattern is not an exact event name
+        """
+        return pattern.startswith(EventMatcher.REGEX_PREFIX) or any(
+            char in pattern for char in "*?["
+        )
+
+    @staticmethod
+    def to_regex(pattern):
+        """
+        Convert wildcard pattern to regular expression matching whole event name
+
+        Args:
+            pattern (string): glob pattern or regular expression prefixed by "re:"
+
+        Returns:
+            string: regular expression
+
+        Raises:
+            re.error: if regular expression is invalid
+        """
+        if not pattern.startswith(EventMatcher.REGEX_PREFIX):
+            return fnmatch.translate(pattern)
+
+        regex = pattern[len(EventMatcher.REGEX_PREFIX) :]
+        re.compile(regex)
+        return f"(?:{regex})\\Z"
+
+    def match(self, event_name):
+        """
+        Check if event name matches one of the patterns
+
+        Args:
+            event_name (string): event name
+
+        Returns:
+            bool: True if event name matches
+        """
+        if self.match_all:
+            return True
+
+        matched = self.__cache.get(event_name)
+        if matched is None:
+            matched = event_name in self.__names or bool(
+                self.__regex and self.__regex.match(event_name)
+            )
+            if len(self.__cache) >= self.CACHE_SIZE:
+                self.__cache.clear()
+            self.__cache[event_name] = matched
+
+        return matched
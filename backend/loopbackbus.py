@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import uuid
+import threading
+
+# pylint: disable=E0402
+from . import pyrebus
+from .pyrebus import PyreBus, import_dependencies
+
+
+class LoopbackRegistry:
+    """
+    In-process discovery registry of loopback nodes. Nodes registered with the same bus name
+    see each other like Pyre nodes on a network (ENTER, JOIN, LEAVE and EXIT events)
+    """
+
+    __default = None
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.__lock = threading.RLock()
+        # registered nodes by uuid
+        self.nodes = {}
+
+    @classmethod
+    def get_default(cls):
+        """
+        Return process wide registry
+
+        Returns:
+            LoopbackRegistry: default registry
+        """
+        if cls.__default is None:
+            cls.__default = LoopbackRegistry()
+        return cls.__default
+
+    def __peers_of(self, node):
+        """
+        Return registered nodes on the same bus than specified node
+
+        Args:
+            node (LoopbackNode): node
+
+        Returns:
+            list: list of LoopbackNode
+        """
+        return [
+            other
+            for other in self.nodes.values()
+            if other is not node and other.name() == node.name()
+        ]
+
+    @staticmethod
+    def __head(node, event_type):
+        """
+        Return first frames of event sent by node
+
+        Args:
+            node (LoopbackNode): node the event comes from
+            event_type (bytes): event type (ENTER, EXIT, JOIN...)
+
+        Returns:
+            list: event type, node uuid and node name frames
+        """
+        return [event_type, node.uuid().bytes, node.name().encode("utf-8")]
+
+    def register(self, node):
+        """
+        Register node: node and nodes already registered on the same bus discover each other
+
+        Args:
+            node (LoopbackNode): node to register
+        """
+        with self.__lock:
+            self.nodes[node.uuid()] = node
+            for other in self.__peers_of(node):
+                for source, target in ((node, other), (other, node)):
+                    target.deliver(
+                        LoopbackRegistry.__head(source, b"ENTER")
+                        + [
+                            json.dumps(source.headers).encode("utf-8"),
+                            source.endpoint().encode("utf-8"),
+                        ]
+                    )
+                    for group in source.groups:
+                        target.deliver(
+                            LoopbackRegistry.__head(source, b"JOIN")
+                            + [group.encode("utf-8")]
+                        )
+
+    def unregister(self, node):
+        """
+        Unregister node, other nodes on the same bus receive EXIT event
+
+        Args:
+            node (LoopbackNode): node to unregister
+        """
+        with self.__lock:
+            if self.nodes.pop(node.uuid(), None) is None:
+                return
+            for other in self.__peers_of(node):
+                other.deliver(LoopbackRegistry.__head(node, b"EXIT"))
+
+    def group_changed(self, node, group, joined):
+        """
+        Notify other nodes that node joined or left group
+
+        Args:
+            node (LoopbackNode): node
+            group (string): group name
+            joined (bool): True if node joined group, False if it left it
+        """
+        with self.__lock:
+            if node.uuid() not in self.nodes:
+                return
+            head = LoopbackRegistry.__head(node, b"JOIN" if joined else b"LEAVE")
+            for other in self.__peers_of(node):
+                other.deliver(head + [group.encode("utf-8")])
+
+    def whisper(self, node, peer_uuid, frames):
+        """
+        Send frames to node peer
+
+        Args:
+            node (LoopbackNode): sender node
+            peer_uuid (UUID): recipient node uuid
+            frames (list): frames to send
+        """
+        target = self.nodes.get(peer_uuid)
+        if target is not None and target.name() == node.name():
+            target.deliver(LoopbackRegistry.__head(node, b"WHISPER") + list(frames))
+
+    def shout(self, node, group, frames):
+        """
+        Send frames to all node peers in group
+
+        Args:
+            node (LoopbackNode): sender node
+            group (string): group name
+            frames (list): frames to send
+        """
+        head = LoopbackRegistry.__head(node, b"SHOUT") + [group.encode("utf-8")]
+        with self.__lock:
+            targets = [
+                other for other in self.__peers_of(node) if group in other.groups
+            ]
+        for target in targets:
+            target.deliver(head + list(frames))
+
+    def get_endpoint(self, peer_uuid):
+        """
+        Return node endpoint
+
+        Args:
+            peer_uuid (UUID): node uuid
+
+        Returns:
+            string: node endpoint or None if node is not registered
+        """
+        node = self.nodes.get(peer_uuid)
+        return node.endpoint() if node else None
+
+
+class LoopbackNode:
+    """
+    In-process node implementing the part of Pyre node API used by PyreBus
+
+    Events and messages from other nodes are queued in an inproc PAIR socket, so node socket
+    can be polled like Pyre node socket.
+    """
+
+    def __init__(self, name, registry, context):
+        """
+        Constructor
+
+        Args:
+            name (string): bus name
+            registry (LoopbackRegistry): discovery registry
+            context (zmq.Context): zmq context
+        """
+        import_dependencies()
+        zmq = pyrebus.zmq
+        self.__name = name
+        self.__uuid = uuid.uuid4()
+        self.__registry = registry
+        self.__lock = threading.Lock()
+        self.__started = False
+        self.headers = {}
+        self.groups = set()
+        # events dropped because node inbox was full
+        self.dropped = 0
+
+        address = f"inproc://loopback-{self.__uuid.hex}"
+        self.__inbox = context.socket(zmq.PAIR)
+        self.__inbox.setsockopt(zmq.LINGER, 0)
+        self.__inbox.bind(address)
+        self.__outbox = context.socket(zmq.PAIR)
+        self.__outbox.setsockopt(zmq.LINGER, 0)
+        self.__outbox.connect(address)
+
+    def uuid(self):
+        """
+        Return node uuid
+
+        Returns:
+            UUID: node uuid
+        """
+        return self.__uuid
+
+    def name(self):
+        """
+        Return node name (bus name)
+
+        Returns:
+            string: node name
+        """
+        return self.__name
+
+    def endpoint(self):
+        """
+        Return node endpoint
+
+        Returns:
+            string: node endpoint
+        """
+        return f"inproc://loopback-{self.__uuid.hex}"
+
+    def peer_address(self, peer_uuid):
+        """
+        Return peer endpoint
+
+        Args:
+            peer_uuid (UUID): peer uuid
+
+        Returns:
+            string: peer endpoint
+        """
+        return self.__registry.get_endpoint(peer_uuid) or ""
+
+    def set_header(self, key, value):
+        """
+        Set node header, sent to peers when node starts
+
+        Args:
+            key (string): header name
+            value (string): header value
+        """
+        self.headers[key] = value
+
+    def join(self, group):
+        """
+        Join group
+
+        Args:
+            group (string): group name
+        """
+        self.groups.add(group)
+        self.__registry.group_changed(self, group, True)
+
+    def leave(self, group):
+        """
+        Leave group
+
+        Args:
+            group (string): group name
+        """
+        self.groups.discard(group)
+        self.__registry.group_changed(self, group, False)
+
+    def start(self):
+        """
+        Start node: register it to discover other nodes
+        """
+        self.__started = True
+        self.__registry.register(self)
+
+    def stop(self):
+        """
+        Stop node: unregister it and close its sockets. Can be called several times
+        """
+        if not self.__started:
+            return
+        self.__started = False
+        self.__registry.unregister(self)
+        with self.__lock:
+            self.__outbox.close()
+            self.__inbox.close()
+
+    def socket(self):
+        """
+        Return socket to poll for incoming events
+
+        Returns:
+            zmq.Socket: node socket
+        """
+        return self.__inbox
+
+    def recv(self):
+        """
+        Receive next event
+
+        Returns:
+            list: event frames
+        """
+        return self.__inbox.recv_multipart()
+
+    def whisper(self, peer_uuid, frames):
+        """
+        Send frames to peer
+
+        Args:
+            peer_uuid (UUID): peer uuid
+            frames (list): frames to send
+        """
+        self.__registry.whisper(self, peer_uuid, frames)
+
+    def shout(self, group, frames):
+        """
+        Send frames to all peers in group
+
+        Args:
+            group (string): group name
+            frames (list): frames to send
+        """
+        self.__registry.shout(self, group, frames)
+
+    def deliver(self, frames):
+        """
+        Queue event for this node without blocking (like a network drops packets, event is dropped
+        if node inbox is full). Can be called from any thread
+
+        Args:
+            frames (list): event frames
+        """
+        zmq = pyrebus.zmq
+        with self.__lock:
+            if not self.__started:
+                return
+            try:
+                self.__outbox.send_multipart(frames, flags=zmq.NOBLOCK)
+            except zmq.Again:
+                self.dropped += 1
+
+
+class LoopbackBus(PyreBus):
+    """
+    External bus using in-process loopback transport instead of Pyre network nodes
+
+    It runs many bus instances in the same process without network (load tests, CI, benchmarks).
+    Each instance gets its own fake mac address so Cleepbus sees them as different devices.
+    """
+
+    def __init__(self, *args, registry=None, **kwargs):
+        """
+        Constructor
+
+        Args:
+            args: PyreBus arguments
+            registry (LoopbackRegistry): discovery registry. Default process wide registry
+            kwargs: PyreBus keyword arguments
+        """
+        PyreBus.__init__(self, *args, **kwargs)
+        self.registry = registry or LoopbackRegistry.get_default()
+        # locally administered unicast mac address
+        self.mac_address = ":".join(
+            f"{byte:02x}" for byte in bytes([0x02]) + os.urandom(5)
+        )
+
+    def _create_node(self, bus_name):
+        """
+        Create loopback node
+
+        Args:
+            bus_name (string): bus name
+
+        Returns:
+            LoopbackNode: loopback node
+        """
+        return LoopbackNode(bus_name, self.registry, self.context)
+
+    def get_mac_addresses(self):
+        """
+        Return fake mac address of this instance
+
+        Returns:
+            list: list of mac addresses
+        """
+        return [self.mac_address]
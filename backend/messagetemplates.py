@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+from collections import OrderedDict
+from cleep.common import MessageRequest
+
+
+class MessageTemplates:
+    """
+    Cache of pre-serialized event messages keyed by (event, sender)
+
+    Each template holds encoded message without params, split around params value, so only params
+    are encoded when an event is sent again. Encoded content is the same than the one built from
+    a MessageRequest.
+    """
+
+    MAX_TEMPLATES = 256
+    # placeholder replaced by params when building template (control chars are escaped by json)
+    PARAMS_PLACEHOLDER = "\x00params\x00"
+
+    def __init__(self, clean_message, max_templates=MAX_TEMPLATES):
+        """
+        Constructor
+
+        Args:
+            clean_message (function): function returning dict of message sent to peers
+            max_templates (int): max number of cached templates. Default MAX_TEMPLATES
+        """
+        self.clean_message = clean_message
+        self.max_templates = max_templates
+        # (prefix, suffix) by (event, sender), least recently used first
+        self.__templates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        """
+        Return number of cached templates
+
+        Returns:
+            int: number of templates
+        """
+        return len(self.__templates)
+
+    def clear(self):
+        """
+        Remove all templates
+        """
+        self.__templates.clear()
+
+    def _make_template(self, event, sender):
+        """
+        Build template of event
+
+        Args:
+            event (string): event name
+            sender (string): event sender
+
+        Returns:
+            tuple: encoded content before and after params (bytes)
+        """
+        message = MessageRequest()
+        message.event = event
+        message.sender = sender
+        message.params = self.PARAMS_PLACEHOLDER
+        content = json.dumps(self.clean_message(message)).encode("utf-8")
+        placeholder = json.dumps(self.PARAMS_PLACEHOLDER).encode("utf-8")
+        prefix, suffix = content.split(placeholder)
+        return prefix, suffix
+
+    def encode(self, event, params=None, sender=None):
+        """
+        Encode event message
+
+        Args:
+            event (string): event name
+            params (dict): event parameters. Default None
+            sender (string): event sender. Default None
+
+        Returns:
+            bytes: encoded message
+        """
+        key = (event, sender)
+        template = self.__templates.get(key)
+        if template is None:
+            self.misses += 1
+            if len(self.__templates) >= self.max_templates:
+                self.__templates.popitem(last=False)
+            template = self.__templates[key] = self._make_template(event, sender)
+        else:
+            self.hits += 1
+            self.__templates.move_to_end(key)
+
+        return b"".join((template[0], json.dumps(params).encode("utf-8"), template[1]))
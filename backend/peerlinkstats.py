@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import deque
+
+# pylint: disable=E0402
+from .percentile import percentile
+
+
+class PeerLinkStats:
+    """
+    Link quality statistics of a peer computed from ping/pong round trips
+
+    Round trip time is smoothed with an exponential moving average and jitter is computed
+    like RTP interarrival jitter (RFC 3550). Last samples are kept to compute percentiles.
+    """
+
+    RTT_SMOOTHING = 0.125
+    JITTER_SMOOTHING = 0.0625
+    MAX_SAMPLES = 100
+    MAX_PENDING = 16
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.rtt = None
+        self.jitter = 0.0
+        self.min_rtt = None
+        self.max_rtt = None
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.samples = deque(maxlen=self.MAX_SAMPLES)
+        self.__last_rtt = None
+        # pending pings: seq => sent timestamp
+        self.__pending = {}
+
+    def ping_sent(self, seq, timestamp):
+        """
+        Ping was sent
+
+        Args:
+            seq (int): ping sequence
+            timestamp (float): sent timestamp
+        """
+        self.sent += 1
+        if len(self.__pending) >= self.MAX_PENDING:
+            # oldest pending ping is considered lost
+            del self.__pending[min(self.__pending)]
+            self.lost += 1
+        self.__pending[seq] = timestamp
+
+    def pong_received(self, seq, timestamp):
+        """
+        Pong was received
+
+        Args:
+            seq (int): ping sequence
+            timestamp (float): received timestamp
+
+        Returns:
+            float: measured round trip time (seconds) or None if ping is unknown (already expired)
+        """
+        sent_at = self.__pending.pop(seq, None)
+        if sent_at is None:
+            return None
+
+        rtt = timestamp - sent_at
+        self.add_sample(rtt)
+        self.received += 1
+        return rtt
+
+    def add_sample(self, rtt):
+        """
+        Add round trip time sample
+
+        Args:
+            rtt (float): round trip time (seconds)
+        """
+        self.samples.append(rtt)
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += (rtt - self.rtt) * self.RTT_SMOOTHING
+        if self.__last_rtt is not None:
+            self.jitter += (
+                abs(rtt - self.__last_rtt) - self.jitter
+            ) * self.JITTER_SMOOTHING
+        self.__last_rtt = rtt
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.max_rtt = rtt if self.max_rtt is None else max(self.max_rtt, rtt)
+
+    def expire_pending(self, timestamp, timeout):
+        """
+        Consider pings without pong after timeout as lost
+
+        Args:
+            timestamp (float): current timestamp
+            timeout (float): ping timeout (seconds)
+        """
+        expired = [
+            seq
+            for seq, sent_at in self.__pending.items()
+            if timestamp - sent_at > timeout
+        ]
+        for seq in expired:
+            del self.__pending[seq]
+        self.lost += len(expired)
+
+    def percentile(self, percent):
+        """
+        Return round trip time percentile over last samples
+
+        Args:
+            percent (float): percentile (0-100)
+
+        Returns:
+            float: round trip time (seconds) or None if no sample
+        """
+        if not self.samples:
+            return None
+
+        return percentile(sorted(self.samples), percent)
+
+    def to_dict(self):
+        """
+        Return stats as dict
+
+        Returns:
+            dict: link stats::
+
+            {
+                rtt (float): smoothed round trip time (seconds)
+                jitter (float): round trip time jitter (seconds)
+                min_rtt (float): min round trip time (seconds)
+                max_rtt (float): max round trip time (seconds)
+                p99_rtt (float): round trip time 99th percentile over last samples (seconds)
+                sent (int): number of sent pings
+                received (int): number of received pongs
+                lost (int): number of lost pings
+                loss (float): loss ratio (0-1)
+            }
+
+        """
+        answered = self.received + self.lost
+        return {
+            "rtt": self.rtt,
+            "jitter": self.jitter,
+            "min_rtt": self.min_rtt,
+            "max_rtt": self.max_rtt,
+            "p99_rtt": self.percentile(99),
+            "sent": self.sent,
+            "received": self.received,
+            "lost": self.lost,
+            "loss": self.lost / answered if answered else 0.0,
+        }
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+class PeerSequence:
+    """
+    Check sequence numbers of messages received from a peer
+
+    Peer numbers its messages per stream (its direct messages to this device and its broadcast
+    messages on each channel). First number received on a stream is the starting point, then
+    skipped numbers are counted as lost until they arrive late (reordered or replayed) and
+    numbers already received are duplicates.
+
+    Received numbers are remembered in a bitmap of the last MAX_RECEIVED numbers, so only numbers
+    known to be received are dropped. Older numbers are delivered as late, they are not counted
+    as recovered losses since they were not tracked.
+    """
+
+    # max missing numbers reported by stream
+    MAX_MISSING = 64
+    # size of received numbers bitmap by stream
+    MAX_RECEIVED = 1024
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        # next expected number, missing numbers and received numbers bitmap by stream
+        # (bit i is set if number expected - 1 - i was received)
+        self.__streams = {}
+        self.received = 0
+        self.lost = 0
+        self.duplicated = 0
+        self.reordered = 0
+        self.recovered = 0
+
+    def check(self, stream, seq, replayed=False):
+        """
+        Check received message sequence number
+
+        Args:
+            stream (string): stream name ("" for direct messages, channel name for broadcast ones)
+            seq (int): message sequence number
+            replayed (bool): True if message was sent again after replay request. Default False
+
+        Returns:
+            tuple: True if message must be processed (False for duplicate) and list of missing
+                   sequence numbers detected by this message
+        """
+        mask = (1 << self.MAX_RECEIVED) - 1
+        state = self.__streams.get(stream)
+        if state is None:
+            # numbers before starting point are considered received
+            self.__streams[stream] = [seq + 1, [], mask]
+            self.received += 1
+            return True, []
+
+        expected, missing, received = state
+        if seq >= expected:
+            gap = list(range(max(expected, seq - self.MAX_MISSING), seq))
+            self.lost += seq - expected
+            missing.extend(gap)
+            del missing[: -self.MAX_MISSING]
+            state[0] = seq + 1
+            state[2] = ((received << (seq + 1 - expected)) | 1) & mask
+            self.received += 1
+            return True, gap
+
+        offset = expected - 1 - seq
+        if offset < self.MAX_RECEIVED:
+            if received >> offset & 1:
+                self.duplicated += 1
+                return False, []
+            # skipped number counted as lost when skipped
+            state[2] = received | (1 << offset)
+            self.lost -= 1
+
+        # late number: still missing, no longer reported as missing or out of bitmap (unknown,
+        # not counted as lost)
+        if seq in missing:
+            missing.remove(seq)
+        if replayed:
+            self.recovered += 1
+        else:
+            self.reordered += 1
+        self.received += 1
+        return True, []
+
+    def to_dict(self):
+        """
+        Return sequence statistics
+
+        Returns:
+            dict: sequence stats::
+
+            {
+                received (int): number of received messages
+                lost (int): number of messages never received
+                duplicated (int): number of dropped duplicate messages
+                reordered (int): number of messages received after following ones
+                recovered (int): number of lost messages received again after replay request
+            }
+
+        """
+        return {
+            "received": self.received,
+            "lost": self.lost,
+            "duplicated": self.duplicated,
+            "reordered": self.reordered,
+            "recovered": self.recovered,
+        }
@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+def percentile(ordered, percent):
+    """
+    Return percentile of samples (nearest rank)
+
+    Args:
+        ordered (list): samples sorted in ascending order, not empty
+        percent (float): percentile (0-100)
+
+    Returns:
+        float: percentile value
+    """
+    index = min(len(ordered) - 1, int(round(percent / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
@@ -8,14 +8,110 @@ import uuid
 import binascii
 import os
 import ipaddress
+import zlib
+import threading
+import importlib
+import itertools
+from collections import namedtuple, deque, OrderedDict
 from urllib.parse import urlparse
 from cleep.libs.internals.externalbus import ExternalBus
 from cleep.common import MessageRequest
-from pyre_gevent import Pyre
-from pyre_gevent.zhelper import get_ifaddrs as zhelper_get_ifaddrs, u
-import zmq.green as zmq
-import netifaces
-import netaddr
+
+# pylint: disable=E0402
+from .eventmatcher import EventMatcher
+from .busstream import BusStream, BusOutgoingStream, BusStreamError
+from .peerlinkstats import PeerLinkStats
+from .tokenbucket import TokenBucket
+from .busprofiler import BusProfiler
+from .bustracer import BusTracer
+from .broadcastrequest import BroadcastRequest
+from .messagetemplates import MessageTemplates
+from .peersequence import PeerSequence
+from .reliabledelivery import ReliableSender, ReliableReceivers
+
+MessageMeta = namedtuple("MessageMeta", ["kind", "name", "flags", "seq", "order"])
+
+# heavy dependencies are imported when bus is used for the first time (see import_dependencies)
+# pylint: disable=C0103
+Pyre = None
+PyrePeer = None
+pyre_zbeacon = None
+zhelper_get_ifaddrs = None
+u = None
+zmq = None
+netifaces = None
+netaddr = None
+
+# original values of process wide pyre-gevent timers changed by bus, by (owner, attribute)
+process_timers_defaults = {}
+
+
+def import_dependencies():
+    """
+    Import bus dependencies (pyre, zmq, netifaces, netaddr) if not already imported
+
+    Dependencies are not imported with module to keep Cleep startup fast: bus only starts when
+    network is up. Already set dependencies are kept (mocked ones during tests for example).
+    """
+    # pylint: disable=W0603
+    global Pyre, PyrePeer, pyre_zbeacon, zhelper_get_ifaddrs, u, zmq, netifaces, netaddr
+    if Pyre is None:
+        Pyre = importlib.import_module("pyre_gevent").Pyre
+    if PyrePeer is None:
+        PyrePeer = importlib.import_module("pyre_gevent.pyre_peer").PyrePeer
+    if pyre_zbeacon is None:
+        pyre_zbeacon = importlib.import_module("pyre_gevent.zbeacon")
+    if zhelper_get_ifaddrs is None or u is None:
+        zhelper = importlib.import_module("pyre_gevent.zhelper")
+        zhelper_get_ifaddrs = zhelper_get_ifaddrs or zhelper.get_ifaddrs
+        u = u or zhelper.u
+    if zmq is None:
+        zmq = importlib.import_module("zmq.green")
+    if netifaces is None:
+        netifaces = importlib.import_module("netifaces")
+    if netaddr is None:
+        netaddr = importlib.import_module("netaddr")
+
+
+class PyreBusPeer:
+    """
+    Peer state kept by bus, filled from peer headers
+    """
+
+    def __init__(self, ident, subscriptions=None):
+        """
+        Constructor
+
+        Args:
+            ident (string): peer identifier
+            subscriptions (EventMatcher): events the peer is interested in. None if peer wants all events
+        """
+        self.ident = ident
+        self.subscriptions = subscriptions
+        self.groups = set()
+        self.features = set()
+        self.last_seen = time.time()
+        self.link = PeerLinkStats()
+        # inbound rate limiter (TokenBucket), created when rate limit is enabled
+        self.bucket = None
+        self.throttled = 0
+        # True while messages of peer are dropped, to warn once per throttling period
+        self.throttling = False
+        self.sequence = PeerSequence()
+        # device uuid, identifies peer across bus restarts
+        self.device_uuid = None
+
+    def is_interested(self, event_name):
+        """
+        Check if peer subscribed to specified event
+
+        Args:
+            event_name (string): event name
+
+        Returns:
+            bool: True if peer wants the event
+        """
+        return self.subscriptions is None or self.subscriptions.match(event_name)
 
 
 class PyreBus(ExternalBus):
@@ -28,6 +124,70 @@ class PyreBus(ExternalBus):
 
     BUS_STOP = "$$STOP$$"
 
+    HEADER_SUBSCRIPTIONS = "subscriptions"
+    HEADER_FEATURES = "busfeatures"
+
+    FEATURE_ZLIB = "zlib"
+    FEATURE_STREAM = "stream"
+    FEATURE_PING = "ping"
+    FEATURE_RESPONSE = "response"
+    FEATURE_REPLAY = "replay"
+    FEATURE_RELIABLE = "reliable"
+    FEATURES = [
+        FEATURE_ZLIB,
+        FEATURE_STREAM,
+        FEATURE_PING,
+        FEATURE_RESPONSE,
+        FEATURE_REPLAY,
+        FEATURE_RELIABLE,
+    ]
+
+    # message meta frame, sent after message content to keep older peers compatible
+    # format: <kind>|<name>|<flags>|<seq>|<order> (trailing empty fields are omitted)
+    # order is the sender sequence number of events and commands: <number> for direct messages,
+    # <number>@<channel> for broadcast messages. Reliable events use seq for their reliable number
+    # and order for the oldest number kept by sender
+    META_SEPARATOR = b"|"
+    KIND_EVENT = b"E"
+    KIND_COMMAND = b"C"
+    KIND_STREAM_OPEN = b"O"
+    KIND_STREAM = b"S"
+    KIND_STREAM_ACK = b"A"
+    STREAM_KINDS = (KIND_STREAM_OPEN, KIND_STREAM, KIND_STREAM_ACK)
+    KIND_PING = b"P"
+    KIND_PONG = b"Q"
+    PING_KINDS = (KIND_PING, KIND_PONG)
+    KIND_RESPONSE = b"R"
+    KIND_REPLAY = b"N"
+    KIND_ACK = b"K"
+    FLAG_COMPRESSED = b"z"
+    FLAG_STREAM_END = b"e"
+    FLAG_STREAM_ABORT = b"a"
+    FLAG_REPLAYED = b"r"
+    FLAG_RELIABLE = b"k"
+
+    COMPRESSION_THRESHOLD = 2048  # bytes
+    COMPRESSION_LEVEL = 6
+
+    STREAM_CHUNK_SIZE = 65536  # bytes
+    STREAM_WINDOW = 8  # chunks
+    STREAM_TIMEOUT = 30.0  # seconds
+
+    PING_TIMEOUT = 5.0  # seconds
+
+    RELIABLE_WINDOW = 64  # unacknowledged messages kept by peer
+    RELIABLE_TIMEOUT = 2.0  # seconds before sending again unacknowledged messages
+    RELIABLE_GIVE_UP = 600.0  # seconds before giving up messages of a gone peer device
+
+    # max messages read from bus at once before dispatching them fairly between peers
+    INBOUND_BURST = 32
+    INBOUND_QUEUE_SIZE = 16  # messages per peer
+
+    # pipe message holding raw frames to whisper: PIPE_FRAMES, peer ident, frames...
+    PIPE_FRAMES = b"$$FRAMES$$"
+    # pipe message holding event encoded from template: PIPE_EVENT, event name, content
+    PIPE_EVENT = b"$$EVENT$$"
+
     POLL_TIMEOUT = 500  # ms
 
     def __init__(
@@ -88,9 +248,137 @@ class PyreBus(ExternalBus):
         self.pipe_out = None
         self.__bus_name = None
         self.__bus_channel = None
+        self.__bus_channels = []
+        self.__mac_addresses = None
+        self.__mac_addresses_fingerprint = None
+        self.channel_routes = []
         self.endpoint = None
+        # bus peers::
+        #   {
+        #       peer ident (string): PyreBusPeer instance
+        #   }
+        self.peers = {}
+        self.event_filter = None
+        # function called when peer opens a stream: on_stream_received(peer_id, stream)
+        self.on_stream_received = None
+        self.__outgoing_streams = {}
+        self.__incoming_streams = {}
+        self.__loop_thread = None
+        # peers ping interval (seconds), None if disabled
+        self.ping_interval = None
+        self.__ping_seq = 0
+        self.__last_ping = 0.0
+        # inbound rate limit (rate, burst), None if disabled
+        self.rate_limit = None
+        # inbound messages waiting to be dispatched, by peer ident (round robin order)
+        self.__inbound_queues = OrderedDict()
+        self.profiler = BusProfiler()
+        # log one message every message_log_every messages, 0 if disabled
+        self.message_log_every = 0
+        self.__message_log_count = 0
+        self.tracer = BusTracer()
+        # pre-serialized events sent by send_event
+        self.templates = MessageTemplates(PyreBus.clean_message)
+        # broadcast requests waiting for responses, by request id
+        self.__requests = {}
+        self.__request_ids = itertools.count(1)
+        # last sequence number sent by stream (("peer", ident) or ("channel", name))
+        self.__sent_sequences = {}
+        # number of sent messages kept by stream to answer replay requests, 0 if disabled
+        self.replay_window = 0
+        self.__replay_buffers = {}
+        # events sent with at-least-once delivery (EventMatcher), None if disabled
+        self.reliable_events = None
+        # unacknowledged reliable messages by peer device uuid (kept across bus restarts)
+        self.__reliable_senders = {}
+        self.__reliable_receivers = ReliableReceivers()
+        self.__last_retransmit = 0.0
+        # peers waiting for acknowledgement
+        self.__pending_acks = set()
+        # static peers endpoints used instead of beacon discovery, empty to use beacons
+        self.static_peers = []
+        self.static_port = None
+        # discovery timers (seconds), None to use pyre defaults
+        self.beacon_interval = None
+        self.peer_evasive = None
+        self.peer_expired = None
+        self.stats = {
+            "filtered": 0,
+            "throttled": 0,
+            "channels": {},
+            "compression": {
+                "compressed": 0,
+                "compressed_bytes_in": 0,
+                "compressed_bytes_out": 0,
+                "compress_time": 0.0,
+                "decompressed": 0,
+                "decompress_time": 0.0,
+            },
+            "reliable": {
+                "sent": 0,
+                "acked": 0,
+                "retransmitted": 0,
+                "dropped": 0,
+                "duplicated": 0,
+            },
+        }
 
     def get_mac_addresses(self):
+        """
+        Return list of mac addresses used to identify cleep device
+
+        Result is cached until network interfaces change (interface added, removed or readdressed)
+        or cache is invalidated with invalidate_mac_addresses
+
+        Returns:
+            list: list of mac addresses
+        """
+        import_dependencies()
+        fingerprint = PyreBus.get_interfaces_fingerprint()
+        if (
+            self.__mac_addresses is not None
+            and fingerprint is not None
+            and fingerprint == self.__mac_addresses_fingerprint
+        ):
+            return list(self.__mac_addresses)
+
+        self.__mac_addresses = self._find_mac_addresses()
+        self.__mac_addresses_fingerprint = fingerprint
+        return list(self.__mac_addresses)
+
+    def invalidate_mac_addresses(self):
+        """
+        Invalidate mac addresses cache, next get_mac_addresses call walks interfaces again
+        """
+        self.__mac_addresses = None
+        self.__mac_addresses_fingerprint = None
+
+    @staticmethod
+    def get_interfaces_fingerprint():
+        """
+        Return cheap fingerprint of network interfaces (names and ipv4 addresses)
+
+        Returns:
+            tuple: interfaces fingerprint or None if interfaces can't be read
+        """
+        import_dependencies()
+        try:
+            return tuple(
+                (
+                    iface,
+                    tuple(
+                        address.get("addr")
+                        for address in netifaces.ifaddresses(iface).get(
+                            netifaces.AF_INET, []
+                        )
+                    ),
+                )
+                for iface in sorted(netifaces.interfaces())
+            )
+        except Exception:
+            return None
+
+    def _find_mac_addresses(self):
         """
         Use pyre zhelper to get list of mac addresses used to identify cleep device
         Code copied from pyre-gevent/zbeacon
@@ -98,6 +386,7 @@ class PyreBus(ExternalBus):
         Returns:
             list: list of mac addresses
         """
+        import_dependencies()
         macs = []
         netinf = zhelper_get_ifaddrs()
         for iface in netinf:
@@ -106,15 +395,15 @@ class PyreBus(ExternalBus):
             for name, data in iface.items():
                 self.logger.debug('Checking out interface "%s": %s', name, data)
                 data_2 = data.get(netifaces.AF_INET, None)
-                self.logger.debug(' -> found data_2: %s', data_2)
+                self.logger.debug(" -> found data_2: %s", data_2)
                 data_10 = data.get(netifaces.AF_INET6, None)
-                self.logger.debug(' -> found data_10: %s', data_10)
+                self.logger.debug(" -> found data_10: %s", data_10)
                 data_17 = data.get(netifaces.AF_PACKET, None)
-                self.logger.debug(' -> found data_17: %s', data_17)
+                self.logger.debug(" -> found data_17: %s", data_17)
                 # workaround: fallback to netifaces module to find mac addr
                 if not data_17 and data_2:
                     data_17 = PyreBus.get_mac_addresses_from_netifaces(data_2)
-                    self.logger.debug(' -> found data_17 again: %s', data_17)
+                    self.logger.debug(" -> found data_17 again: %s", data_17)
 
                 if not data_2 and not data_10:
                     self.logger.debug('AF_INET(6) not found for interface "%s".', name)
@@ -169,12 +458,15 @@ class PyreBus(ExternalBus):
                 if not ip_address:
                     continue
                 # handle netaddr breaking changes
-                if netaddr.__version__.startswith('0.'):
+                if netaddr.__version__.startswith("0."):
                     # is_private does not exist anymore on new IpAddress lib version
                     # pylint: disable=no-member
                     ip_is_private = ip_address.is_private()
                 else:
-                    ip_is_private = ip_address.is_ipv4_private_use() or ip_address.is_ipv6_unique_local()
+                    ip_is_private = (
+                        ip_address.is_ipv4_private_use()
+                        or ip_address.is_ipv6_unique_local()
+                    )
                 if not ip_is_private:
                     self.logger.debug(
                         'Interface "%s" refers to public ip address, drop it.', name
@@ -205,6 +497,7 @@ class PyreBus(ExternalBus):
         if not adapter:
             return None
 
+        import_dependencies()
         addresses = netifaces.ifaddresses(adapter)
         mac_addr = addresses.get(netifaces.AF_LINK, None)
 
@@ -217,36 +510,53 @@ class PyreBus(ExternalBus):
     def stop(self):
         """
         Stop bus
+
+        Zmq context and communication pipe are kept to be reused at next start, only network
+        node is destroyed.
         """
-        # send stop message to unblock pyre task
-        if self.pipe_in is not None:
+        if self.node is None:
+            return
+
+        # send stop message to unblock bus loop running in another thread
+        if self.__loop_thread not in (None, threading.get_ident()):
             self.logger.debug("Send STOP on pipe")
             self.pipe_in.send(json.dumps(self.BUS_STOP).encode("utf-8"))
             time.sleep(0.15)
 
-            # and close everything
-            self.pipe_in.close()
-            self.pipe_in = None
-
-            self.pipe_out.close()
-            self.pipe_out = None
-
-            try:
-                self.node and self.node.stop()
-            except zmq.ZMQError:  # pragma: no cover
-                pass
-            except AssertionError as error:
-                # this assertion occurs when cleep-desktop is stopping when pyrebus is not connected
-                if str(error) != "Only one greenlet can be waiting on this event":
-                    self.logger.exception("Exception stopping pyre node")
-            except Exception:
+        # pyre-gevent node ignores context parameter and creates its own context
+        node_context = getattr(self.node, "_ctx", None)
+        try:
+            self.node.stop()
+        except zmq.ZMQError:  # pragma: no cover
+            pass
+        except AssertionError as error:
+            # this assertion occurs when cleep-desktop is stopping when pyrebus is not connected
+            if str(error) != "Only one greenlet can be waiting on this event":
                 self.logger.exception("Exception stopping pyre node")
-            time.sleep(0.15)
-            self.node = None
-            self.node_socket = None
-            self.poller = None
+        except Exception:
+            self.logger.exception("Exception stopping pyre node")
+        if node_context is not None and node_context is not self.context:
+            # release node context io thread and file descriptors
+            node_context.destroy(linger=0)
+        self.node = None
+        self.node_socket = None
+        self.poller = None
+        self.peers.clear()
+        self.__sent_sequences.clear()
+        self.__replay_buffers.clear()
+        # unacknowledged reliable messages are kept to be sent again after restart
+        self.__pending_acks.clear()
+        for stream in self.__incoming_streams.values():
+            stream.abort()
+        self.__incoming_streams.clear()
+        self.__inbound_queues.clear()
+        for stream in self.__outgoing_streams.values():
+            stream.aborted = True
+        for request in self.__requests.values():
+            request.complete()
+        self.__requests.clear()
 
-            self.__externalbus_configured = False
+        self.__externalbus_configured = False
 
     def start(self, infos, bus_name="CLEEP", bus_channel="CLEEP"):
         """
@@ -255,7 +565,7 @@ class PyreBus(ExternalBus):
         Args:
             infos (dict): peer infos
             bus_name (string): bus name to create. Default CLEEP
-            bus_channel (string): bus channel to join. Default CLEEP
+            bus_channel (string|list): bus channel(s) to join. First one is the default channel. Default CLEEP
 
         Returns:
             bool: True if successfully connected to pyrebus, False otherwise (connected to localhost)
@@ -265,18 +575,60 @@ class PyreBus(ExternalBus):
             raise Exception('Parameter "infos" is not specified or invalid')
         if not bus_name or not isinstance(bus_name, str):
             raise Exception('Parameter "bus_name" is not specified or invalid')
-        if not bus_channel or not isinstance(bus_channel, str):
+        bus_channels = [bus_channel] if isinstance(bus_channel, str) else bus_channel
+        if (
+            not bus_channels
+            or not isinstance(bus_channels, list)
+            or not all(channel and isinstance(channel, str) for channel in bus_channels)
+        ):
             raise Exception('Parameter "bus_channel" is not specified or invalid')
 
+        import_dependencies()
+
         # save members
         self.__bus_name = bus_name
-        self.__bus_channel = bus_channel
+        self.__bus_channel = bus_channels[0]
+        self.__bus_channels = list(bus_channels)
+        self.stats["channels"] = {
+            channel: {"received": 0, "sent": 0} for channel in self.__bus_channels
+        }
 
-        # zmq context
+        # zmq context and communication pipe are kept across restarts
         if self.context is None:
             self.context = zmq.Context()
+        if self.pipe_in is None:
+            self._create_pipe()
+        else:
+            self._drain_pipe()
+
+        # create node
+        self.node = self._create_node(self.__bus_name)
+        self.node.set_header(self.HEADER_FEATURES, ",".join(self.FEATURES))
+        for key, value in infos.items():
+            self.node.set_header(key, value)
+        for channel in self.__bus_channels:
+            self.node.join(channel)
+        self.node.start()
+
+        # communication socket
+        self.node_socket = self.node.socket()
+
+        # poller
+        self.poller = zmq.Poller()
+        self.poller.register(self.pipe_out, zmq.POLLIN)
+        self.poller.register(self.node_socket, zmq.POLLIN)
+
+        self.__externalbus_configured = True
+
+        # check endpoint
+        self.endpoint = self.node.endpoint()
+        self.logger.info('Connected to cleepbus endpoint "%s"', self.endpoint)
+        return self.endpoint.find("127.0.0.1") == -1
 
-        # communication pipe
+    def _create_pipe(self):
+        """
+        Create communication pipe between bus users (pipe_in) and bus loop (pipe_out)
+        """
         self.pipe_in = self.context.socket(zmq.PAIR)
         self.pipe_in.setsockopt(zmq.LINGER, 0)
         self.pipe_in.setsockopt(zmq.RCVHWM, 100)
@@ -295,27 +647,135 @@ class PyreBus(ExternalBus):
         self.pipe_in.bind(iface)
         self.pipe_out.connect(iface)
 
-        # create node
-        self.node = Pyre(self.__bus_name)
-        for key, value in infos.items():
-            self.node.set_header(key, value)
-        self.node.join(self.__bus_channel)
-        self.node.start()
+    def _drain_pipe(self):
+        """
+        Drop messages left in pipe while bus was stopped (stop request, messages to stopped bus)
 
-        # communication socket
-        self.node_socket = self.node.socket()
+        Returns:
+            int: number of dropped messages
+        """
+        dropped = 0
+        while self.pipe_out.poll(0, zmq.POLLIN):
+            self.pipe_out.recv_multipart()
+            dropped += 1
+        if dropped:
+            self.logger.debug("%d messages sent while bus was stopped dropped", dropped)
+        return dropped
+
+    def close(self):
+        """
+        Stop bus and release zmq context and communication pipe
+        """
+        self.stop()
+        if self.pipe_in is not None:
+            self.pipe_in.close()
+            self.pipe_out.close()
+            self.pipe_in = None
+            self.pipe_out = None
+        if self.context is not None:
+            self.context.term()
+            self.context = None
 
-        # poller
-        self.poller = zmq.Poller()
-        self.poller.register(self.pipe_out, zmq.POLLIN)
-        self.poller.register(self.node_socket, zmq.POLLIN)
+    def _create_node(self, bus_name):
+        """
+        Create bus node
 
-        self.__externalbus_configured = True
+        Args:
+            bus_name (string): bus name
 
-        # check endpoint
-        self.endpoint = self.node.endpoint()
-        self.logger.info('Connected to cleepbus endpoint "%s"', self.endpoint)
-        return self.endpoint.find("127.0.0.1") == -1
+        Returns:
+            Pyre: pyre node, or UnicastNode if static peers are configured
+        """
+        if self.static_peers:
+            # imported here because unicast node depends on this module
+            # pylint: disable=C0415
+            from .unicastnode import UnicastNode
+
+            return UnicastNode(
+                bus_name,
+                self.context,
+                self.static_peers,
+                port=self.static_port or UnicastNode.DEFAULT_PORT,
+                interval=self.beacon_interval or UnicastNode.INTERVAL,
+                expired=self.peer_expired or UnicastNode.EXPIRED,
+            )
+
+        node = Pyre(bus_name, ctx=self.context)
+        self._set_node_timers(node)
+        return node
+
+    def _set_node_timers(self, node):
+        """
+        Apply discovery timers to pyre node
+
+        pyre-gevent only has process wide timers (beacon default interval and peer timers): they
+        are changed for all nodes of the process and restored to their original value when
+        timers are unset
+
+        Args:
+            node (Pyre): pyre node
+        """
+        if self.beacon_interval and hasattr(node, "set_interval"):
+            node.set_interval(int(self.beacon_interval * 1000))
+        if hasattr(pyre_zbeacon, "INTERVAL_DFLT"):
+            # pyre-gevent node does not forward its interval to beacon, set beacon default instead
+            PyreBus._set_process_timer(
+                pyre_zbeacon, "INTERVAL_DFLT", self.beacon_interval
+            )
+        timers = (
+            (self.peer_evasive, "set_evasive_timeout", "PEER_EVASIVE"),
+            (self.peer_expired, "set_expired_timeout", "PEER_EXPIRED"),
+        )
+        for timeout, setter, attribute in timers:
+            if hasattr(node, setter):
+                if timeout:
+                    getattr(node, setter)(int(timeout * 1000))
+            elif hasattr(PyrePeer, attribute):
+                PyreBus._set_process_timer(PyrePeer, attribute, timeout)
+
+    @staticmethod
+    def _set_process_timer(owner, attribute, value):
+        """
+        Set process wide timer, keeping its original value to restore it
+
+        Args:
+            owner (object): module or class holding timer
+            attribute (string): timer attribute name
+            value (float): timer value. None to restore original value
+        """
+        key = (owner, attribute)
+        if value:
+            if key not in process_timers_defaults:
+                process_timers_defaults[key] = getattr(owner, attribute)
+            setattr(owner, attribute, value)
+        elif key in process_timers_defaults:
+            setattr(owner, attribute, process_timers_defaults.pop(key))
+
+    def set_static_peers(self, endpoints, port=None):
+        """
+        Discover peers from static list of endpoints instead of UDP beacons (for networks
+        filtering broadcast). Peers share endpoints they know, so only a few seeds are needed.
+        Applied at next bus start
+
+        Args:
+            endpoints (list): list of peers endpoints (tcp://host:port). Empty list to use beacons
+            port (int): listening port of this device. Default UnicastNode.DEFAULT_PORT
+        """
+        self.static_peers = list(endpoints or [])
+        self.static_port = port
+
+    def set_discovery_timers(self, interval=None, evasive=None, expired=None):
+        """
+        Set discovery timers. Applied at next bus start
+
+        Args:
+            interval (float): interval between two beacons, or pings with static peers (seconds). None for default
+            evasive (float): silence duration before peer is pinged (seconds). None for default
+            expired (float): silence duration before peer is disconnected (seconds). None for default
+        """
+        self.beacon_interval = interval or None
+        self.peer_evasive = evasive or None
+        self.peer_expired = expired or None
 
     def is_running(self):
         """
@@ -342,9 +802,13 @@ class PyreBus(ExternalBus):
             return False
 
         # poll external bus
+        self.__loop_thread = threading.get_ident()
+        self.profiler.begin()
         items = {}
         try:
+            start = self.profiler.start()
             items = dict(self.poller.poll(self.POLL_TIMEOUT))
+            self.profiler.record("poll", start)
         except KeyboardInterrupt:
             # stop requested by user
             self.logger.debug("Stop Pyre bus")
@@ -353,35 +817,90 @@ class PyreBus(ExternalBus):
         except Exception:
             self.logger.exception("Exception occured during externalbus polling:")
 
+        # measure peers link quality
+        if self.ping_interval and time.time() - self.__last_ping >= self.ping_interval:
+            self._ping_peers()
+        if self.__requests:
+            self._expire_requests(time.time())
+        if (
+            self.__reliable_senders
+            and time.time() - self.__last_retransmit >= self.RELIABLE_TIMEOUT / 4
+        ):
+            self._expire_reliable_senders(time.time())
+            self._retransmit_reliable(time.time())
+        if self.__incoming_streams:
+            self._expire_incoming_streams(time.time())
+
         # process received data
         if self.pipe_out in items and items[self.pipe_out] == zmq.POLLIN:
             return self._message_to_send_to_pipe()
         if self.node_socket in items and items[self.node_socket] == zmq.POLLIN:
-            return self._message_to_receive_from_pipe()
+            running = self._receive_from_bus()
+            if self.__pending_acks:
+                self._send_acks()
+            return running
 
         # timeout
         return True
 
-    def _message_to_receive_from_pipe(self):
+    def _receive_from_bus(self):
+        """
+        Read all pending bus messages (up to INBOUND_BURST) and dispatch them fairly between peers
+
+        Returns:
+            bool: True to continue, False to stop external bus
+        """
+        running = self._message_to_receive_from_pipe(dispatch=False)
+        received = 1
+        while (
+            running
+            and received < self.INBOUND_BURST
+            and self.node_socket.poll(0, zmq.POLLIN) == zmq.POLLIN
+        ):
+            running = self._message_to_receive_from_pipe(dispatch=False)
+            received += 1
+        self._dispatch_inbound_messages()
+
+        return running
+
+    def _message_to_receive_from_pipe(self, dispatch=True):
         """
         Receive message from external bus
 
+        Args:
+            dispatch (bool): dispatch received message immediately. Default True
+
         Returns:
             bool: True to continue, False to stop external bus
         """
+        start = self.profiler.start()
         data = self.node.recv()
+        self.profiler.record("recv", start)
         data_type = data.pop(0).decode("utf-8")
         data_peer = uuid.UUID(bytes=data.pop(0))
         data_name = data.pop(0).decode("utf-8")
-        self.logger.trace("type=%s peer=%s name=%s", data_type, data_peer, data_name)
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.trace(
+                "type=%s peer=%s name=%s", data_type, data_peer, data_name
+            )
 
         # check message origin
         if data_name != self.__bus_name:
-            self.logger.debug(
-                "Peer connected from another bus: peer=%s bus=%s", data_peer, data_name
-            )
+            if debug:
+                self.logger.debug(
+                    "Peer connected from another bus: peer=%s bus=%s",
+                    data_peer,
+                    data_name,
+                )
             return True
 
+        # update peer liveness
+        peer_id = str(data_peer)
+        bus_peer = self.peers.get(peer_id)
+        if bus_peer:
+            bus_peer.last_seen = time.time()
+
         if data_type in ("SHOUT", "WHISPER"):
             # message received, decode it and trigger callback
             if data_type == "SHOUT":
@@ -389,26 +908,54 @@ class PyreBus(ExternalBus):
                 data_group = data.pop(0).decode("utf-8")
 
                 # check message group
-                if data_group != self.__bus_channel:
+                if data_group not in self.__bus_channels:
                     # invalid group
-                    self.logger.debug(
-                        'Message received from another channel "%s" (current "%s")',
-                        data_group,
-                        self.__bus_channel,
-                    )
+                    if debug:
+                        self.logger.debug(
+                            'Message received from another channel "%s" (current %s)',
+                            data_group,
+                            self.__bus_channels,
+                        )
                     return True
-
-            # trigger message received callback
-            try:
-                data_content = data.pop(0).decode("utf-8")
-                self.logger.debug("Raw data received on bus: %s", data_content)
-                raw_message = json.loads(data_content)
-                message = MessageRequest()
-                message.fill_from_dict(raw_message)
-                self.logger.debug("Message request received: %s", str(message))
-                self.on_message_received(str(data_peer), message)
-            except Exception:
-                self.logger.exception("Error parsing peer message:")
+                self._count_channel_message(data_group, "received")
+
+            # drop unwanted events before decoding message content
+            meta = PyreBus.parse_message_meta(data[1]) if len(data) > 1 else None
+            if meta and meta.kind in self.STREAM_KINDS:
+                self._handle_stream_frame(peer_id, meta, data[0])
+                return True
+            if meta and meta.kind in self.PING_KINDS:
+                self._handle_ping_frame(peer_id, meta)
+                return True
+            if meta and meta.kind == self.KIND_RESPONSE:
+                self._handle_response(peer_id, meta, data[0])
+                return True
+            if meta and meta.kind == self.KIND_REPLAY:
+                self._handle_replay_request(peer_id, data[0])
+                return True
+            if meta and meta.kind == self.KIND_ACK:
+                self._handle_ack(bus_peer, meta)
+                return True
+            reliable = meta is not None and self.FLAG_RELIABLE in meta.flags
+            if reliable:
+                if not self._is_new_reliable(bus_peer, meta):
+                    return True
+            elif meta and meta.order and not self._check_sequence(bus_peer, meta):
+                # duplicate
+                return True
+            if meta and not self._accept_message_meta(meta):
+                self.stats["filtered"] += 1
+                if reliable:
+                    self._acknowledge_reliable(peer_id, meta)
+                return True
+
+            # rate limit peer and queue message until dispatch
+            queued = self._queue_inbound_message(peer_id, meta, data[0])
+            if queued and reliable:
+                # throttled reliable message is not acknowledged, it will be sent again
+                self._acknowledge_reliable(peer_id, meta)
+            if queued and dispatch:
+                self._dispatch_inbound_messages()
 
         elif data_type == "ENTER":
             # get message data
@@ -427,12 +974,36 @@ class PyreBus(ExternalBus):
                 peer_infos.ident = str(data_peer)
                 peer_infos.ip = peer_endpoint.hostname
                 # save peer and trigger callback
+                self.peers[peer_infos.ident] = self._make_bus_peer(
+                    peer_infos.ident, infos
+                )
                 self.on_peer_connected(str(data_peer), peer_infos)
+                # peer is back: send again reliable messages it did not acknowledge
+                self._retransmit_reliable(
+                    time.time(), self.peers[peer_infos.ident], timeout=0.0
+                )
             except Exception:
                 self.logger.exception("Error handling new peer connection")
 
+        elif data_type in ("JOIN", "LEAVE"):
+            # peer joined or left a channel
+            data_group = data.pop(0).decode("utf-8")
+            bus_peer = self.peers.get(str(data_peer))
+            if bus_peer and data_type == "JOIN":
+                bus_peer.groups.add(data_group)
+            elif bus_peer:
+                bus_peer.groups.discard(data_group)
+
         elif data_type == "EXIT":
             # peer disconnected
+            self.peers.pop(str(data_peer), None)
+            self.__sent_sequences.pop(("peer", str(data_peer)), None)
+            self.__replay_buffers.pop(("peer", str(data_peer)), None)
+            self.__inbound_queues.pop(str(data_peer), None)
+            self._abort_peer_streams(str(data_peer))
+            for request in list(self.__requests.values()):
+                if request.remove_peer(str(data_peer)):
+                    self.__requests.pop(request.request_id, None)
             try:
                 self.on_peer_disconnected(str(data_peer))
             except Exception:
@@ -440,118 +1011,1549 @@ class PyreBus(ExternalBus):
 
         return True
 
-    @staticmethod
-    def clean_message(message):
+    def _queue_inbound_message(self, peer_id, meta, content):
         """
-        Clean message removing useless field for external messaging
+        Queue message received from peer if peer does not exceed its rate limit
 
         Args:
-            message (MessageRequest): message request instance
+            peer_id (string): peer identifier
+            meta (MessageMeta): message meta. None if peer does not send meta
+            content (bytes): message content
 
         Returns:
-            dict: cleaned message request
+            bool: True if message is queued, False if it is throttled
         """
-        message_dict = message.to_dict()
-        message_dict.pop("startup", None)
-        message_dict.pop("broadcast", None)
-        message_dict.pop("peer_infos", None)
+        bus_peer = self.peers.get(peer_id)
+        queue = self.__inbound_queues.get(peer_id)
+        throttled = queue is not None and len(queue) >= self.INBOUND_QUEUE_SIZE
+        if not throttled and bus_peer and self.rate_limit:
+            if bus_peer.bucket is None:
+                bus_peer.bucket = TokenBucket(*self.rate_limit, time.time())
+            throttled = not bus_peer.bucket.consume(time.time())
+        if throttled:
+            self.stats["throttled"] += 1
+            if bus_peer:
+                bus_peer.throttled += 1
+                if not bus_peer.throttling:
+                    bus_peer.throttling = True
+                    self.logger.warning(
+                        "Peer %s exceeds its inbound rate limit, its messages are dropped",
+                        peer_id,
+                    )
+            self.logger.trace("Message from peer %s throttled", peer_id)
+            return False
 
-        return message_dict
+        if bus_peer:
+            bus_peer.throttling = False
+        if queue is None:
+            queue = self.__inbound_queues[peer_id] = deque()
+        queue.append((meta, content))
+        return True
 
-    def _message_to_send_to_pipe(self):
+    def _dispatch_inbound_messages(self):
         """
-        Send message to outside
+        Dispatch queued messages, one message per peer at a time (round robin)
+        """
+        while self.__inbound_queues:
+            for peer_id in list(self.__inbound_queues):
+                queue = self.__inbound_queues.get(peer_id)
+                if not queue:
+                    self.__inbound_queues.pop(peer_id, None)
+                    continue
+                meta, content = queue.popleft()
+                if not queue:
+                    del self.__inbound_queues[peer_id]
+                self._dispatch_message(peer_id, meta, content)
 
-        Returns:
-            bool: True to continue, False to stop external bus
+    def _dispatch_message(self, peer_id, meta, content):
+        """
+        Decode message and trigger message received callback
+
+        Args:
+            peer_id (string): peer identifier
+            meta (MessageMeta): message meta. None if peer does not send meta
+            content (bytes): message content
         """
-        # message to send
         try:
-            data = self.pipe_out.recv()
-            self.logger.trace("Raw data received on pipe: %s", data)
-            raw_message = json.loads(data.decode("utf-8"))
+            start = self.profiler.start()
+            if meta and self.FLAG_COMPRESSED in meta.flags:
+                content = self._decompress(content)
+            if self.message_log_every:
+                self._log_sampled_message(
+                    "received", peer_id, meta.name if meta else None, len(content)
+                )
+            content = content.decode("utf-8")
+            debug = self.logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                self.logger.debug("Raw data received on bus: %s", content)
+            raw_message = json.loads(content)
+            trace = raw_message.pop("trace", None)
+            message = MessageRequest()
+            message.fill_from_dict(raw_message)
+            self.profiler.record("decode", start)
+            if debug:
+                self.logger.debug("Message request received: %s", message)
+            start = self.profiler.start()
+            if trace and self.tracer.enabled:
+                response = self._traced_message_received(peer_id, message, trace)
+            else:
+                response = self.on_message_received(peer_id, message)
+            self.profiler.record("callback", start)
+            if meta and meta.kind == self.KIND_COMMAND and meta.seq:
+                self._send_response(peer_id, meta, response)
         except Exception:
-            self.logger.exception("Error handling message to send")
-            return True
-
-        # stop node
-        if raw_message == self.BUS_STOP:
-            self.logger.debug("Stop Pyre bus")
-            self.node.stop()
-            return False
+            self.logger.exception("Error parsing peer message:")
 
-        # send message
-        message = MessageRequest()
-        message.fill_from_dict(raw_message)
-        self.logger.debug("Send message: %s", message)
-        cleaned_message = PyreBus.clean_message(message)
-        if message.peer_infos and message.peer_infos.ident:
-            # whisper message (to peer)
-            self.logger.debug("Whisper message: %s", cleaned_message)
-            self.node.whisper(
-                uuid.UUID(message.peer_infos.ident),
-                json.dumps(cleaned_message).encode("utf-8"),
-            )
-        else:
-            # shout message (broadcast)
-            self.logger.debug("Shout message: %s", cleaned_message)
-            self.node.shout(
-                self.__bus_channel, json.dumps(cleaned_message).encode("utf-8")
-            )
+    def _traced_message_received(self, peer_id, message, trace):
+        """
+        Trigger message received callback recording receive and handler spans. Trace context is active
+        during callback so messages sent by handler belong to the same trace
 
-        return True
+        Args:
+            peer_id (string): peer identifier
+            message (MessageRequest): received message
+            trace (dict): trace context sent by peer (trace_id, span_id, sent)
 
-    def run(self):
+        Returns:
+            callback result (command response)
         """
-        Run pyre bus in infinite loop (blocking)
+        name = message.command or message.event
+        receive_context = self.tracer.new_context(trace)
+        self.tracer.record(
+            receive_context, "receive", name, trace.get("sent", time.time()), peer_id
+        )
+        handler_context = self.tracer.new_context(receive_context)
+        self.tracer.activate(handler_context)
+        start = time.time()
+        try:
+            return self.on_message_received(peer_id, message)
+        finally:
+            self.tracer.activate(None)
+            self.tracer.record(handler_context, "handler", name, start, peer_id)
+
+    def set_message_log_sampling(self, every):
         """
-        self.logger.debug("Pyre node started")
-        while True:
-            try:
-                if not self.__externalbus_configured:
-                    # bus not configured (no network yet?), pause
-                    time.sleep(0.25)
+        Log one message every N sent or received messages (INFO level), whatever logger level
 
-                elif not self.run_once():
-                    # stop requested
-                    self.logger.debug("Stop requested programmatically")
-                    break
+        Args:
+            every (int): log one message every specified number of messages. 0 to disable sampled log
+        """
+        self.message_log_every = every
 
-            except KeyboardInterrupt:  # pragma: no cover
-                # user stop
-                self.logger.debug("Stop requested manually (CTRL-C)")
-                break
+    def _log_sampled_message(self, direction, peer_id, name, size):
+        """
+        Log message if it is sampled
 
-            except Exception:
-                self.logger.exception("Exception during external bus process:")
+        Args:
+            direction (string): sent or received
+            peer_id (string): peer identifier. None for broadcast message
+            name (string|bytes): event or command name
+            size (int): message content size (bytes)
+        """
+        self.__message_log_count += 1
+        if self.__message_log_count % self.message_log_every:
+            return
 
-        self.logger.debug("Pyre node terminated")
+        self.logger.info(
+            "Sampled message %s (1/%d): peer=%s name=%s size=%d",
+            direction,
+            self.message_log_every,
+            peer_id or "broadcast",
+            name.decode("utf-8") if isinstance(name, bytes) else name,
+            size,
+        )
 
-    def _broadcast_message(self, message):
+    def set_rate_limit(self, rate, burst):
         """
-        Broadcast message
+        Limit number of messages accepted from each peer
 
         Args:
-            message (MessageRequest): message to send
+            rate (float): messages per second allowed per peer. None or 0 to disable rate limit
+            burst (int): max number of messages accepted at once
         """
-        # no difference between message to recipient or broadcast message due to pipe implementation,
-        # message difference is made in __message_to_send_to_pipe
-        self._send_message(message)
+        self.rate_limit = (rate, max(1, burst)) if rate else None
+        for bus_peer in self.peers.values():
+            bus_peer.bucket = None
 
-    def _send_message(self, message):
+    def get_peer_throttled(self, peer_ident):
         """
-        Send message to specified peer
+        Return number of messages dropped from peer because it exceeded its rate limit
 
         Args:
-            message (MessageRequest): message to send. Can be a command or an event
+            peer_ident (string): peer identifier
+
+        Returns:
+            int: number of throttled messages or None if peer is not connected
         """
-        # check bus
-        if not self.__externalbus_configured:
-            self.logger.warning(
-                "External bus is not configured yet, maybe no network connection, message not sent: %s",
-                message.to_dict(),
-            )
-            return
+        bus_peer = self.peers.get(peer_ident)
+        return bus_peer.throttled if bus_peer else None
 
-        # send message
-        self.pipe_in.send(json.dumps(message.to_dict()).encode("utf-8"))
+    def _make_bus_peer(self, ident, infos):
+        """
+        Build bus peer from peer headers
+
+        Args:
+            ident (string): peer identifier
+            infos (dict): peer headers
+
+        Returns:
+            PyreBusPeer: bus peer instance
+        """
+        subscriptions = None
+        if infos.get(self.HEADER_SUBSCRIPTIONS):
+            try:
+                subscriptions = EventMatcher(
+                    json.loads(infos[self.HEADER_SUBSCRIPTIONS])
+                )
+            except Exception:
+                self.logger.warning(
+                    'Invalid subscriptions for peer "%s", send it all events', ident
+                )
+
+        bus_peer = PyreBusPeer(ident, subscriptions)
+        bus_peer.features = set(
+            feature
+            for feature in infos.get(self.HEADER_FEATURES, "").split(",")
+            if feature
+        )
+        bus_peer.device_uuid = infos.get("uuid")
+
+        return bus_peer
+
+    def get_peer_last_seen(self, peer_ident):
+        """
+        Return last time a frame was received from specified peer
+
+        Args:
+            peer_ident (string): peer identifier
+
+        Returns:
+            float: timestamp or None if peer is not connected
+        """
+        bus_peer = self.peers.get(peer_ident)
+        return bus_peer.last_seen if bus_peer else None
+
+    def set_ping_interval(self, interval):
+        """
+        Set interval between two pings sent to peers to measure link quality
+
+        Args:
+            interval (float): ping interval (seconds). None or 0 to disable pings
+        """
+        self.ping_interval = interval or None
+
+    def _ping_peers(self):
+        """
+        Ping all peers that support ping. Must be called from bus thread
+        """
+        now = time.time()
+        self.__last_ping = now
+        self.__ping_seq += 1
+        meta = PyreBus.make_meta(self.KIND_PING, b"", seq=self.__ping_seq)
+        for bus_peer in self.peers.values():
+            if self.FEATURE_PING not in bus_peer.features:
+                continue
+            bus_peer.link.expire_pending(now, self.PING_TIMEOUT)
+            try:
+                self.node.whisper(uuid.UUID(bus_peer.ident), [b"", meta])
+                bus_peer.link.ping_sent(self.__ping_seq, now)
+            except Exception:
+                self.logger.exception('Unable to ping peer "%s"', bus_peer.ident)
+
+    def _handle_ping_frame(self, peer_id, meta):
+        """
+        Handle received ping (answer pong) or pong (update peer link stats)
+
+        Args:
+            peer_id (string): peer identifier
+            meta (MessageMeta): frame meta
+        """
+        if meta.kind == self.KIND_PING:
+            self.node.whisper(
+                uuid.UUID(peer_id),
+                [b"", PyreBus.make_meta(self.KIND_PONG, b"", seq=int(meta.seq or 0))],
+            )
+            return
+
+        bus_peer = self.peers.get(peer_id)
+        if bus_peer and meta.seq:
+            bus_peer.link.pong_received(int(meta.seq), time.time())
+
+    def send_command_to_all(self, message, timeout, quorum=None, on_response=None):
+        """
+        Send command once to all peers of message channel and collect their responses
+
+        Only peers supporting responses are expected to answer. Responses are collected by bus
+        thread: use on_response callback or iterate over returned request. Iterating from bus
+        thread processes bus while waiting for responses.
+
+        Args:
+            message (MessageRequest): command to send
+            timeout (float|function): response timeout (seconds) or function returning timeout of a peer identifier
+            quorum (int): complete request after this number of responses. Default None (all peers)
+            on_response (function): function called for each response: on_response(peer_id, response)
+
+        Returns:
+            BroadcastRequest: request
+        """
+        channel = self._get_message_channel(message)
+        peer_ids = [
+            peer.ident
+            for peer in list(self.peers.values())
+            if channel in peer.groups and self.FEATURE_RESPONSE in peer.features
+        ]
+        request = BroadcastRequest(
+            next(self.__request_ids),
+            BroadcastRequest.make_deadlines(peer_ids, timeout, time.time()),
+            quorum,
+            on_response,
+            self._wait_for,
+        )
+        if not peer_ids or quorum == 0:
+            request.complete()
+            return request
+
+        self.__requests[request.request_id] = request
+        self._send_message(message, request.request_id)
+        return request
+
+    def send_command_to_peer(self, message, timeout, on_response):
+        """
+        Send command to message peer and collect its response. Response is handled by bus
+        thread like broadcast requests responses
+
+        Args:
+            message (MessageRequest): command to send (peer_infos is the recipient)
+            timeout (float): response timeout (seconds)
+            on_response (function): function called with response: on_response(peer_id, response)
+
+        Returns:
+            BroadcastRequest: request, None if peer does not answer commands (command is not sent)
+        """
+        bus_peer = self.peers.get(message.peer_infos.ident)
+        if bus_peer is None or self.FEATURE_RESPONSE not in bus_peer.features:
+            return None
+
+        request = BroadcastRequest(
+            next(self.__request_ids),
+            BroadcastRequest.make_deadlines([bus_peer.ident], timeout, time.time()),
+            None,
+            on_response,
+            self._wait_for,
+        )
+        self.__requests[request.request_id] = request
+        self._send_message(message, request.request_id)
+        return request
+
+    def _send_response(self, peer_id, meta, response):
+        """
+        Send command response to peer that sent the command
+
+        Args:
+            peer_id (string): peer identifier
+            meta (MessageMeta): command meta
+            response (MessageResponse): command response
+        """
+        content = {
+            "error": getattr(response, "error", response is None),
+            "message": getattr(response, "message", ""),
+            "data": getattr(response, "data", None),
+        }
+        self.node.whisper(
+            uuid.UUID(peer_id),
+            [
+                json.dumps(content).encode("utf-8"),
+                PyreBus.make_meta(self.KIND_RESPONSE, meta.name, seq=int(meta.seq)),
+            ],
+        )
+
+    def _handle_response(self, peer_id, meta, content):
+        """
+        Handle command response of broadcast or peer request
+
+        Args:
+            peer_id (string): peer identifier
+            meta (MessageMeta): response meta
+            content (bytes): response content
+        """
+        request = self.__requests.get(int(meta.seq or 0))
+        if request is None:
+            return
+        try:
+            response = json.loads(content.decode("utf-8"))
+        except Exception:
+            self.logger.exception('Invalid response received from peer "%s"', peer_id)
+            return
+        if request.add_response(peer_id, response):
+            self.__requests.pop(request.request_id, None)
+
+    def _expire_requests(self, now):
+        """
+        Stop waiting for responses of peers whose deadline is over
+
+        Args:
+            now (float): current timestamp
+        """
+        for request in list(self.__requests.values()):
+            if request.expire(now) or request.completed:
+                self.__requests.pop(request.request_id, None)
+
+    def get_peer_link_stats(self, peer_ident):
+        """
+        Return link quality statistics of specified peer
+
+        Args:
+            peer_ident (string): peer identifier
+
+        Returns:
+            dict: link stats (see PeerLinkStats.to_dict) or None if peer is not connected
+        """
+        bus_peer = self.peers.get(peer_ident)
+        return bus_peer.link.to_dict() if bus_peer else None
+
+    def _get_event_recipients(self, event_name, channel):
+        """
+        Return channel peers that subscribed to specified event
+
+        Args:
+            event_name (string): event name
+            channel (string): channel the event is sent to
+
+        Returns:
+            list: list of interested peer identifiers, or None if all channel peers are interested (shout is enough)
+        """
+        members = [peer for peer in self.peers.values() if channel in peer.groups]
+        recipients = [peer.ident for peer in members if peer.is_interested(event_name)]
+        return None if len(recipients) == len(members) else recipients
+
+    def set_channel_routes(self, routes):
+        """
+        Set channel routes: events matching channel patterns are sent to this channel only.
+        Events matching no route are sent to default channel
+
+        Args:
+            routes (dict): event name patterns by channel::
+
+            {
+                channel (string): list of event name patterns
+                ...
+            }
+
+        """
+        self.channel_routes = [
+            (channel, EventMatcher(patterns)) for channel, patterns in routes.items()
+        ]
+
+    def _count_channel_message(self, channel, counter):
+        """
+        Increase channel message counter
+
+        Args:
+            channel (string): channel name
+            counter (string): counter name (received or sent)
+        """
+        if channel in self.stats["channels"]:
+            self.stats["channels"][channel][counter] += 1
+
+    def _get_message_channel(self, message):
+        """
+        Return channel to send broadcast message to
+
+        Args:
+            message (MessageRequest): message request instance
+
+        Returns:
+            string: channel name
+        """
+        if message.event:
+            for channel, matcher in self.channel_routes:
+                if channel in self.__bus_channels and matcher.match(message.event):
+                    return channel
+
+        return self.__bus_channel
+
+    def set_event_filter(self, patterns):
+        """
+        Set events accepted from other peers. Other events are dropped before being decoded
+
+        Args:
+            patterns (list): list of event name patterns. None to accept all events
+        """
+        self.event_filter = EventMatcher(patterns) if patterns is not None else None
+
+    def _accept_message_meta(self, meta):
+        """
+        Check message meta against event filter
+
+        Args:
+            meta (MessageMeta): message meta
+
+        Returns:
+            bool: True if message must be handled
+        """
+        if self.event_filter is None or meta.kind != self.KIND_EVENT:
+            return True
+
+        return self.event_filter.match(meta.name.decode("utf-8"))
+
+    @staticmethod
+    def parse_message_meta(frame):
+        """
+        Parse message meta frame
+
+        Args:
+            frame (bytes): meta frame
+
+        Returns:
+            MessageMeta: message meta
+        """
+        fields = PyreBus._frame_bytes(frame).split(PyreBus.META_SEPARATOR)
+        fields.extend([b""] * (len(MessageMeta._fields) - len(fields)))
+        return MessageMeta(*fields[: len(MessageMeta._fields)])
+
+    @staticmethod
+    def make_meta(kind, name, flags=b"", seq=None, order=b""):
+        """
+        Build meta frame
+
+        Args:
+            kind (bytes): message kind
+            name (bytes): message name (event, command, stream id...)
+            flags (bytes): message flags. Default no flag
+            seq (int): sequence number. Default None
+            order (bytes): sender sequence number of message. Default none
+
+        Returns:
+            bytes: meta frame
+        """
+        fields = [
+            kind,
+            name,
+            flags,
+            b"" if seq is None else str(seq).encode("utf-8"),
+            order,
+        ]
+        while not fields[-1]:
+            fields.pop()
+        return PyreBus.META_SEPARATOR.join(fields)
+
+    @staticmethod
+    def set_meta_order(meta, order):
+        """
+        Set order field of meta frame
+
+        Args:
+            meta (bytes): meta frame
+            order (bytes): sender sequence number of message
+
+        Returns:
+            bytes: meta frame with order
+        """
+        fields = PyreBus._frame_bytes(meta).split(PyreBus.META_SEPARATOR)[:4]
+        fields.extend([b""] * (4 - len(fields)))
+        fields.append(order)
+        return PyreBus.META_SEPARATOR.join(fields)
+
+    @staticmethod
+    def make_message_meta(message, flags=b"", seq=None):
+        """
+        Build message meta frame
+
+        Args:
+            message (MessageRequest): message request instance
+            flags (bytes): message flags. Default no flag
+            seq (int): broadcast request id of command waiting for responses. Default None
+
+        Returns:
+            bytes: meta frame
+        """
+        if message.is_command():
+            return PyreBus.make_meta(
+                PyreBus.KIND_COMMAND, message.command.encode("utf-8"), flags, seq
+            )
+        return PyreBus.make_meta(
+            PyreBus.KIND_EVENT, (message.event or "").encode("utf-8"), flags
+        )
+
+    @staticmethod
+    def _frame_bytes(frame):
+        """
+        Return frame content as bytes (frames received without copy are zmq.Frame)
+
+        Args:
+            frame (bytes|zmq.Frame): frame
+
+        Returns:
+            bytes: frame content
+        """
+        return frame if isinstance(frame, bytes) else frame.bytes
+
+    def _compress(self, content):
+        """
+        Compress message content
+
+        Args:
+            content (bytes): message content
+
+        Returns:
+            bytes: compressed content
+        """
+        start = time.thread_time()
+        compressed = zlib.compress(content, self.COMPRESSION_LEVEL)
+        stats = self.stats["compression"]
+        stats["compress_time"] += time.thread_time() - start
+        stats["compressed"] += 1
+        stats["compressed_bytes_in"] += len(content)
+        stats["compressed_bytes_out"] += len(compressed)
+
+        return compressed
+
+    def _decompress(self, content):
+        """
+        Decompress message content
+
+        Args:
+            content (bytes): compressed message content
+
+        Returns:
+            bytes: message content
+        """
+        start = time.thread_time()
+        decompressed = zlib.decompress(content)
+        stats = self.stats["compression"]
+        stats["decompress_time"] += time.thread_time() - start
+        stats["decompressed"] += 1
+
+        return decompressed
+
+    def _peers_support(self, idents, feature):
+        """
+        Check if all specified peers support feature
+
+        Args:
+            idents (list): list of peer identifiers
+            feature (string): feature name
+
+        Returns:
+            bool: True if all peers are known and support feature
+        """
+        return len(idents) > 0 and all(
+            ident in self.peers and feature in self.peers[ident].features
+            for ident in idents
+        )
+
+    def _make_frames(self, message, content, compress, seq=None):
+        """
+        Build message frames, compressing content if allowed and big enough
+
+        Args:
+            message (MessageRequest): message request instance
+            content (bytes): encoded message content
+            compress (bool): True if recipients support compression
+            seq (int): broadcast request id. Default None
+
+        Returns:
+            list: message frames (content and meta)
+        """
+        if compress and len(content) >= self.COMPRESSION_THRESHOLD:
+            compressed = self._compress(content)
+            if len(compressed) < len(content):
+                return [
+                    compressed,
+                    PyreBus.make_message_meta(message, self.FLAG_COMPRESSED, seq),
+                ]
+
+        return [content, PyreBus.make_message_meta(message, seq=seq)]
+
+    def _send_frames(self, peer_ident, frames):
+        """
+        Whisper raw frames to peer. Can be called from any thread, frames are sent without copy
+
+        Args:
+            peer_ident (string): peer identifier
+            frames (list): frames to send (content and meta)
+        """
+        self.pipe_in.send_multipart(
+            [self.PIPE_FRAMES, peer_ident.encode("utf-8")] + frames, copy=False
+        )
+
+    def _wait_for(self, predicate, timeout):
+        """
+        Wait until predicate is True. If called from bus thread, bus is processed while waiting
+
+        Args:
+            predicate (function): function returning True when wait is over
+            timeout (float): max time to wait (seconds)
+
+        Returns:
+            bool: False if timeout occured
+        """
+        end = time.time() + timeout
+        while not predicate():
+            if time.time() > end:
+                return False
+            if threading.get_ident() == self.__loop_thread:
+                self.run_once()
+            else:
+                time.sleep(0.01)
+
+        return True
+
+    def send_stream(self, peer_ident, chunks, infos=None, timeout=None):
+        """
+        Send stream of chunks to peer
+
+        Chunks are consumed lazily: no more than STREAM_WINDOW chunks are in flight, next chunk is
+        read only when peer acknowledges previous ones. This function blocks until stream is sent.
+
+        Args:
+            peer_ident (string): peer identifier
+            chunks (iterable): chunks to send (bytes or buffer). Should not exceed STREAM_CHUNK_SIZE
+            infos (dict): stream infos sent to peer (name, size...). Default None
+            timeout (float): max time to wait for peer acknowledgement (seconds). Default STREAM_TIMEOUT
+
+        Returns:
+            int: number of sent chunks
+
+        Raises:
+            BusStreamError: if stream failed (peer does not support stream, timeout, aborted by peer)
+        """
+        if not self.__externalbus_configured:
+            raise BusStreamError("External bus is not running")
+        if not self._peers_support([peer_ident], self.FEATURE_STREAM):
+            raise BusStreamError(f'Peer "{peer_ident}" does not support streams')
+
+        timeout = timeout or self.STREAM_TIMEOUT
+        stream = BusOutgoingStream(uuid.uuid4().hex, peer_ident, self.STREAM_WINDOW)
+        name = stream.stream_id.encode("utf-8")
+        self.__outgoing_streams[stream.stream_id] = stream
+        try:
+            self._send_frames(
+                peer_ident,
+                [
+                    json.dumps(infos or {}).encode("utf-8"),
+                    PyreBus.make_meta(self.KIND_STREAM_OPEN, name),
+                ],
+            )
+            for chunk in chunks:
+                if not self._wait_for(stream.can_send, timeout):
+                    raise BusStreamError(f'Stream "{stream.stream_id}" timed out')
+                if stream.aborted:
+                    raise BusStreamError(f'Stream "{stream.stream_id}" aborted')
+                stream.sent += 1
+                self._send_frames(
+                    peer_ident,
+                    [chunk, PyreBus.make_meta(self.KIND_STREAM, name, seq=stream.sent)],
+                )
+
+            stream.sent += 1
+            self._send_frames(
+                peer_ident,
+                [
+                    b"",
+                    PyreBus.make_meta(
+                        self.KIND_STREAM, name, self.FLAG_STREAM_END, stream.sent
+                    ),
+                ],
+            )
+            if not self._wait_for(stream.is_acked, timeout):
+                raise BusStreamError(f'Stream "{stream.stream_id}" timed out')
+            if stream.aborted:
+                raise BusStreamError(f'Stream "{stream.stream_id}" aborted')
+
+            return stream.sent - 1
+
+        except Exception:
+            if not stream.aborted and self.__externalbus_configured:
+                self._send_frames(
+                    peer_ident,
+                    [
+                        b"",
+                        PyreBus.make_meta(
+                            self.KIND_STREAM, name, self.FLAG_STREAM_ABORT
+                        ),
+                    ],
+                )
+            raise
+
+        finally:
+            self.__outgoing_streams.pop(stream.stream_id, None)
+
+    def _handle_stream_frame(self, peer_id, meta, content):
+        """
+        Handle received stream frame (open, chunk or ack)
+
+        Args:
+            peer_id (string): peer identifier
+            meta (MessageMeta): frame meta
+            content (bytes): frame content
+        """
+        stream_id = meta.name.decode("utf-8")
+        seq = int(meta.seq or 0)
+
+        if meta.kind == self.KIND_STREAM_ACK:
+            stream = self.__outgoing_streams.get(stream_id)
+            if stream and stream.peer_ident == peer_id:
+                if self.FLAG_STREAM_ABORT in meta.flags:
+                    stream.aborted = True
+                else:
+                    stream.ack(seq)
+            return
+
+        if meta.kind == self.KIND_STREAM_OPEN:
+            stream = BusStream(
+                stream_id,
+                peer_id,
+                json.loads(content.decode("utf-8")),
+                self.STREAM_WINDOW,
+                self.STREAM_TIMEOUT,
+                lambda ack_seq: self._send_frames(
+                    peer_id,
+                    [
+                        b"",
+                        PyreBus.make_meta(self.KIND_STREAM_ACK, meta.name, seq=ack_seq),
+                    ],
+                ),
+            )
+            try:
+                if self.on_stream_received is None:
+                    raise BusStreamError("Streams are not handled")
+                self.__incoming_streams[stream_id] = stream
+                self.on_stream_received(peer_id, stream)
+            except Exception:
+                self.logger.exception('Stream "%s" refused', stream_id)
+                self.__incoming_streams.pop(stream_id, None)
+                self._abort_incoming_stream(peer_id, meta.name)
+            return
+
+        stream = self.__incoming_streams.get(stream_id)
+        if not stream or stream.peer_id != peer_id:
+            return
+        if self.FLAG_STREAM_ABORT in meta.flags:
+            stream.abort()
+            self.__incoming_streams.pop(stream_id, None)
+        elif not stream.push(seq, content, self.FLAG_STREAM_END in meta.flags):
+            self.logger.warning(
+                'Invalid chunk %s for stream "%s", abort it', seq, stream_id
+            )
+            stream.abort()
+            self.__incoming_streams.pop(stream_id, None)
+            self._abort_incoming_stream(peer_id, meta.name)
+        elif self.FLAG_STREAM_END in meta.flags:
+            self.__incoming_streams.pop(stream_id, None)
+
+    def _abort_peer_streams(self, peer_id):
+        """
+        Abort incoming and outgoing streams of disconnected peer
+
+        Args:
+            peer_id (string): peer identifier
+        """
+        for stream_id, stream in list(self.__incoming_streams.items()):
+            if stream.peer_id == peer_id:
+                stream.abort()
+                del self.__incoming_streams[stream_id]
+        for stream in self.__outgoing_streams.values():
+            if stream.peer_ident == peer_id:
+                stream.aborted = True
+
+    def _expire_incoming_streams(self, now):
+        """
+        Drop incoming streams cancelled by their consumer or without activity for STREAM_TIMEOUT,
+        and notify their sender
+
+        Args:
+            now (float): current timestamp
+        """
+        for stream_id, stream in list(self.__incoming_streams.items()):
+            if not stream.is_expired(now):
+                continue
+            self.logger.debug('Incoming stream "%s" expired', stream_id)
+            stream.abort()
+            del self.__incoming_streams[stream_id]
+            self._abort_incoming_stream(stream.peer_id, stream_id.encode("utf-8"))
+
+    def _abort_incoming_stream(self, peer_id, name):
+        """
+        Notify stream sender its stream is aborted
+
+        Args:
+            peer_id (string): peer identifier
+            name (bytes): stream identifier
+        """
+        self._send_frames(
+            peer_id,
+            [
+                b"",
+                PyreBus.make_meta(self.KIND_STREAM_ACK, name, self.FLAG_STREAM_ABORT),
+            ],
+        )
+
+    def get_stats(self):
+        """
+        Return bus statistics
+
+        Returns:
+            dict: bus statistics::
+
+            {
+                filtered (int): number of received events dropped by event filter
+                throttled (int): number of received messages dropped by peers rate limit
+                compression (dict): compression statistics::
+                    {
+                        compressed (int): number of compressed messages
+                        compressed_bytes_in (int): size of messages before compression
+                        compressed_bytes_out (int): size of messages after compression
+                        ratio (float): compression ratio (compressed_bytes_out / compressed_bytes_in)
+                        compress_time (float): cpu time spent compressing messages (seconds)
+                        decompressed (int): number of decompressed messages
+                        decompress_time (float): cpu time spent decompressing messages (seconds)
+                    }
+                channels (dict): received and sent broadcast messages by channel::
+                    {
+                        channel (string): {
+                            received (int): number of received messages
+                            sent (int): number of sent messages
+                        },
+                        ...
+                    }
+            }
+
+        """
+        stats = dict(self.stats)
+        stats["channels"] = {
+            channel: dict(counters)
+            for channel, counters in self.stats["channels"].items()
+        }
+        compression = dict(self.stats["compression"])
+        compression["ratio"] = (
+            compression["compressed_bytes_out"] / compression["compressed_bytes_in"]
+            if compression["compressed_bytes_in"]
+            else 1.0
+        )
+        stats["compression"] = compression
+        stats["reliable"] = dict(
+            self.stats["reliable"],
+            pending=sum(
+                len(sender.pending) for sender in self.__reliable_senders.values()
+            ),
+        )
+        return stats
+
+    @staticmethod
+    def clean_message(message):
+        """
+        Clean message removing useless field for external messaging
+
+        Args:
+            message (MessageRequest): message request instance
+
+        Returns:
+            dict: cleaned message request
+        """
+        message_dict = message.to_dict()
+        message_dict.pop("startup", None)
+        message_dict.pop("broadcast", None)
+        message_dict.pop("peer_infos", None)
+
+        return message_dict
+
+    def _message_to_send_to_pipe(self):
+        """
+        Send message to outside
+
+        Returns:
+            bool: True to continue, False to stop external bus
+        """
+        # message to send
+        try:
+            data = self.pipe_out.recv_multipart(copy=False)
+            head = PyreBus._frame_bytes(data[0])
+            if head == self.PIPE_FRAMES:
+                # raw frames, forward them as is
+                peer_ident = PyreBus._frame_bytes(data[1]).decode("utf-8")
+                self.node.whisper(uuid.UUID(peer_ident), data[2:])
+                return True
+            if head == self.PIPE_EVENT:
+                # event already encoded
+                message = MessageRequest()
+                message.event = PyreBus._frame_bytes(data[1]).decode("utf-8")
+                self._send_content(message, PyreBus._frame_bytes(data[2]))
+                return True
+            debug = self.logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                self.logger.trace("Raw data received on pipe: %s", head)
+            raw_message = json.loads(head.decode("utf-8"))
+        except Exception:
+            self.logger.exception("Error handling message to send")
+            return True
+
+        # stop node
+        if raw_message == self.BUS_STOP:
+            self.logger.debug("Stop Pyre bus")
+            self.node.stop()
+            return False
+
+        # send message
+        start = self.profiler.start()
+        trace = raw_message.pop("trace", None)
+        request_id = raw_message.pop("request_id", None)
+        message = MessageRequest()
+        message.fill_from_dict(raw_message)
+        if debug:
+            self.logger.debug("Send message: %s", message)
+        cleaned_message = PyreBus.clean_message(message)
+        if trace:
+            trace["sent"] = time.time()
+            cleaned_message["trace"] = trace
+        content = json.dumps(cleaned_message).encode("utf-8")
+        self.profiler.record("encode", start)
+        self._send_content(message, content, request_id, trace)
+
+        return True
+
+    def _sequence_frames(self, frames, ident=None, channel=None):
+        """
+        Number message frames in their stream and keep them for replay if enabled
+
+        Args:
+            frames (list): message frames (content and meta)
+            ident (string): recipient peer identifier for direct message. Default None
+            channel (string): channel of broadcast message. Default None
+
+        Returns:
+            list: new message frames with numbered meta
+        """
+        key = ("peer", ident) if ident is not None else ("channel", channel)
+        seq = self.__sent_sequences.get(key, 0) + 1
+        self.__sent_sequences[key] = seq
+        order = str(seq) if ident is not None else f"{seq}@{channel}"
+        frames = [frames[0], PyreBus.set_meta_order(frames[1], order.encode("utf-8"))]
+        if self.replay_window:
+            buffer = self.__replay_buffers.get(key)
+            if buffer is None:
+                buffer = self.__replay_buffers[key] = deque(maxlen=self.replay_window)
+            buffer.append((seq, frames))
+        return frames
+
+    def _check_sequence(self, bus_peer, meta):
+        """
+        Check sequence number of message received from peer and request replay of missing messages
+
+        Args:
+            bus_peer (PyreBusPeer): peer the message comes from. None if peer is unknown
+            meta (MessageMeta): message meta
+
+        Returns:
+            bool: True if message must be processed, False if it is a duplicate
+        """
+        if bus_peer is None:
+            return True
+        try:
+            seq, _, stream = meta.order.decode("utf-8").partition("@")
+            accepted, missing = bus_peer.sequence.check(
+                stream, int(seq), self.FLAG_REPLAYED in meta.flags
+            )
+        except Exception:
+            self.logger.warning(
+                'Invalid message order "%s" from peer "%s"', meta.order, bus_peer.ident
+            )
+            return True
+
+        if missing and self.replay_window and self.FEATURE_REPLAY in bus_peer.features:
+            self.node.whisper(
+                uuid.UUID(bus_peer.ident),
+                [
+                    json.dumps(
+                        {"stream": stream, "seqs": missing[-self.replay_window :]}
+                    ).encode("utf-8"),
+                    PyreBus.make_meta(self.KIND_REPLAY, b""),
+                ],
+            )
+        return accepted
+
+    def _handle_replay_request(self, peer_id, content):
+        """
+        Send again to peer the requested messages still in replay buffer
+
+        Args:
+            peer_id (string): peer identifier
+            content (bytes): replay request content
+        """
+        try:
+            request = json.loads(PyreBus._frame_bytes(content).decode("utf-8"))
+            key = (
+                ("channel", request["stream"])
+                if request["stream"]
+                else ("peer", peer_id)
+            )
+            seqs = set(request["seqs"])
+        except Exception:
+            self.logger.warning('Invalid replay request from peer "%s"', peer_id)
+            return
+
+        for seq, frames in self.__replay_buffers.get(key, ()):
+            if seq in seqs:
+                meta = PyreBus.parse_message_meta(frames[1])
+                self.node.whisper(
+                    uuid.UUID(peer_id),
+                    [
+                        frames[0],
+                        PyreBus.make_meta(
+                            meta.kind,
+                            meta.name,
+                            meta.flags + self.FLAG_REPLAYED,
+                            int(meta.seq) if meta.seq else None,
+                            meta.order,
+                        ),
+                    ],
+                )
+
+    def set_reliable_events(self, patterns):
+        """
+        Set events sent with at-least-once delivery: they are sent to each subscribed peer,
+        acknowledged by peers and sent again until acknowledged (or given up when too many
+        messages are pending). Other events are not slowed down
+
+        Args:
+            patterns (list): list of event name patterns. Empty list or None to disable
+        """
+        self.reliable_events = EventMatcher(patterns) if patterns else None
+        if self.reliable_events is None:
+            self.__reliable_senders.clear()
+
+    @staticmethod
+    def _make_reliable_frames(name, content, flags, seq, base, epoch):
+        """
+        Build reliable event frames. Order field is <base>@<epoch>
+
+        Args:
+            name (bytes): event name
+            content (bytes): message content (compressed or not)
+            flags (bytes): message flags
+            seq (int): reliable message number
+            base (int): oldest message number kept by sender
+            epoch (string): sender epoch
+
+        Returns:
+            list: message frames
+        """
+        return [
+            content,
+            PyreBus.make_meta(
+                PyreBus.KIND_EVENT,
+                name,
+                flags + PyreBus.FLAG_RELIABLE,
+                seq,
+                f"{base}@{epoch}".encode("utf-8"),
+            ),
+        ]
+
+    @staticmethod
+    def _parse_reliable_order(order):
+        """
+        Parse order field of reliable message
+
+        Args:
+            order (bytes): order field (<base>@<epoch>, <base> for senders without epoch)
+
+        Returns:
+            tuple: oldest message number kept by sender (int) and sender epoch (string)
+
+        Raises:
+            ValueError: if order is invalid
+        """
+        base, _, epoch = order.decode("utf-8").partition("@")
+        return int(base or 1), epoch
+
+    @staticmethod
+    def _reliable_key(bus_peer):
+        """
+        Return key of reliable receiver state of peer: device uuid is kept across peer restarts
+        while pyre identifier changes
+
+        Args:
+            bus_peer (PyreBusPeer): peer
+
+        Returns:
+            string: peer device uuid, pyre identifier if unknown
+        """
+        return bus_peer.device_uuid or bus_peer.ident
+
+    def _send_reliable(self, message, content, channel):
+        """
+        Send reliable event to each subscribed peer of channel. Peers not supporting reliable
+        delivery get a regular message
+
+        Args:
+            message (MessageRequest): message request instance
+            content (bytes): encoded message
+            channel (string): channel the event is sent to
+        """
+        now = time.time()
+        frames_by_compression = {}
+        for peer in list(self.peers.values()):
+            if channel not in peer.groups or not peer.is_interested(message.event):
+                continue
+            compress = self.FEATURE_ZLIB in peer.features
+            if compress not in frames_by_compression:
+                frames_by_compression[compress] = self._make_frames(
+                    message, content, compress
+                )
+            frames = frames_by_compression[compress]
+            if self.FEATURE_RELIABLE not in peer.features or not peer.device_uuid:
+                self.node.whisper(
+                    uuid.UUID(peer.ident), self._sequence_frames(frames, peer.ident)
+                )
+                continue
+
+            sender = self.__reliable_senders.get(peer.device_uuid)
+            if sender is None:
+                sender = self.__reliable_senders[peer.device_uuid] = ReliableSender(
+                    self.RELIABLE_WINDOW
+                )
+            meta = PyreBus.parse_message_meta(frames[1])
+            dropped = sender.dropped
+            seq = sender.add(meta.name, frames[0], meta.flags, now)
+            self.stats["reliable"]["sent"] += 1
+            self.stats["reliable"]["dropped"] += sender.dropped - dropped
+            self.node.whisper(
+                uuid.UUID(peer.ident),
+                PyreBus._make_reliable_frames(
+                    meta.name, frames[0], meta.flags, seq, sender.base, sender.epoch
+                ),
+            )
+
+    def _retransmit_reliable(self, now, bus_peer=None, timeout=None):
+        """
+        Send again reliable messages not acknowledged in time
+
+        Args:
+            now (float): current timestamp
+            bus_peer (PyreBusPeer): only send messages of this peer. Default None (all peers)
+            timeout (float): acknowledgement timeout. Default RELIABLE_TIMEOUT
+        """
+        self.__last_retransmit = now
+        timeout = self.RELIABLE_TIMEOUT if timeout is None else timeout
+        for peer in [bus_peer] if bus_peer else list(self.peers.values()):
+            sender = self.__reliable_senders.get(peer.device_uuid)
+            if not sender or not sender.pending:
+                continue
+            for seq, name, content, flags in sender.due(now, timeout):
+                self.stats["reliable"]["retransmitted"] += 1
+                self.node.whisper(
+                    uuid.UUID(peer.ident),
+                    PyreBus._make_reliable_frames(
+                        name, content, flags, seq, sender.base, sender.epoch
+                    ),
+                )
+
+    def _expire_reliable_senders(self, now):
+        """
+        Give up messages of peer devices gone for more than RELIABLE_GIVE_UP seconds
+
+        Args:
+            now (float): current timestamp
+        """
+        connected = {peer.device_uuid for peer in self.peers.values()}
+        for device_uuid, sender in list(self.__reliable_senders.items()):
+            if device_uuid in connected:
+                sender.gone_since = None
+            elif sender.gone_since is None:
+                sender.gone_since = now
+            elif now - sender.gone_since >= self.RELIABLE_GIVE_UP:
+                self.stats["reliable"]["dropped"] += len(sender.pending)
+                del self.__reliable_senders[device_uuid]
+
+    def _is_new_reliable(self, bus_peer, meta):
+        """
+        Check received reliable message is not a duplicate. Duplicates are acknowledged again
+        (previous acknowledgement may be lost)
+
+        Args:
+            bus_peer (PyreBusPeer): peer the message comes from. None if peer is unknown
+            meta (MessageMeta): message meta
+
+        Returns:
+            bool: True if message must be processed
+        """
+        if bus_peer is None:
+            # unknown peer, not acknowledged so it is sent again once peer is known
+            return False
+        try:
+            seq = int(meta.seq)
+            base, epoch = PyreBus._parse_reliable_order(meta.order)
+        except ValueError:
+            self.logger.warning(
+                'Invalid reliable message from peer "%s"', bus_peer.ident
+            )
+            return False
+
+        receiver = self.__reliable_receivers.get(PyreBus._reliable_key(bus_peer), epoch)
+        if receiver.is_duplicate(seq, base):
+            self.stats["reliable"]["duplicated"] += 1
+            self.__pending_acks.add(bus_peer.ident)
+            return False
+        return True
+
+    def _acknowledge_reliable(self, peer_id, meta):
+        """
+        Register processed reliable message, acknowledgement is sent after received messages
+        are processed
+
+        Args:
+            peer_id (string): peer identifier
+            meta (MessageMeta): message meta
+        """
+        bus_peer = self.peers.get(peer_id)
+        if bus_peer is None:
+            return
+        base, epoch = PyreBus._parse_reliable_order(meta.order)
+        self.__reliable_receivers.get(PyreBus._reliable_key(bus_peer), epoch).receive(
+            int(meta.seq), base
+        )
+        self.__pending_acks.add(peer_id)
+
+    def _send_acks(self):
+        """
+        Send cumulative acknowledgement to peers that sent reliable messages
+        """
+        for peer_id in self.__pending_acks:
+            bus_peer = self.peers.get(peer_id)
+            if bus_peer:
+                receiver = self.__reliable_receivers.get(
+                    PyreBus._reliable_key(bus_peer)
+                )
+                self.node.whisper(
+                    uuid.UUID(peer_id),
+                    [
+                        b"",
+                        PyreBus.make_meta(
+                            self.KIND_ACK,
+                            b"",
+                            seq=receiver.acked,
+                        ),
+                    ],
+                )
+        self.__pending_acks.clear()
+
+    def _handle_ack(self, bus_peer, meta):
+        """
+        Remove reliable messages acknowledged by peer
+
+        Args:
+            bus_peer (PyreBusPeer): peer the acknowledgement comes from. None if peer is unknown
+            meta (MessageMeta): acknowledgement meta
+        """
+        sender = self.__reliable_senders.get(bus_peer.device_uuid) if bus_peer else None
+        if sender and meta.seq:
+            self.stats["reliable"]["acked"] += sender.ack(int(meta.seq))
+
+    def set_replay_window(self, window):
+        """
+        Set number of sent messages kept by stream to send them again when peers detect gaps.
+        Peers only request replays when their replay window is enabled too
+
+        Args:
+            window (int): number of kept messages by stream. 0 to disable replay
+        """
+        self.replay_window = window
+        self.__replay_buffers.clear()
+
+    def get_peer_sequence_stats(self, peer_ident):
+        """
+        Return sequence statistics of messages received from peer
+
+        Args:
+            peer_ident (string): peer identifier
+
+        Returns:
+            dict: sequence stats (see PeerSequence.to_dict) or None if peer is not connected
+        """
+        bus_peer = self.peers.get(peer_ident)
+        return bus_peer.sequence.to_dict() if bus_peer else None
+
+    def _send_content(self, message, content, request_id=None, trace=None):
+        """
+        Send encoded message to its recipients
+
+        Args:
+            message (MessageRequest): message request instance (used for routing)
+            content (bytes): encoded message
+            request_id (int): broadcast or peer request id. Default None
+            trace (dict): trace context. Default None
+        """
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if self.message_log_every:
+            self._log_sampled_message(
+                "sent",
+                message.peer_infos.ident if message.peer_infos else None,
+                message.command or message.event,
+                len(content),
+            )
+        start = self.profiler.start()
+        if message.peer_infos and message.peer_infos.ident:
+            # whisper message (to peer)
+            if debug:
+                self.logger.debug("Whisper message: %s", content)
+            ident = message.peer_infos.ident
+            frames = self._make_frames(
+                message,
+                content,
+                self._peers_support([ident], self.FEATURE_ZLIB),
+                request_id,
+            )
+            self.node.whisper(uuid.UUID(ident), self._sequence_frames(frames, ident))
+        else:
+            channel = self._get_message_channel(message)
+            self._count_channel_message(channel, "sent")
+            reliable = (
+                self.reliable_events is not None
+                and message.event
+                and self.reliable_events.match(message.event)
+            )
+            recipients = (
+                self._get_event_recipients(message.event, channel)
+                if message.event and not reliable
+                else None
+            )
+            if reliable:
+                # send event to each peer and wait for acknowledgement
+                self._send_reliable(message, content, channel)
+            elif recipients is None:
+                # shout message (broadcast), compress only if all channel peers support it
+                if debug:
+                    self.logger.debug("Shout message on %s: %s", channel, content)
+                members = [
+                    peer.ident for peer in self.peers.values() if channel in peer.groups
+                ]
+                frames = self._make_frames(
+                    message,
+                    content,
+                    self._peers_support(members, self.FEATURE_ZLIB),
+                    request_id,
+                )
+                self.node.shout(channel, self._sequence_frames(frames, channel=channel))
+            else:
+                # whisper event only to peers that subscribed to it
+                if debug:
+                    self.logger.debug(
+                        "Whisper event to %d subscribed peers: %s",
+                        len(recipients),
+                        content,
+                    )
+                frames_by_compression = {}
+                for ident in recipients:
+                    compress = self._peers_support([ident], self.FEATURE_ZLIB)
+                    if compress not in frames_by_compression:
+                        frames_by_compression[compress] = self._make_frames(
+                            message, content, compress
+                        )
+                    self.node.whisper(
+                        uuid.UUID(ident),
+                        self._sequence_frames(frames_by_compression[compress], ident),
+                    )
+        self.profiler.record("send", start)
+        if trace:
+            self.tracer.record(
+                trace,
+                "send",
+                message.command or message.event,
+                trace["sent"],
+                ident if message.peer_infos and message.peer_infos.ident else channel,
+            )
+
+    def run(self):
+        """
+        Run pyre bus in infinite loop (blocking)
+        """
+        self.logger.debug("Pyre node started")
+        while True:
+            try:
+                if not self.__externalbus_configured:
+                    # bus not configured (no network yet?), pause
+                    time.sleep(0.25)
+
+                elif not self.run_once():
+                    # stop requested
+                    self.logger.debug("Stop requested programmatically")
+                    break
+
+            except KeyboardInterrupt:  # pragma: no cover
+                # user stop
+                self.logger.debug("Stop requested manually (CTRL-C)")
+                break
+
+            except Exception:
+                self.logger.exception("Exception during external bus process:")
+
+        self.logger.debug("Pyre node terminated")
+
+    def _broadcast_message(self, message):
+        """
+        Broadcast message
+
+        Args:
+            message (MessageRequest): message to send
+        """
+        # no difference between message to recipient or broadcast message due to pipe implementation,
+        # message difference is made in __message_to_send_to_pipe
+        self._send_message(message)
+
+    def _send_message(self, message, request_id=None):
+        """
+        Send message to specified peer
+
+        Args:
+            message (MessageRequest): message to send. Can be a command or an event
+            request_id (int): broadcast request id if command responses are expected. Default None
+        """
+        # check bus
+        if not self.__externalbus_configured:
+            self.logger.warning(
+                "External bus is not configured yet, maybe no network connection, message not sent: %s",
+                message.to_dict(),
+            )
+            return
+
+        # send message
+        message_dict = message.to_dict()
+        if self.tracer.enabled:
+            message_dict["trace"] = self.tracer.new_context()
+        if request_id is not None:
+            message_dict["request_id"] = request_id
+        self.pipe_in.send(json.dumps(message_dict).encode("utf-8"))
+
+    def send_event(self, event, params=None, sender=None):
+        """
+        Broadcast event to peers. Event is encoded from a cached template so only params are
+        encoded, and it is not decoded again by bus thread
+
+        Args:
+            event (string): event name
+            params (dict): event parameters. Default None
+            sender (string): event sender. Default None
+        """
+        if self.tracer.enabled:
+            # trace context is added to message content
+            message = MessageRequest()
+            message.event = event
+            message.params = params
+            message.sender = sender
+            self._send_message(message)
+            return
+
+        if not self.__externalbus_configured:
+            self.logger.warning(
+                'External bus is not configured yet, maybe no network connection, event "%s" not sent',
+                event,
+            )
+            return
+
+        self.pipe_in.send_multipart(
+            [
+                self.PIPE_EVENT,
+                event.encode("utf-8"),
+                self.templates.encode(event, params, sender),
+            ]
+        )
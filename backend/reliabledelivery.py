@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+from collections import OrderedDict
+
+
+class ReliableSender:
+    """
+    Reliable messages sent to a peer device and not acknowledged yet
+
+    Messages are numbered from 1 and kept in a bounded buffer: when buffer is full, oldest message
+    is dropped (given up). Receiver acknowledges cumulatively the highest number it received
+    without gap. Each message carries the oldest number still kept (base) so receiver does not
+    wait for given up messages, and sender epoch (random identifier of this numbering) so
+    receiver resets its state when a new sender starts numbering again from 1.
+    """
+
+    def __init__(self, window):
+        """
+        Constructor
+
+        Args:
+            window (int): max number of unacknowledged messages
+        """
+        self.window = window
+        self.epoch = os.urandom(4).hex()
+        # timestamp peer device left the bus, None if it is connected
+        self.gone_since = None
+        self.next_seq = 1
+        # pending message by number: [name, content, flags, last sent timestamp]
+        self.pending = OrderedDict()
+        self.dropped = 0
+        self.retransmitted = 0
+
+    @property
+    def base(self):
+        """
+        Return oldest message number still kept
+
+        Returns:
+            int: oldest pending number, next number if nothing is pending
+        """
+        return next(iter(self.pending), self.next_seq)
+
+    def add(self, name, content, flags, now):
+        """
+        Add message to send
+
+        Args:
+            name (bytes): message name
+            content (bytes): message content
+            flags (bytes): message flags
+            now (float): current timestamp
+
+        Returns:
+            int: message number
+        """
+        seq = self.next_seq
+        self.next_seq += 1
+        self.pending[seq] = [name, content, flags, now]
+        while len(self.pending) > self.window:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+        return seq
+
+    def ack(self, seq):
+        """
+        Remove messages acknowledged by peer
+
+        Args:
+            seq (int): highest number received by peer without gap
+
+        Returns:
+            int: number of acknowledged messages
+        """
+        acked = 0
+        while self.pending and next(iter(self.pending)) <= seq:
+            self.pending.popitem(last=False)
+            acked += 1
+        return acked
+
+    def due(self, now, timeout):
+        """
+        Return messages not acknowledged in time, and mark them as sent again
+
+        Args:
+            now (float): current timestamp
+            timeout (float): acknowledgement timeout (seconds). 0 to return all pending messages
+
+        Returns:
+            list: list of (number, name, content, flags)
+        """
+        due = []
+        for seq, message in self.pending.items():
+            if now - message[3] >= timeout:
+                message[3] = now
+                due.append((seq, message[0], message[1], message[2]))
+        self.retransmitted += len(due)
+        return due
+
+
+class ReliableReceiver:
+    """
+    Reliable messages received from a peer, to drop duplicates and compute cumulative acknowledgement
+    """
+
+    # max numbers received after a gap remembered (bounded by sender window in practice)
+    MAX_AHEAD = 1024
+
+    def __init__(self, epoch=""):
+        """
+        Constructor
+
+        Args:
+            epoch (string): sender epoch. Default "" (sender without epoch)
+        """
+        self.epoch = epoch
+        # highest number received without gap
+        self.acked = 0
+        # numbers received after a gap
+        self.ahead = set()
+        self.duplicated = 0
+
+    def is_duplicate(self, seq, base):
+        """
+        Check if message was already received
+
+        Args:
+            seq (int): message number
+            base (int): oldest message number still kept by sender
+
+        Returns:
+            bool: True if message is a duplicate
+        """
+        self.__skip(base)
+        if seq <= self.acked or seq in self.ahead:
+            self.duplicated += 1
+            return True
+        return False
+
+    def receive(self, seq, base):
+        """
+        Register received message
+
+        Args:
+            seq (int): message number
+            base (int): oldest message number still kept by sender
+
+        Returns:
+            bool: True if message is new, False if it is a duplicate
+        """
+        self.__skip(base)
+        if seq <= self.acked or seq in self.ahead:
+            return False
+
+        self.ahead.add(seq)
+        self.__advance()
+        if len(self.ahead) > self.MAX_AHEAD:
+            self.acked = min(self.ahead)
+            self.ahead.discard(self.acked)
+            self.__advance()
+        return True
+
+    def __skip(self, base):
+        """
+        Do not wait anymore for messages given up by sender
+
+        Args:
+            base (int): oldest message number still kept by sender
+        """
+        if base - 1 > self.acked:
+            self.acked = base - 1
+            self.ahead = {ahead for ahead in self.ahead if ahead > self.acked}
+            self.__advance()
+
+    def __advance(self):
+        """
+        Move acknowledged number over contiguous received numbers
+        """
+        while self.acked + 1 in self.ahead:
+            self.acked += 1
+            self.ahead.discard(self.acked)
+
+
+class ReliableReceivers:
+    """
+    Receivers state by peer device, kept when peer leaves to still drop duplicates when it
+    comes back. State is reset when sender epoch changes (sender restarted its numbering).
+    Least recently used states are forgotten
+    """
+
+    MAX_PEERS = 512
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.__receivers = OrderedDict()
+
+    def __len__(self):
+        """
+        Return number of known peers
+
+        Returns:
+            int: number of peers
+        """
+        return len(self.__receivers)
+
+    def get(self, peer_key, epoch=None):
+        """
+        Return receiver of peer, created if needed
+
+        Args:
+            peer_key (string): peer device identifier
+            epoch (string): sender epoch of received message. Default None (current receiver)
+
+        Returns:
+            ReliableReceiver: peer receiver
+        """
+        receiver = self.__receivers.get(peer_key)
+        if receiver is None or (epoch is not None and receiver.epoch != epoch):
+            if (
+                peer_key not in self.__receivers
+                and len(self.__receivers) >= self.MAX_PEERS
+            ):
+                self.__receivers.popitem(last=False)
+            receiver = self.__receivers[peer_key] = ReliableReceiver(epoch or "")
+        self.__receivers.move_to_end(peer_key)
+        return receiver
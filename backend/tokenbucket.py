@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: tokens are refilled at constant rate up to burst size,
+    each allowed message consumes one token
+    """
+
+    def __init__(self, rate, burst, now):
+        """
+        Constructor
+
+        Args:
+            rate (float): refill rate (tokens per second)
+            burst (int): bucket size (max tokens)
+            now (float): current timestamp
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def consume(self, now):
+        """
+        Consume one token
+
+        Args:
+            now (float): current timestamp
+
+        Returns:
+            bool: True if token was available, False if rate is exceeded
+        """
+        if now > self.updated:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+        if self.tokens < 1.0:
+            return False
+
+        self.tokens -= 1.0
+        return True
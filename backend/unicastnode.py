@@ -0,0 +1,537 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from urllib.parse import urlparse
+
+# pylint: disable=E0402
+from . import pyrebus
+from .pyrebus import import_dependencies
+
+
+class UnicastNode:
+    """
+    Node discovering peers from a static list of endpoints instead of UDP beacons
+
+    It implements the part of Pyre node API used by PyreBus, for networks where UDP broadcast
+    is filtered. Node sends HELLO to configured seed endpoints, peers answer with their own HELLO
+    and share endpoints of peers they know (gossip), so configuring a few seeds is enough to
+    discover all peers. Peers are pinged every interval and expired when silent for too long.
+
+    Like Pyre, each node receives messages on a ROUTER socket and sends messages to each peer
+    through a DEALER socket. Sockets are handled by node thread, events are queued in an inproc
+    PAIR socket polled by bus.
+    """
+
+    DEFAULT_PORT = 5680
+    # peers ping interval (seconds)
+    INTERVAL = 1.0
+    # peer is expired after this duration without message (seconds)
+    EXPIRED = 30.0
+    # max number of messages queued for a peer
+    PEER_HWM = 1000
+    # time given to BYE messages to reach peers when node stops (milliseconds)
+    BYE_LINGER = 100
+
+    def __init__(
+        self,
+        name,
+        context,
+        seeds,
+        port=DEFAULT_PORT,
+        interval=INTERVAL,
+        expired=EXPIRED,
+        address=None,
+    ):
+        """
+        Constructor
+
+        Args:
+            name (string): bus name
+            context (zmq.Context): zmq context
+            seeds (list): list of seed endpoints (tcp://host:port)
+            port (int): listening port. 0 for random port. Default DEFAULT_PORT
+            interval (float): peers ping interval (seconds). Default INTERVAL
+            expired (float): peer expiry (seconds). Default EXPIRED
+            address (string): address advertised to peers. Default address used to reach first seed
+        """
+        import_dependencies()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.__name = name
+        self.__uuid = uuid.uuid4()
+        self.__context = context
+        self.__port = port
+        self.__address = address or UnicastNode.get_local_address(seeds)
+        self.__thread = None
+        self.__started = False
+        self.seeds = list(seeds)
+        self.interval = interval
+        self.expired = expired
+        self.headers = {}
+        self.groups = set()
+        # known peers::
+        #   {
+        #       peer uuid (UUID): {
+        #           endpoint (string): peer endpoint
+        #           dealer (zmq.Socket): socket to send messages to peer
+        #           groups (set): peer groups
+        #           last_seen (float): last time a message was received from peer
+        #           seed (string): seed endpoint resolved to this peer, None if discovered by gossip
+        #       }
+        #   }
+        self.peers = {}
+        # sockets to endpoints not resolved to a peer yet (seeds or gossiped endpoints)
+        self.pending = {}
+        self.router = None
+
+        zmq = pyrebus.zmq
+        address = f"inproc://unicast-{self.__uuid.hex}"
+        self.__inbox = context.socket(zmq.PAIR)
+        self.__inbox.setsockopt(zmq.LINGER, 0)
+        self.__inbox.bind(f"{address}-events")
+        self.__outbox = context.socket(zmq.PAIR)
+        self.__outbox.setsockopt(zmq.LINGER, 0)
+        self.__outbox.connect(f"{address}-events")
+        self.__pipe = context.socket(zmq.PAIR)
+        self.__pipe.setsockopt(zmq.LINGER, 0)
+        self.__pipe.bind(f"{address}-commands")
+        self.__commands = context.socket(zmq.PAIR)
+        self.__commands.setsockopt(zmq.LINGER, 0)
+        self.__commands.connect(f"{address}-commands")
+
+    @staticmethod
+    def get_local_address(seeds):
+        """
+        Return local address used to reach seeds (no packet is sent)
+
+        Args:
+            seeds (list): list of seed endpoints
+
+        Returns:
+            string: local ip address, 127.0.0.1 if seeds are unreachable
+        """
+        for seed in seeds:
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    endpoint = urlparse(seed)
+                    sock.connect((endpoint.hostname, endpoint.port or 1))
+                    return sock.getsockname()[0]
+            except (OSError, ValueError):
+                continue
+        return "127.0.0.1"
+
+    def uuid(self):
+        """
+        Return node uuid
+
+        Returns:
+            UUID: node uuid
+        """
+        return self.__uuid
+
+    def name(self):
+        """
+        Return node name (bus name)
+
+        Returns:
+            string: node name
+        """
+        return self.__name
+
+    def endpoint(self):
+        """
+        Return node endpoint
+
+        Returns:
+            string: node endpoint
+        """
+        return f"tcp://{self.__address}:{self.__port}"
+
+    def peer_address(self, peer_uuid):
+        """
+        Return peer endpoint
+
+        Args:
+            peer_uuid (UUID): peer uuid
+
+        Returns:
+            string: peer endpoint
+        """
+        peer = self.peers.get(peer_uuid)
+        return peer["endpoint"] if peer else ""
+
+    def set_header(self, key, value):
+        """
+        Set node header, sent to peers in HELLO
+
+        Args:
+            key (string): header name
+            value (string): header value
+        """
+        self.headers[key] = value
+
+    def join(self, group):
+        """
+        Join group
+
+        Args:
+            group (string): group name
+        """
+        if self.__started:
+            self.__pipe.send_multipart([b"JOIN", group.encode("utf-8")])
+        else:
+            self.groups.add(group)
+
+    def leave(self, group):
+        """
+        Leave group
+
+        Args:
+            group (string): group name
+        """
+        if self.__started:
+            self.__pipe.send_multipart([b"LEAVE", group.encode("utf-8")])
+        else:
+            self.groups.discard(group)
+
+    def start(self):
+        """
+        Start node: listen for peers messages and send HELLO to seeds
+        """
+        zmq = pyrebus.zmq
+        self.router = self.__context.socket(zmq.ROUTER)
+        self.router.setsockopt(zmq.LINGER, 0)
+        self.router.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        if self.__port:
+            self.router.bind(f"tcp://*:{self.__port}")
+        else:
+            self.__port = self.router.bind_to_random_port("tcp://*")
+        for seed in self.seeds:
+            if seed != self.endpoint():
+                self.pending[seed] = self._connect(seed)
+
+        self.__started = True
+        self.__thread = threading.Thread(target=self._run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop node: say goodbye to peers and close sockets. Can be called several times
+        """
+        if not self.__started:
+            return
+        self.__started = False
+        self.__pipe.send_multipart([b"$TERM"])
+        self.__thread.join(2.0)
+        self.__pipe.close()
+        self.__inbox.close()
+
+    def socket(self):
+        """
+        Return socket to poll for incoming events
+
+        Returns:
+            zmq.Socket: node socket
+        """
+        return self.__inbox
+
+    def recv(self):
+        """
+        Receive next event
+
+        Returns:
+            list: event frames (same format as Pyre events)
+        """
+        return self.__inbox.recv_multipart()
+
+    def whisper(self, peer_uuid, frames):
+        """
+        Send frames to peer
+
+        Args:
+            peer_uuid (UUID): peer uuid
+            frames (list): frames to send
+        """
+        self.__pipe.send_multipart([b"WHISPER", peer_uuid.bytes] + list(frames))
+
+    def shout(self, group, frames):
+        """
+        Send frames to all peers in group
+
+        Args:
+            group (string): group name
+            frames (list): frames to send
+        """
+        self.__pipe.send_multipart([b"SHOUT", group.encode("utf-8")] + list(frames))
+
+    def _run(self):
+        """
+        Node thread: handle commands, peers messages and peers heartbeat
+        """
+        zmq = pyrebus.zmq
+        poller = zmq.Poller()
+        poller.register(self.__commands, zmq.POLLIN)
+        poller.register(self.router, zmq.POLLIN)
+        heartbeat_at = 0.0
+        running = True
+        while running:
+            timeout = max(0.0, heartbeat_at - time.time())
+            try:
+                items = dict(poller.poll(timeout * 1000))
+                if self.__commands in items:
+                    running = self._handle_command(self.__commands.recv_multipart())
+                if running and self.router in items:
+                    self._handle_message(self.router.recv_multipart())
+                if running and time.time() >= heartbeat_at:
+                    self._heartbeat(time.time())
+                    heartbeat_at = time.time() + self.interval
+            except Exception:
+                self.logger.exception("Error in unicast node")
+
+        self._close()
+
+    def _close(self):
+        """
+        Say goodbye to peers and close node thread sockets. Dealers linger a bit so BYE is sent
+        before they are closed, peers see node exit at once instead of expiring it
+        """
+        zmq = pyrebus.zmq
+        for peer in self.peers.values():
+            peer["dealer"].setsockopt(zmq.LINGER, self.BYE_LINGER)
+            self._send(peer["dealer"], [b"BYE"])
+            peer["dealer"].close()
+        for dealer in self.pending.values():
+            dealer.close()
+        self.peers.clear()
+        self.pending.clear()
+        self.router.close()
+        self.__commands.close()
+        self.__outbox.close()
+
+    def _connect(self, endpoint):
+        """
+        Create socket to send messages to endpoint
+
+        Args:
+            endpoint (string): peer endpoint
+
+        Returns:
+            zmq.Socket: dealer socket
+        """
+        zmq = pyrebus.zmq
+        dealer = self.__context.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.IDENTITY, self.__uuid.bytes)
+        dealer.setsockopt(zmq.LINGER, 0)
+        dealer.setsockopt(zmq.SNDHWM, self.PEER_HWM)
+        dealer.setsockopt(zmq.IMMEDIATE, 1)
+        dealer.connect(endpoint)
+        return dealer
+
+    def _send(self, dealer, frames):
+        """
+        Send frames without blocking. Frames are dropped if peer is not reachable
+
+        Args:
+            dealer (zmq.Socket): dealer socket
+            frames (list): frames to send
+        """
+        try:
+            dealer.send_multipart(frames, flags=pyrebus.zmq.NOBLOCK)
+        except pyrebus.zmq.ZMQError:
+            pass
+
+    def _emit(self, event_type, peer_uuid, frames=None):
+        """
+        Queue event for bus
+
+        Args:
+            event_type (bytes): event type (ENTER, EXIT, JOIN...)
+            peer_uuid (UUID): peer the event comes from
+            frames (list): event frames
+        """
+        head = [event_type, peer_uuid.bytes, self.__name.encode("utf-8")]
+        self.__outbox.send_multipart(head + list(frames or []))
+
+    def _hello(self, via=None, seed=None):
+        """
+        Build HELLO frames
+
+        Args:
+            via (string): endpoint used to reach peer, when it is not known yet
+            seed (string): endpoint the peer used to reach this node
+
+        Returns:
+            list: HELLO frames
+        """
+        hello = {
+            "name": self.__name,
+            "endpoint": self.endpoint(),
+            "headers": self.headers,
+            "groups": sorted(self.groups),
+            "peers": [peer["endpoint"] for peer in self.peers.values()],
+            "via": via,
+            "seed": seed,
+        }
+        return [b"HELLO", json.dumps(hello).encode("utf-8")]
+
+    def _handle_command(self, command):
+        """
+        Handle command sent by node API
+
+        Args:
+            command (list): command frames
+
+        Returns:
+            bool: False if node must stop
+        """
+        command_type = command.pop(0)
+        if command_type == b"$TERM":
+            return False
+        if command_type == b"WHISPER":
+            peer = self.peers.get(uuid.UUID(bytes=command.pop(0)))
+            if peer:
+                self._send(peer["dealer"], [b"WHISPER"] + command)
+        elif command_type == b"SHOUT":
+            group = command[0].decode("utf-8")
+            for peer in self.peers.values():
+                if group in peer["groups"]:
+                    self._send(peer["dealer"], [b"SHOUT"] + command)
+        elif command_type in (b"JOIN", b"LEAVE"):
+            group = command[0].decode("utf-8")
+            if command_type == b"JOIN":
+                self.groups.add(group)
+            else:
+                self.groups.discard(group)
+            for peer in self.peers.values():
+                self._send(peer["dealer"], [command_type] + command)
+        return True
+
+    def _handle_message(self, message):
+        """
+        Handle message received from peer
+
+        Args:
+            message (list): message frames (sender uuid, message type and content)
+        """
+        peer_uuid = uuid.UUID(bytes=message.pop(0))
+        message_type = message.pop(0)
+        if message_type == b"HELLO":
+            self._handle_hello(peer_uuid, json.loads(message[0].decode("utf-8")))
+            return
+
+        peer = self.peers.get(peer_uuid)
+        if not peer:
+            return
+        peer["last_seen"] = time.time()
+        if message_type == b"WHISPER":
+            self._emit(b"WHISPER", peer_uuid, message)
+        elif message_type == b"SHOUT":
+            if message[0].decode("utf-8") in self.groups:
+                self._emit(b"SHOUT", peer_uuid, message)
+        elif message_type in (b"JOIN", b"LEAVE"):
+            group = message[0].decode("utf-8")
+            if message_type == b"JOIN":
+                peer["groups"].add(group)
+            else:
+                peer["groups"].discard(group)
+            self._emit(message_type, peer_uuid, message)
+        elif message_type == b"BYE":
+            self._remove_peer(peer_uuid)
+
+    def _handle_hello(self, peer_uuid, hello):
+        """
+        Handle HELLO: add new peer and connect to peers it knows
+
+        Args:
+            peer_uuid (UUID): peer uuid
+            hello (dict): HELLO content
+        """
+        if hello.get("name") != self.__name:
+            return
+        if peer_uuid == self.__uuid:
+            # a seed is this node
+            if hello.get("via") in self.pending:
+                self.pending.pop(hello["via"]).close()
+            return
+
+        peer = self.peers.get(peer_uuid)
+        seed = hello.get("seed")
+        if peer is None:
+            endpoint = hello["endpoint"]
+            dealer = self.pending.pop(endpoint, None) or self._connect(endpoint)
+            peer = {
+                "endpoint": endpoint,
+                "dealer": dealer,
+                "groups": set(hello.get("groups", [])),
+                "last_seen": time.time(),
+                "seed": seed if seed in self.seeds else None,
+            }
+            if peer["seed"] is None and endpoint in self.seeds:
+                peer["seed"] = endpoint
+            self.peers[peer_uuid] = peer
+            self._send(dealer, self._hello(seed=hello.get("via")))
+            self._emit(
+                b"ENTER",
+                peer_uuid,
+                [
+                    json.dumps(hello.get("headers", {})).encode("utf-8"),
+                    endpoint.encode("utf-8"),
+                ],
+            )
+            for group in sorted(peer["groups"]):
+                self._emit(b"JOIN", peer_uuid, [group.encode("utf-8")])
+        else:
+            peer["last_seen"] = time.time()
+            if seed in self.seeds:
+                peer["seed"] = seed
+            if hello.get("via"):
+                self._send(peer["dealer"], self._hello(seed=hello.get("via")))
+
+        # seed resolved to peer (seed may differ from endpoint advertised by peer)
+        if seed in self.pending:
+            self.pending.pop(seed).close()
+
+        # gossip: connect to peers known by new peer
+        known = {peer["endpoint"] for peer in self.peers.values()}
+        for endpoint in hello.get("peers", []):
+            if (
+                endpoint != self.endpoint()
+                and endpoint not in known
+                and endpoint not in self.pending
+            ):
+                self.pending[endpoint] = self._connect(endpoint)
+                self._send(self.pending[endpoint], self._hello(via=endpoint))
+
+    def _remove_peer(self, peer_uuid):
+        """
+        Remove peer and retry its seed
+
+        Args:
+            peer_uuid (UUID): peer uuid
+        """
+        peer = self.peers.pop(peer_uuid)
+        peer["dealer"].close()
+        self._emit(b"EXIT", peer_uuid)
+        if peer["seed"] and peer["seed"] not in self.pending:
+            self.pending[peer["seed"]] = self._connect(peer["seed"])
+
+    def _heartbeat(self, now):
+        """
+        Ping peers, expire silent ones and send HELLO to unresolved endpoints
+
+        Args:
+            now (float): current timestamp
+        """
+        for peer_uuid, peer in list(self.peers.items()):
+            if now - peer["last_seen"] > self.expired:
+                self.logger.debug('Peer "%s" expired', peer_uuid)
+                self._remove_peer(peer_uuid)
+            else:
+                self._send(peer["dealer"], [b"PING"])
+        for endpoint, dealer in self.pending.items():
+            self._send(dealer, self._hello(via=endpoint))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare encoding cost of events propagated by Cleepbus (caller side and bus thread side, network
+and pipe transport excluded):
+ - message path: MessageRequest encoded to pipe, decoded by bus thread, cleaned and encoded again
+ - template path: only params encoded after cached (event, sender) template
+
+Run from repository root:
+
+    python benchmarks/bench_event_encoding.py [--events 100000]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=C0413
+from cleep.common import MessageRequest
+from backend.pyrebus import PyreBus
+from backend.messagetemplates import MessageTemplates
+
+EVENTS = [
+    ("sensors.temperature.update", "sensors", {"sensor": "kitchen", "celsius": 21.5}),
+    ("system.monitoring.cpu", "system", {"percent": 12.3}),
+    ("gpios.gpio.on", "gpios", {"gpio": "GPIO18", "init": False}),
+]
+
+
+def encode_message(event, params, sender):
+    """
+    Encode event like send_message does
+
+    Args:
+        event (string): event name
+        params (dict): event parameters
+        sender (string): event sender
+
+    Returns:
+        bytes: message content sent to peers
+    """
+    message = MessageRequest()
+    message.event = event
+    message.params = params
+    message.sender = sender
+    # caller thread
+    pipe_content = json.dumps(message.to_dict()).encode("utf-8")
+    # bus thread
+    received = MessageRequest()
+    received.fill_from_dict(json.loads(pipe_content.decode("utf-8")))
+    return json.dumps(PyreBus.clean_message(received)).encode("utf-8")
+
+
+def run(count, encode):
+    """
+    Encode events
+
+    Args:
+        count (int): number of events
+        encode (function): encoding function
+
+    Returns:
+        float: duration per event (seconds)
+    """
+    start = time.perf_counter()
+    for index in range(count):
+        event, sender, params = EVENTS[index % len(EVENTS)]
+        encode(event, params, sender)
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    """
+    Run benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=100000)
+    args = parser.parse_args()
+
+    templates = MessageTemplates(PyreBus.clean_message)
+    for event, sender, params in EVENTS:
+        if templates.encode(event, params, sender) != encode_message(
+            event, params, sender
+        ):
+            raise Exception(f'Template content differs for event "{event}"')
+
+    message = run(args.events, encode_message)
+    template = run(args.events, templates.encode)
+    print(
+        f"{args.events} events: message path {message * 1e6:.2f} us/event, "
+        f"template path {template * 1e6:.2f} us/event ({template / message - 1:+.0%})"
+    )
+
+
+if __name__ == "__main__":
+    main()
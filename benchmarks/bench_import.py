@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure cleepbus import time (what Cleep pays at boot) and deferred bus dependencies import time
+(what is paid when bus starts)
+
+Each measure runs in a fresh interpreter to avoid modules cache. Run from repository root:
+
+    python benchmarks/bench_import.py [--runs 10]
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEASURE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter() - start
+heavy = [name for name in ("pyre_gevent", "zmq", "netifaces", "netaddr") if name in sys.modules]
+start = time.perf_counter()
+from backend import pyrebus
+pyrebus.import_dependencies()
+deferred = time.perf_counter() - start
+print(json.dumps({{"imported": imported, "deferred": deferred, "heavy": heavy}}))
+"""
+
+
+def measure(module):
+    """
+    Import module in fresh interpreter
+
+    Args:
+        module (string): module to import
+
+    Returns:
+        dict: import duration, deferred dependencies import duration and heavy modules loaded
+    """
+    output = subprocess.check_output(
+        [sys.executable, "-c", MEASURE.format(module=module)], cwd=ROOT
+    )
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def main():
+    """
+    Run benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10, help="number of runs")
+    args = parser.parse_args()
+
+    for module in ("backend.pyrebus", "backend.cleepbus"):
+        results = [measure(module) for _ in range(args.runs)]
+        imported = statistics.median(result["imported"] for result in results)
+        deferred = statistics.median(result["deferred"] for result in results)
+        print(
+            f"{module}: import {imported * 1000:.1f} ms (median of {args.runs}), "
+            f"bus dependencies {deferred * 1000:.1f} ms at bus start, "
+            f"heavy modules loaded at import: {results[0]['heavy'] or 'none'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure bus hot paths throughput (message decoding on reception, message encoding on sending)
+with debug logging disabled, enabled, and with sampled message log
+
+Run from repository root:
+
+    python benchmarks/bench_logging.py [--messages 20000]
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from unittest.mock import Mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=C0413
+from backend.pyrebus import PyreBus
+
+PEER_ID = "12345678-1234-5678-1234-567812345678"
+MESSAGE = {
+    "event": "system.device.heartbeat",
+    "params": {"uptime": 123456, "temperature": 42.0, "devices": list(range(20))},
+}
+
+
+def build_bus():
+    """
+    Build bus without network: node and pipe are replaced by mocks
+
+    Returns:
+        PyreBus: bus instance
+    """
+    bus = PyreBus(
+        lambda peer_id, message: None,
+        lambda peer_id, infos: None,
+        lambda peer_id: None,
+        lambda infos: None,
+        False,
+        None,
+    )
+    bus.logger.propagate = False
+    bus.logger.handlers = [logging.NullHandler()]
+    bus.node = Mock()
+    bus.pipe_out = Mock()
+    bus.pipe_out.recv_multipart.return_value = [json.dumps(MESSAGE).encode("utf-8")]
+    return bus
+
+
+def run(bus, messages):
+    """
+    Receive and send messages
+
+    Args:
+        bus (PyreBus): bus instance
+        messages (int): number of messages
+
+    Returns:
+        float: messages per second (one reception and one sending per message)
+    """
+    content = json.dumps(MESSAGE).encode("utf-8")
+    meta = PyreBus.make_meta(PyreBus.KIND_EVENT, MESSAGE["event"].encode("utf-8"))
+    meta = PyreBus.parse_message_meta(meta)
+    start = time.perf_counter()
+    for _ in range(messages):
+        bus._dispatch_message(PEER_ID, meta, content)
+        bus._message_to_send_to_pipe()
+    return messages / (time.perf_counter() - start)
+
+
+def main():
+    """
+    Run benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--messages", type=int, default=20000, help="number of messages"
+    )
+    args = parser.parse_args()
+
+    scenarios = [
+        ("debug disabled", logging.INFO, 0),
+        ("debug disabled, 1/1000 sampled log", logging.INFO, 1000),
+        ("debug enabled", logging.DEBUG, 0),
+    ]
+    for name, level, sampling in scenarios:
+        bus = build_bus()
+        bus.logger.setLevel(level)
+        bus.set_message_log_sampling(sampling)
+        print(f"{name}: {run(bus, args.messages):.0f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
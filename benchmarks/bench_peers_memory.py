@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure memory used by peers table: peer infos decoded like Cleepbus does, with plain PeerInfos
+(one dict and string copies per peer) and with CompactPeerInfos (slots and shared extra infos)
+
+Peers infos are generated like received from the network (every string is a new object), with
+a few distinct Cleep versions, hardware models and installed applications.
+
+Run from repository root:
+
+    python benchmarks/bench_peers_memory.py [--peers 100 500 1000]
+"""
+
+import os
+import sys
+import json
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=C0413
+from cleep.common import PeerInfos
+from backend.cleepbus import Cleepbus
+
+APPS = [
+    ["system", "parameters", "audio", "network"],
+    ["system", "parameters", "audio", "network", "cleepbus", "sensors", "gpios"],
+    ["system", "parameters", "network", "cleepbus", "openweathermap", "charts"],
+]
+VERSIONS = ["0.1.0", "0.1.1", "0.2.0"]
+HARDWARE = [
+    {
+        "hwmodel": "3B+",
+        "hwmemory": "1024",
+        "pcbrevision": "1.3",
+        "hwrevision": "a020d3",
+    },
+    {"hwmodel": "4B", "hwmemory": "2048", "pcbrevision": "1.4", "hwrevision": "b03114"},
+    {
+        "hwmodel": "Zero W",
+        "hwmemory": "512",
+        "pcbrevision": "1.1",
+        "hwrevision": "9000c1",
+    },
+]
+
+
+def make_infos(index):
+    """
+    Build peer infos like received in bus ENTER message
+
+    Args:
+        index (int): peer index
+
+    Returns:
+        dict: peer infos (all values are strings)
+    """
+    infos = {
+        "uuid": f"00000000-0000-0000-0000-{index:012d}",
+        "version": VERSIONS[index % len(VERSIONS)],
+        "hostname": f"peer{index}",
+        "port": "80",
+        "ssl": "0",
+        "auth": "0",
+        "cleepdesktop": "0",
+        "macs": json.dumps(
+            [
+                f"b8:27:eb:{index >> 16 & 0xff:02x}:{index >> 8 & 0xff:02x}:{index & 0xff:02x}"
+            ]
+        ),
+        "apps": json.dumps(APPS[index % len(APPS)]),
+        "hwaudio": "1",
+        "hwwireless": "1",
+        "hwethernet": "1",
+    }
+    infos.update(HARDWARE[index % len(HARDWARE)])
+    # decoded json strings are new objects, like strings received from network
+    return json.loads(json.dumps(infos))
+
+
+def decode_plain(infos):
+    """
+    Decode peer infos in a plain PeerInfos (previous Cleepbus implementation)
+
+    Args:
+        infos (dict): peer infos
+
+    Returns:
+        PeerInfos: peer infos
+    """
+    peer_infos = Cleepbus._decode_peer_infos(infos)
+    plain = PeerInfos()
+    plain.fill_from_dict(peer_infos.to_dict())
+    plain.extra = dict(peer_infos.extra)
+    return plain
+
+
+def measure(size, decode):
+    """
+    Measure memory allocated by peers table
+
+    Args:
+        size (int): number of peers
+        decode (function): function decoding peer infos
+
+    Returns:
+        int: allocated bytes per peer
+    """
+    infos = [make_infos(index) for index in range(size)]
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    peers = {}
+    for peer_infos in infos:
+        decoded = decode(peer_infos)
+        peers[decoded.uuid] = decoded
+    # received infos are released once decoded
+    infos.clear()
+    allocated = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return allocated / size
+
+
+def main():
+    """
+    Run benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--peers", type=int, nargs="+", default=[100, 500, 1000])
+    args = parser.parse_args()
+
+    # warm up imports and interned strings
+    Cleepbus._decode_peer_infos(make_infos(0))
+
+    for size in args.peers:
+        plain = measure(size, decode_plain)
+        compact = measure(size, Cleepbus._decode_peer_infos)
+        print(
+            f"{size} peers: PeerInfos {plain:.0f} B/peer, "
+            f"CompactPeerInfos {compact:.0f} B/peer ({compact / plain - 1:+.0%})"
+        )
+
+
+if __name__ == "__main__":
+    main()
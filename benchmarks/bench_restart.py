@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stress bus restarts (like on flapping Wi-Fi): measure restart wall time and file descriptors
+and threads left behind after repeated start/stop
+
+Peers use in-process loopback transport by default (no network needed). Use --transport pyre
+to restart real Pyre nodes (a network interface with broadcast is needed).
+
+Run from repository root:
+
+    python benchmarks/bench_restart.py [--restarts 100] [--transport loopback]
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=C0413
+from backend.pyrebus import PyreBus
+from backend.loopbackbus import LoopbackBus, LoopbackRegistry
+
+INFOS = {"uuid": "00000000-0000-0000-0000-000000000000"}
+
+
+def count_fds():
+    """
+    Return number of file descriptors opened by process
+
+    Returns:
+        int: number of file descriptors
+    """
+    return len(os.listdir("/proc/self/fd"))
+
+
+def count_threads():
+    """
+    Return number of threads of process (including zmq io threads)
+
+    Returns:
+        int: number of threads
+    """
+    return len(os.listdir("/proc/self/task"))
+
+
+def main():
+    """
+    Run benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--restarts", type=int, default=100, help="number of restarts")
+    parser.add_argument("--transport", choices=["loopback", "pyre"], default="loopback")
+    args = parser.parse_args()
+
+    callbacks = (
+        lambda peer_id, message: None,
+        lambda peer_id, infos: None,
+        lambda peer_id: None,
+        lambda infos: infos,
+        False,
+        None,
+    )
+    if args.transport == "loopback":
+        bus = LoopbackBus(*callbacks, registry=LoopbackRegistry())
+    else:
+        bus = PyreBus(*callbacks)
+    bus.logger.disabled = True
+
+    # first start allocates long lived resources
+    bus.start(INFOS, "BENCHRESTART")
+    fds = count_fds()
+    threads = count_threads()
+
+    durations = []
+    for _ in range(args.restarts):
+        start = time.perf_counter()
+        bus.stop()
+        bus.start(INFOS, "BENCHRESTART")
+        durations.append(time.perf_counter() - start)
+    bus.stop()
+
+    print(
+        f"{args.restarts} restarts: "
+        f"median {statistics.median(durations) * 1000:.1f} ms, "
+        f"max {max(durations) * 1000:.1f} ms, "
+        f"file descriptors {count_fds() - fds:+d}, threads {count_threads() - threads:+d}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Simulate many Cleep devices in one process to measure scaling limits
+
+Each simulated device is a Cleepbus module instance set up with Cleep test session (Cleep core is
+mocked), so messages go through the real bus and Cleepbus paths (events propagation, sequence
+checks, subscriptions filtering and peers bookkeeping). Module thread is not started, the simulation
+processes all buses itself.
+
+For each network size, devices are started and the tool reports:
+ - discovery convergence time (until every device knows all other devices)
+ - memory per device (python allocations traced with tracemalloc)
+ - event storm duration and CPU time per device (every device propagates events)
+ - churn convergence time (part of devices leave then join again)
+
+Devices use in-process loopback transport by default (no network needed). Use --transport pyre
+to use real Pyre nodes (beacons must be allowed on current network).
+
+Run from repository root:
+
+    python benchmarks/simulation.py --peers 50 200 500 --events 10 --churn 0.1
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import unittest
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=C0413
+from cleep.libs.tests import session
+from backend.cleepbus import Cleepbus
+from backend.pyrebus import import_dependencies
+
+EVENT = "simulation.storm.event"
+APPS = {"system": {}, "parameters": {}, "audio": {}, "network": {}}
+
+
+class SimulatedPeer:
+    """
+    Cleepbus module of a simulated device
+    """
+
+    def __init__(self, index, transport):
+        """
+        Constructor
+
+        Args:
+            index (int): peer index
+            transport (string): loopback or pyre
+        """
+        self.index = index
+        self.received = 0
+        if transport == "loopback":
+            os.environ[Cleepbus.TRANSPORT_ENV] = Cleepbus.TRANSPORT_LOOPBACK
+        else:
+            os.environ.pop(Cleepbus.TRANSPORT_ENV, None)
+        self.session = session.TestSession(unittest.TestCase())
+        self.module = self.session.setup(
+            Cleepbus, mock_on_start=False, mock_on_stop=False
+        )
+        self.session.add_mock_command(
+            self.session.make_mock_command("get_modules", APPS)
+        )
+        self.module._configure()
+        self.module.logger.disabled = True
+        self.module.external_bus.logger.disabled = True
+        # events received from other devices are sent to internal bus
+        self.module.send_event = self.on_event_received
+        self.bus = self.module.external_bus
+
+    def on_event_received(self, event, params=None, to=None):
+        """
+        Event sent to internal bus by Cleepbus
+        """
+        if event == EVENT:
+            self.received += 1
+
+    @property
+    def peers(self):
+        """
+        Return online peers known by device
+
+        Returns:
+            list: online peers infos
+        """
+        return [peer for peer in self.module.peers.values() if peer.online]
+
+    def start(self):
+        """
+        Start bus (like a device joining network)
+        """
+        self.module._start_external_bus()
+
+    def stop(self):
+        """
+        Stop bus (like a device leaving network)
+        """
+        self.module._stop_external_bus()
+
+    def close(self):
+        """
+        Stop module
+        """
+        self.module._on_stop()
+
+    def propagate(self, index):
+        """
+        Propagate local event to other devices
+
+        Args:
+            index (int): event index
+        """
+        self.module.on_event(
+            {
+                "event": EVENT,
+                "params": {"peer": self.index, "index": index},
+                "propagate": True,
+                "startup": False,
+            }
+        )
+
+    def pump(self):
+        """
+        Process all pending bus work without blocking
+
+        Returns:
+            int: number of processed items
+        """
+        if not self.bus.is_running():
+            return 0
+
+        processed = 0
+        while self.bus.pipe_out.poll(0):
+            self.bus._message_to_send_to_pipe()
+            processed += 1
+        while self.bus.node_socket.poll(0):
+            self.bus._message_to_receive_from_pipe()
+            processed += 1
+        return processed
+
+
+def stop_peers(peers):
+    """
+    Stop peers in parallel (bus stop waits for pyre task)
+
+    Args:
+        peers (list): list of SimulatedPeer
+    """
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        list(executor.map(lambda peer: peer.stop(), peers))
+
+
+def pump_until(peers, predicate, timeout):
+    """
+    Pump all peers until predicate is True
+
+    Args:
+        peers (list): list of SimulatedPeer
+        predicate (function): stop condition
+        timeout (float): max duration (seconds)
+
+    Returns:
+        tuple: duration (seconds, None if timeout) and CPU time (seconds)
+    """
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    while not predicate():
+        if time.perf_counter() - start > timeout:
+            return None, time.process_time() - cpu_start
+        if not sum(peer.pump() for peer in peers):
+            time.sleep(0.001)
+    return time.perf_counter() - start, time.process_time() - cpu_start
+
+
+def simulate(size, transport, events, churn, timeout, memory=True):
+    """
+    Run simulation for specified number of peers
+
+    Args:
+        size (int): number of peers
+        transport (string): loopback or pyre
+        events (int): number of events broadcast by each peer during event storm
+        churn (float): ratio of peers leaving and joining again
+        timeout (float): max duration of each step (seconds)
+        memory (bool): measure memory (tracemalloc slows down discovery). Default True
+
+    Returns:
+        dict: measures
+    """
+    # load bus dependencies before measuring memory
+    import_dependencies()
+    if memory:
+        tracemalloc.start()
+    memory_start = tracemalloc.get_traced_memory()[0]
+    peers = [SimulatedPeer(index, transport) for index in range(size)]
+    for peer in peers:
+        peer.start()
+
+    def converged():
+        return all(len(peer.peers) == size - 1 for peer in peers)
+
+    discovery, _ = pump_until(peers, converged, timeout)
+    allocated = tracemalloc.get_traced_memory()[0] - memory_start
+    tracemalloc.stop()
+
+    # event storm: every peer propagates events (one per round to not overflow bus pipe)
+    expected = events * (size - 1)
+    storm_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for index in range(events):
+        for peer in peers:
+            peer.propagate(index)
+        for peer in peers:
+            peer.pump()
+    storm, _ = pump_until(
+        peers, lambda: all(peer.received >= expected for peer in peers), timeout
+    )
+    storm_cpu = time.process_time() - cpu_start
+    if storm is not None:
+        storm = time.perf_counter() - storm_start
+
+    # churn: some peers leave then join again
+    churned = peers[: int(size * churn)]
+    stop_peers(churned)
+    leave, _ = pump_until(
+        peers,
+        lambda: all(
+            len(peer.peers) == size - 1 - len(churned)
+            for peer in peers
+            if peer not in churned
+        ),
+        timeout,
+    )
+    for peer in churned:
+        peer.start()
+    rejoin, _ = pump_until(peers, converged, timeout)
+
+    stop_peers([peer for peer in peers if peer.bus.is_running()])
+    for peer in peers:
+        peer.close()
+
+    return {
+        "peers": size,
+        "discovery": discovery,
+        "memory_per_peer": allocated / size if memory else None,
+        "storm": storm,
+        "storm_cpu_per_peer": storm_cpu / size,
+        "churned": len(churned),
+        "churn_leave": leave,
+        "churn_rejoin": rejoin,
+    }
+
+
+def format_duration(duration):
+    """
+    Format duration
+
+    Args:
+        duration (float): duration (seconds) or None
+
+    Returns:
+        string: formatted duration
+    """
+    return "timeout" if duration is None else f"{duration * 1000:.0f} ms"
+
+
+def main():
+    """
+    Run simulation
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--peers", type=int, nargs="+", default=[50, 200, 500])
+    parser.add_argument("--transport", choices=["loopback", "pyre"], default="loopback")
+    parser.add_argument("--events", type=int, default=10, help="events per peer")
+    parser.add_argument(
+        "--churn", type=float, default=0.1, help="ratio of churned peers"
+    )
+    parser.add_argument("--timeout", type=float, default=120.0, help="step timeout")
+    parser.add_argument(
+        "--no-memory", action="store_true", help="do not measure memory (faster)"
+    )
+    parser.add_argument("--json", action="store_true", help="output json")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.peers:
+        result = simulate(
+            size,
+            args.transport,
+            args.events,
+            args.churn,
+            args.timeout,
+            memory=not args.no_memory,
+        )
+        results.append(result)
+        if not args.json:
+            memory = result["memory_per_peer"]
+            print(
+                f"{size} peers: discovery {format_duration(result['discovery'])}, "
+                f"memory {'-' if memory is None else f'{memory / 1024:.1f}'} KiB/peer, "
+                f"storm of {args.events * size} events {format_duration(result['storm'])} "
+                f"(cpu {result['storm_cpu_per_peer'] * 1000:.2f} ms/peer), "
+                f"churn of {result['churned']} peers: leave {format_duration(result['churn_leave'])}, "
+                f"rejoin {format_duration(result['churn_rejoin'])}"
+            )
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
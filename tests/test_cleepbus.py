@@ -3,10 +3,33 @@ import unittest
 import logging
 import sys
 import json
+import re
 import copy
+import zlib
+import uuid
+import threading
+import importlib.util
+from collections import deque
+
 sys.path.append("../")
 from backend.cleepbus import Cleepbus
-from backend.pyrebus import PyreBus
+from backend.pyrebus import PyreBus, import_dependencies
+import backend.pyrebus as pyrebus_module
+from backend.busstream import BusStream, BusOutgoingStream, BusStreamError
+from backend.peerlinkstats import PeerLinkStats
+from backend.peersequence import PeerSequence
+from backend.reliabledelivery import ReliableSender, ReliableReceiver
+from backend.busprofiler import BusProfiler
+from backend.loopbackbus import LoopbackBus, LoopbackRegistry
+from backend.unicastnode import UnicastNode
+from backend.broadcastrequest import BroadcastRequest
+from backend.adaptivetimeout import AdaptiveTimeout
+from backend.tokenbucket import TokenBucket
+from backend.bustracer import BusTracer
+from backend.eventmatcher import EventMatcher
+from backend.percentile import percentile
+from backend.compactpeerinfos import CompactPeerInfos, PeerInfosPool, SharedExtra
+from backend.messagetemplates import MessageTemplates
 from cleep.exception import (
     InvalidParameter,
     MissingParameter,
@@ -172,6 +195,7 @@ class TestsCleepbus(unittest.TestCase):
                 "uuid": self.module.uuid,
                 "cleepdesktop": "0",
                 "auth": "0",
+                "subscriptions": '["*"]',
             },
         )
 
@@ -204,6 +228,7 @@ class TestsCleepbus(unittest.TestCase):
                 "uuid": self.module.uuid,
                 "cleepdesktop": "0",
                 "auth": "0",
+                "subscriptions": '["*"]',
             },
         )
 
@@ -244,6 +269,116 @@ class TestsCleepbus(unittest.TestCase):
             },
         )
 
+    def test_decode_peer_infos_drop_bus_headers(self):
+        self.init_session()
+
+        peer_infos = self.module._decode_peer_infos(
+            {
+                "field1": "value1",
+                "subscriptions": '["system.*"]',
+                "busfeatures": "zlib",
+            }
+        )
+
+        self.assertDictEqual(dict(peer_infos.extra), {"field1": "value1"})
+
+    def test_decode_peer_infos_share_extra(self):
+        self.init_session()
+
+        peer_infos1 = self.module._decode_peer_infos(
+            {"uuid": "uuid1", "version": "1.0.0", "apps": '["system"]'}
+        )
+        peer_infos2 = self.module._decode_peer_infos(
+            {"uuid": "uuid2", "version": "1.0.0", "apps": '["system"]'}
+        )
+
+        self.assertIsInstance(peer_infos1, PeerInfos)
+        self.assertDictEqual(vars(peer_infos1), {})
+        self.assertIs(peer_infos1._extra, peer_infos2._extra)
+        self.assertIs(peer_infos1.apps, peer_infos2.apps)
+        self.assertEqual(peer_infos1.apps, ("system",))
+        self.assertEqual(peer_infos1.to_dict(True)["extra"]["version"], "1.0.0")
+        self.assertIs(peer_infos1._extra, peer_infos2._extra)
+
+    def test_set_subscriptions(self):
+        self.init_session()
+        mock_pyrebus.return_value.is_running.return_value = True
+        self.module._start_external_bus = Mock()
+        self.module._stop_external_bus = Mock()
+
+        self.module.set_subscriptions(["system.*", "alarm.alarm.triggered"])
+
+        self.assertListEqual(
+            self.module._get_config_field("subscriptions"),
+            ["system.*", "alarm.alarm.triggered"],
+        )
+        self.module._stop_external_bus.assert_called()
+        self.module._start_external_bus.assert_called()
+
+        mock_pyrebus.return_value.is_running = Mock()
+
+    def test_set_subscriptions_bus_not_running(self):
+        self.init_session()
+        mock_pyrebus.return_value.is_running.return_value = False
+        self.module._start_external_bus = Mock()
+
+        self.module.set_subscriptions(["*"])
+
+        self.assertFalse(self.module._start_external_bus.called)
+
+        mock_pyrebus.return_value.is_running = Mock()
+
+    def test_set_subscriptions_check_parameters(self):
+        self.init_session()
+
+        with self.assertRaises(MissingParameter) as cm:
+            self.module.set_subscriptions(None)
+        self.assertEqual(str(cm.exception), 'Parameter "subscriptions" is missing')
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_subscriptions(["system.*", ""])
+        self.assertEqual(
+            str(cm.exception), "Subscriptions must be a list of event patterns"
+        )
+
+    def test_set_channels(self):
+        self.init_session()
+        mock_pyrebus.return_value.is_running.return_value = True
+        self.module._start_external_bus = Mock()
+        self.module._stop_external_bus = Mock()
+
+        self.module.set_channels(["CLEEP", "floor1"], {"floor1": ["light.*"]})
+
+        self.assertListEqual(
+            self.module._get_config_field("channels"), ["CLEEP", "floor1"]
+        )
+        self.assertDictEqual(
+            self.module._get_config_field("channel_routes"), {"floor1": ["light.*"]}
+        )
+        mock_pyrebus.return_value.set_channel_routes.assert_called_with(
+            {"floor1": ["light.*"]}
+        )
+        self.module._start_external_bus.assert_called()
+
+        mock_pyrebus.return_value.is_running = Mock()
+
+    def test_set_channels_check_parameters(self):
+        self.init_session()
+
+        with self.assertRaises(MissingParameter) as cm:
+            self.module.set_channels(None)
+        self.assertEqual(str(cm.exception), 'Parameter "channels" is missing')
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_channels([])
+        self.assertEqual(
+            str(cm.exception), "Channels must be a non empty list of channel names"
+        )
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_channels(["CLEEP"], {"floor1": ["light.*"]})
+        self.assertEqual(
+            str(cm.exception),
+            "Routes must be a list of event patterns by joined channel",
+        )
+
     def test_on_stop(self):
         self.init_session()
         self.module._stop_external_bus = Mock()
@@ -251,6 +386,7 @@ class TestsCleepbus(unittest.TestCase):
         self.module._on_stop()
 
         self.module._stop_external_bus.assert_called()
+        mock_pyrebus.return_value.close.assert_called()
 
     def test_on_process(self):
         self.init_session()
@@ -265,7 +401,7 @@ class TestsCleepbus(unittest.TestCase):
 
         self.module._start_external_bus()
 
-        mock_pyrebus.return_value.start.assert_called()
+        mock_pyrebus.return_value.start.assert_called_with(ANY, bus_channel=["CLEEP"])
         mock_pyrebus.return_value.get_mac_addresses = Mock()
 
     def test_stop_external_bus(self):
@@ -305,6 +441,8 @@ class TestsCleepbus(unittest.TestCase):
                     "port": 8000,
                     "hostname": None,
                     "online": False,
+                    "last_seen": None,
+                    "link": None,
                 },
                 "peer2": {
                     "cleepdesktop": True,
@@ -316,10 +454,376 @@ class TestsCleepbus(unittest.TestCase):
                     "port": 80,
                     "hostname": "dummy",
                     "online": False,
+                    "last_seen": None,
+                    "link": None,
                 },
             },
         )
 
+    def test_get_peers_last_seen(self):
+        self.init_session()
+        online_peer = PeerInfos(uuid="123", ident="666")
+        online_peer.online = True
+        offline_peer = PeerInfos(uuid="456", ident="999")
+        self.module.peers = {"123": online_peer, "456": offline_peer}
+        self.module.peers_last_seen = {"123": 10.0, "456": 20.0}
+        mock_pyrebus.return_value.get_peer_last_seen.return_value = 30.0
+
+        peers = self.module.get_peers()
+
+        self.assertEqual(peers["123"]["last_seen"], 30.0)
+        self.assertEqual(peers["456"]["last_seen"], 20.0)
+        mock_pyrebus.return_value.get_peer_last_seen.assert_called_once_with("666")
+
+        mock_pyrebus.return_value.get_peer_last_seen = Mock()
+
+    @patch("backend.cleepbus.time")
+    def test_offline_peer_expiry(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        self.init_session()
+        self.module._set_config_field("offline_peer_ttl", 60)
+        peer_infos = self.make_peer_infos()
+        self.module._on_peer_connected(peer_infos.ident, peer_infos)
+        self.module._on_peer_disconnected(peer_infos.ident)
+
+        mock_time.time.return_value = 1059.0
+        self.module._expire_peers()
+        self.assertIn(peer_infos.uuid, self.module.peers)
+
+        mock_time.time.return_value = 1061.0
+        self.module._expire_peers()
+        self.assertNotIn(peer_infos.uuid, self.module.peers)
+        self.assertNotIn(peer_infos.uuid, self.module.peers_last_seen)
+
+    @patch("backend.cleepbus.time")
+    def test_offline_peer_expiry_cancelled_on_reconnection(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        self.init_session()
+        self.module._set_config_field("offline_peer_ttl", 60)
+        peer_infos = self.make_peer_infos()
+        self.module._on_peer_connected(peer_infos.ident, peer_infos)
+        self.module._on_peer_disconnected(peer_infos.ident)
+        self.module._on_peer_connected(peer_infos.ident, peer_infos)
+
+        mock_time.time.return_value = 2000.0
+        self.module._expire_peers()
+
+        self.assertIn(peer_infos.uuid, self.module.peers)
+        self.assertEqual(self.module.peers_last_seen[peer_infos.uuid], 1000.0)
+
+    @patch("backend.cleepbus.time")
+    def test_offline_peer_expiry_max_offline_peers(self, mock_time):
+        self.init_session()
+        self.module._set_config_field("max_offline_peers", 1)
+        for index in range(3):
+            mock_time.time.return_value = 1000.0 + index
+            peer_infos = PeerInfos(
+                uuid=f"uuid{index}", ident=f"ident{index}", macs=[f"mac{index}"]
+            )
+            self.module._on_peer_connected(peer_infos.ident, peer_infos)
+            self.module._on_peer_disconnected(peer_infos.ident)
+
+        self.module._expire_peers()
+
+        self.assertListEqual(list(self.module.peers.keys()), ["uuid2"])
+
+    @patch("backend.cleepbus.time")
+    def test_offline_peer_expiry_max_offline_peers_without_ttl(self, mock_time):
+        self.init_session()
+        self.module._set_config_field("offline_peer_ttl", 0)
+        self.module._set_config_field("max_offline_peers", 1)
+        for index in range(3):
+            mock_time.time.return_value = 1000.0 + index
+            peer_infos = PeerInfos(
+                uuid=f"uuid{3 - index}", ident=f"ident{index}", macs=[f"mac{index}"]
+            )
+            self.module._on_peer_connected(peer_infos.ident, peer_infos)
+            self.module._on_peer_disconnected(peer_infos.ident)
+
+        self.module._expire_peers()
+
+        # oldest offline peers are removed first, whatever their uuid
+        self.assertListEqual(list(self.module.peers.keys()), ["uuid1"])
+
+    @patch("backend.cleepbus.time")
+    def test_offline_peer_expiry_flapping_peer(self, mock_time):
+        self.init_session()
+        peer_infos = self.make_peer_infos()
+        for index in range(100):
+            mock_time.time.return_value = 1000.0 + index
+            self.module._on_peer_connected(peer_infos.ident, peer_infos)
+            self.module._on_peer_disconnected(peer_infos.ident)
+
+        self.assertLessEqual(len(self.module._Cleepbus__peers_expiry), 2)
+        self.module._set_config_field("offline_peer_ttl", 60)
+        mock_time.time.return_value = 1158.0
+        self.module._expire_peers()
+        self.assertIn(peer_infos.uuid, self.module.peers)
+        mock_time.time.return_value = 1160.0
+        self.module._expire_peers()
+        self.assertNotIn(peer_infos.uuid, self.module.peers)
+
+    def test_set_peers_expiry(self):
+        self.init_session()
+        peer_infos = self.make_peer_infos()
+        self.module._on_peer_connected(peer_infos.ident, peer_infos)
+        self.module._on_peer_disconnected(peer_infos.ident)
+
+        self.module.set_peers_expiry(0, 0)
+
+        self.assertEqual(self.module._get_config_field("offline_peer_ttl"), 0)
+        self.assertEqual(self.module._get_config_field("max_offline_peers"), 0)
+        self.assertNotIn(peer_infos.uuid, self.module.peers)
+
+    def test_set_peers_expiry_check_parameters(self):
+        self.init_session()
+
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_peers_expiry(-1, 10)
+        self.assertEqual(str(cm.exception), "Offline peer ttl must be positive")
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_peers_expiry(10, -1)
+        self.assertEqual(str(cm.exception), "Max offline peers must be positive")
+
+    def test_get_bus_stats(self):
+        self.init_session()
+        online_peer = PeerInfos(uuid="123", ident="666")
+        online_peer.online = True
+        offline_peer = PeerInfos(uuid="456", ident="999")
+        self.module.peers = {"123": online_peer, "456": offline_peer}
+        mock_pyrebus.return_value.get_peer_link_stats.return_value = {"rtt": 0.01}
+        mock_pyrebus.return_value.get_stats.return_value = {"filtered": 2}
+
+        stats = self.module.get_bus_stats()
+
+        self.assertDictEqual(
+            stats,
+            {
+                "bus": {"filtered": 2},
+                "peers": {"123": {"rtt": 0.01, "throttled": 0, "sequence": None}},
+            },
+        )
+        self.assertEqual(self.module.get_peers()["123"]["link"], {"rtt": 0.01})
+        mock_pyrebus.return_value.get_peer_link_stats.assert_called_with("666")
+
+        mock_pyrebus.return_value.get_peer_link_stats = Mock()
+        mock_pyrebus.return_value.get_stats = Mock()
+
+    def test_set_inbound_rate_limit(self):
+        self.init_session()
+
+        self.module.set_inbound_rate_limit(10, 20)
+
+        self.assertEqual(self.module._get_config_field("inbound_rate"), 10)
+        self.assertEqual(self.module._get_config_field("inbound_burst"), 20)
+        mock_pyrebus.return_value.set_rate_limit.assert_called_with(10, 20)
+
+    def test_set_inbound_rate_limit_check_parameters(self):
+        self.init_session()
+
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_inbound_rate_limit(-1, 20)
+        self.assertEqual(str(cm.exception), "Rate must be positive")
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_inbound_rate_limit(10, 0)
+        self.assertEqual(str(cm.exception), "Burst must be greater than 0")
+
+    def test_set_profiling(self):
+        self.init_session()
+        profiler = mock_pyrebus.return_value.profiler
+
+        self.module.set_profiling(True, 10)
+        profiler.reset.assert_called()
+        profiler.enable.assert_called_with(10)
+        self.module.set_profiling(False)
+        profiler.disable.assert_called()
+
+        profiler.get_summary.return_value = {"poll": {"count": 1}}
+        self.assertEqual(self.module.get_profiling(), {"poll": {"count": 1}})
+        profiler.get_stacks.return_value = "run_once;poll 10"
+        self.assertEqual(self.module.get_profiling("stacks"), "run_once;poll 10")
+
+        mock_pyrebus.return_value.profiler = Mock()
+
+    def test_set_profiling_check_parameters(self):
+        self.init_session()
+
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_profiling(True, 0)
+        self.assertEqual(str(cm.exception), "Sample every must be greater than 0")
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.get_profiling("flamegraph")
+        self.assertEqual(str(cm.exception), 'Output must be "summary" or "stacks"')
+
+    def test_set_tracing(self):
+        self.init_session()
+        tracer = mock_pyrebus.return_value.tracer
+        tracer.get_spans.return_value = [{"trace_id": "123"}]
+
+        self.module.set_tracing(True)
+
+        self.assertTrue(tracer.enabled)
+        self.assertEqual(self.module.get_traces("123"), [{"trace_id": "123"}])
+        tracer.get_spans.assert_called_with("123")
+
+        mock_pyrebus.return_value.tracer = Mock()
+
+    def test_set_message_log_sampling(self):
+        self.init_session()
+
+        self.module.set_message_log_sampling(100)
+
+        self.assertEqual(self.module._get_config_field("message_log_sampling"), 100)
+        mock_pyrebus.return_value.set_message_log_sampling.assert_called_with(100)
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_message_log_sampling(-1)
+        self.assertEqual(str(cm.exception), "Sampling must be positive")
+
+    def test_set_ping_interval(self):
+        self.init_session()
+        # pings are disabled by default
+        self.assertEqual(self.module._get_config_field("ping_interval"), 0)
+
+        self.module.set_ping_interval(30)
+
+        self.assertEqual(self.module._get_config_field("ping_interval"), 30)
+        mock_pyrebus.return_value.set_ping_interval.assert_called_with(30)
+
+    def test_set_replay_window(self):
+        self.init_session()
+
+        self.module.set_replay_window(32)
+
+        self.assertEqual(self.module._get_config_field("replay_window"), 32)
+        mock_pyrebus.return_value.set_replay_window.assert_called_with(32)
+
+    def test_set_replay_window_check_parameters(self):
+        self.init_session()
+
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_replay_window(-1)
+        self.assertEqual(str(cm.exception), "Replay window must be between 0 and 256")
+        with self.assertRaises(InvalidParameter):
+            self.module.set_replay_window(257)
+
+    def test_set_reliable_events(self):
+        self.init_session()
+
+        self.module.set_reliable_events(["alarm.*", "re:doors\\..*"])
+
+        self.assertEqual(
+            self.module._get_config_field("reliable_events"),
+            ["alarm.*", "re:doors\\..*"],
+        )
+        mock_pyrebus.return_value.set_reliable_events.assert_called_with(
+            ["alarm.*", "re:doors\\..*"]
+        )
+
+    def test_set_reliable_events_check_parameters(self):
+        self.init_session()
+
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_reliable_events(["re:alarm.(sensor"])
+        self.assertEqual(
+            str(cm.exception), "Patterns must be a list of valid event patterns"
+        )
+        with self.assertRaises(InvalidParameter):
+            self.module.set_reliable_events([""])
+
+    def test_set_ping_interval_check_parameters(self):
+        self.init_session()
+
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_ping_interval(-1)
+        self.assertEqual(str(cm.exception), "Ping interval must be positive")
+
+    def test_set_static_peers(self):
+        self.init_session()
+        mock_pyrebus.return_value.is_running.return_value = True
+        self.module._start_external_bus = Mock()
+        self.module._stop_external_bus = Mock()
+
+        self.module.set_static_peers(["tcp://10.0.0.2:5680"], 5681)
+
+        self.assertEqual(
+            self.module._get_config_field("static_peers"), ["tcp://10.0.0.2:5680"]
+        )
+        self.assertEqual(self.module._get_config_field("static_port"), 5681)
+        mock_pyrebus.return_value.set_static_peers.assert_called_with(
+            ["tcp://10.0.0.2:5680"], 5681
+        )
+        self.module._start_external_bus.assert_called()
+
+        mock_pyrebus.return_value.is_running = Mock()
+
+    def test_set_static_peers_check_parameters(self):
+        self.init_session()
+
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_static_peers(["10.0.0.2"])
+        self.assertEqual(
+            str(cm.exception), "Endpoints must be a list of tcp://ip:port endpoints"
+        )
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_static_peers([], 0)
+        self.assertEqual(str(cm.exception), "Port must be a valid port number")
+
+    def test_set_discovery_profile(self):
+        self.init_session()
+        self.module._start_external_bus = Mock()
+        self.module._stop_external_bus = Mock()
+
+        self.module.set_discovery_profile("fast_failover")
+
+        self.assertEqual(
+            self.module._get_config_field("discovery_profile"), "fast_failover"
+        )
+        self.assertEqual(self.module._get_config_field("beacon_interval"), 0.5)
+        self.assertEqual(self.module._get_config_field("peer_evasive"), 2.0)
+        self.assertEqual(self.module._get_config_field("peer_expired"), 5.0)
+        mock_pyrebus.return_value.set_discovery_timers.assert_called_with(0.5, 2.0, 5.0)
+        self.assertEqual(
+            self.module.get_discovery_profiles()["fast_failover"],
+            {"interval": 0.5, "evasive": 2.0, "expired": 5.0},
+        )
+
+    def test_set_discovery_profile_check_parameters(self):
+        self.init_session()
+
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_discovery_profile("turbo")
+        self.assertEqual(
+            str(cm.exception),
+            "Profile must be one of default, dense_lan, fast_failover, low_power",
+        )
+
+    def test_set_discovery_timers(self):
+        self.init_session()
+        self.module._start_external_bus = Mock()
+        self.module._stop_external_bus = Mock()
+
+        self.module.set_discovery_timers(2.0, 8.0, 20.0)
+
+        self.assertEqual(self.module._get_config_field("discovery_profile"), "custom")
+        mock_pyrebus.return_value.set_discovery_timers.assert_called_with(
+            2.0, 8.0, 20.0
+        )
+
+    def test_set_discovery_timers_check_parameters(self):
+        self.init_session()
+
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_discovery_timers(0.0, 8.0, 20.0)
+        self.assertEqual(str(cm.exception), "Interval must be greater than 0")
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_discovery_timers(2.0, 1.0, 20.0)
+        self.assertEqual(
+            str(cm.exception), "Evasive must be greater or equal than interval"
+        )
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_discovery_timers(2.0, 8.0, 8.0)
+        self.assertEqual(str(cm.exception), "Expired must be greater than evasive")
+
     def test_on_message_received_event(self):
         self.init_session()
         peer_infos = PeerInfos(
@@ -388,6 +892,31 @@ class TestsCleepbus(unittest.TestCase):
         )
         self.assertFalse(self.module.send_event.called)
 
+    def test_on_message_received_command_timeout(self):
+        self.init_session()
+        peer_infos = self.make_peer_infos()
+        self.module.peers = {peer_infos.uuid: peer_infos}
+        msg = MessageRequest()
+        msg.command = "my_command"
+        msg.to = "dummy"
+        msg.peer_infos = peer_infos
+        self.module.send_command = Mock()
+
+        msg.timeout = 8.0
+        self.module._on_message_received(peer_infos.ident, msg)
+        self.assertEqual(self.module.send_command.call_args.args[3], 6.0)
+        msg.timeout = 4.0
+        self.module._on_message_received(peer_infos.ident, msg)
+        self.assertEqual(self.module.send_command.call_args.args[3], 5.0)
+
+        # fast link reduces network margin
+        mock_pyrebus.return_value.get_peer_link_stats.return_value = {"p99_rtt": 0.1}
+        msg.timeout = 8.0
+        self.module._on_message_received(peer_infos.ident, msg)
+        self.assertAlmostEqual(self.module.send_command.call_args.args[3], 7.5)
+
+        mock_pyrebus.return_value.get_peer_link_stats = Mock()
+
     def test_on_message_received_from_unknown_peer(self):
         self.init_session()
         peer_infos = PeerInfos(
@@ -521,14 +1050,9 @@ class TestsCleepbus(unittest.TestCase):
             }
         )
 
-        mock_pyrebus.return_value.send_message.assert_called()
-        call_args = mock_pyrebus.return_value.send_message.call_args
-        logging.debug("Call args: %s" % call_args.args[0])
-        self.assertEqual(call_args.args[0].event, "my.dummy.event")
-        self.assertEqual(call_args.args[0].params, {"param1": "value1"})
-        self.assertEqual(call_args.args[0].command_uuid, None)
-        self.assertEqual(call_args.args[0].peer_infos, None)
-        self.assertEqual(call_args.args[0].to, None)
+        mock_pyrebus.return_value.send_event.assert_called_with(
+            "my.dummy.event", {"param1": "value1"}, "mod1"
+        )
 
     def test_on_event_drop_propagate(self):
         self.init_session()
@@ -543,7 +1067,55 @@ class TestsCleepbus(unittest.TestCase):
             }
         )
 
-        self.assertFalse(mock_pyrebus.return_value.send_message.called)
+        self.assertFalse(mock_pyrebus.return_value.send_event.called)
+
+    def test_on_event_propagation_lists(self):
+        self.init_session()
+        self.module.set_propagation(
+            ["system.*", "re:sensors\\.(temperature|humidity)\\..*"],
+            ["system.secret.*"],
+        )
+
+        for event_name in (
+            "system.device.reboot",
+            "system.secret.token",
+            "sensors.temperature.update",
+            "sensors.motion.on",
+        ):
+            self.module.on_event(
+                {
+                    "startup": False,
+                    "event": event_name,
+                    "params": {},
+                    "propagate": True,
+                    "device_id": "123-456-789",
+                }
+            )
+
+        self.assertEqual(
+            [
+                call_args.args[0]
+                for call_args in mock_pyrebus.return_value.send_event.call_args_list
+            ],
+            ["system.device.reboot", "sensors.temperature.update"],
+        )
+        self.assertEqual(
+            self.module._get_config_field("propagation_deny"), ["system.secret.*"]
+        )
+
+    def test_set_propagation_check_parameters(self):
+        self.init_session()
+
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_propagation(["re:system.(device"])
+        self.assertEqual(
+            str(cm.exception), "Allow must be a list of valid event patterns"
+        )
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.set_propagation(["*"], [""])
+        self.assertEqual(
+            str(cm.exception), "Deny must be a list of valid event patterns"
+        )
 
     def test_on_event_handle_network_up(self):
         self.init_session()
@@ -561,6 +1133,7 @@ class TestsCleepbus(unittest.TestCase):
         )
 
         self.module._start_external_bus.assert_called()
+        mock_pyrebus.return_value.invalidate_mac_addresses.assert_called()
 
         mock_pyrebus.return_value.is_running = Mock()
 
@@ -604,7 +1177,194 @@ class TestsCleepbus(unittest.TestCase):
         self.assertDictEqual(msg.peer_infos.to_dict(), peer_infos.to_dict())
         self.assertEqual(msg.timeout, 8.0)
 
-    def test_send_command_to_peer_check_parameters(self):
+    @patch("backend.cleepbus.time")
+    def test_send_command_to_peer_adaptive_timeout(self, mock_time):
+        mock_time.time.return_value = 100.0
+        self.init_session()
+        peer_infos = self.make_peer_infos()
+        peer_infos.online = True
+        self.module.peers = {peer_infos.uuid: peer_infos}
+        manual_response = Mock()
+
+        for _ in range(5):
+            mock_time.time.return_value = 100.0
+            self.module._send_command_to_peer(
+                "my_command", "dummy", peer_infos.uuid, manual_response=manual_response
+            )
+            callback = mock_pyrebus.return_value.send_command_to_peer.call_args.args[2]
+            mock_time.time.return_value = 100.5
+            callback(peer_infos.ident, "response")
+        manual_response.assert_called_with("response")
+
+        self.module._send_command_to_peer("my_command", "dummy", peer_infos.uuid)
+        msg = mock_pyrebus.return_value.send_message.call_args.args[0]
+        self.assertEqual(msg.timeout, 3.5)
+
+        # slow peer gets longer timeout, clamped to max
+        for _ in range(5):
+            self.module.command_timeouts.add_sample(peer_infos.uuid, "slow", 9.0)
+        self.module._send_command_to_peer("slow", "dummy", peer_infos.uuid)
+        msg = mock_pyrebus.return_value.send_message.call_args.args[0]
+        self.assertEqual(msg.timeout, 27.0)
+        self.module.command_timeouts.add_sample(peer_infos.uuid, "slow", 20.0)
+        self.module._send_command_to_peer("slow", "dummy", peer_infos.uuid)
+        msg = mock_pyrebus.return_value.send_message.call_args.args[0]
+        self.assertEqual(msg.timeout, 30.0)
+
+    @patch("backend.cleepbus.time")
+    def test_send_command_to_peer_timed_out(self, mock_time):
+        mock_time.time.return_value = 100.0
+        self.init_session()
+        peer_infos = self.make_peer_infos()
+        peer_infos.online = True
+        self.module.peers = {peer_infos.uuid: peer_infos}
+        mock_pyrebus.return_value.is_running.return_value = False
+        self.module._send_command_to_peer(
+            "my_command", "dummy", peer_infos.uuid, manual_response=Mock()
+        )
+
+        mock_time.time.return_value = 107.0
+        self.module._on_process()
+        self.module._send_command_to_peer("my_command", "dummy", peer_infos.uuid)
+        msg = mock_pyrebus.return_value.send_message.call_args.args[0]
+        self.assertEqual(msg.timeout, 8.0)
+
+        mock_time.time.return_value = 108.0
+        self.module._on_process()
+        self.module._send_command_to_peer("my_command", "dummy", peer_infos.uuid)
+        msg = mock_pyrebus.return_value.send_message.call_args.args[0]
+        self.assertEqual(msg.timeout, 16.0)
+
+    @patch("backend.cleepbus.time")
+    def test_send_command_to_peer_without_response_support(self, mock_time):
+        mock_time.time.return_value = 100.0
+        self.init_session()
+        peer_infos = self.make_peer_infos()
+        peer_infos.online = True
+        self.module.peers = {peer_infos.uuid: peer_infos}
+        mock_pyrebus.return_value.is_running.return_value = False
+        mock_pyrebus.return_value.send_command_to_peer.return_value = None
+        manual_response = Mock()
+
+        self.module._send_command_to_peer(
+            "my_command", "dummy", peer_infos.uuid, manual_response=manual_response
+        )
+
+        # command is sent without response, its duration is not measured
+        mock_pyrebus.return_value.send_message.assert_called_once_with(
+            ANY, 8.0, manual_response
+        )
+        mock_time.time.return_value = 200.0
+        self.module._on_process()
+        self.assertEqual(
+            self.module.command_timeouts.get_timeout(peer_infos.uuid, "my_command"),
+            8.0,
+        )
+
+    @patch("backend.pyrebus.zmq")
+    def test_send_command_to_peer_round_trip(self, mock_zmq):
+        self.init_session()
+        registry = LoopbackRegistry()
+        context = FakeContext()
+        buses = []
+        for uuid_value in ("uuid1", "uuid2"):
+            bus = LoopbackBus(
+                Mock(),
+                Mock(),
+                Mock(),
+                lambda infos: PeerInfos(uuid=infos["uuid"]),
+                False,
+                Mock(),
+                registry=registry,
+            )
+            bus.context = context
+            bus.start({"uuid": uuid_value}, "TESTBUS", "CLEEP")
+            buses.append(bus)
+        bus1, bus2 = buses
+        for bus in buses:
+            while bus.node_socket.poll():
+                bus._message_to_receive_from_pipe()
+        bus2.on_message_received.return_value = Mock(error=False, message="", data=2)
+        self.module.external_bus = bus1
+        peer_infos = PeerInfos(uuid="uuid2", ident=str(bus2.node.uuid()))
+        peer_infos.online = True
+        self.module.peers = {"uuid2": peer_infos}
+        manual_response = Mock()
+
+        self.module._send_command_to_peer(
+            "my_command", "dummy", "uuid2", manual_response=manual_response
+        )
+        bus1._message_to_send_to_pipe()
+        for bus in (bus2, bus1):
+            while bus.node_socket.poll():
+                bus._message_to_receive_from_pipe()
+
+        self.assertEqual(
+            bus2.on_message_received.call_args.args[1].command, "my_command"
+        )
+        manual_response.assert_called_once_with(
+            {"error": False, "message": "", "data": 2}
+        )
+        # real duration is recorded, not a timeout
+        timeouts = self.module.command_timeouts
+        self.assertEqual(
+            len(timeouts._AdaptiveTimeout__samples[("uuid2", "my_command")]), 1
+        )
+        self.assertEqual(timeouts._AdaptiveTimeout__censored, {})
+        self.assertEqual(self.module._Cleepbus__pending_commands, {})
+
+    @patch("backend.cleepbus.time")
+    def test_send_command_to_all(self, mock_time):
+        mock_time.time.return_value = 100.0
+        self.init_session()
+        peer_infos = self.make_peer_infos()
+        peer_infos.online = True
+        self.module.peers = {peer_infos.uuid: peer_infos}
+        request = BroadcastRequest(1, {peer_infos.ident: 108.0, "unknown": 108.0})
+
+        def send_command_to_all(message, timeout, quorum, on_response):
+            self.assertEqual(timeout(peer_infos.ident), 8.0)
+            request.on_response = on_response
+            mock_time.time.return_value = 100.5
+            request.add_response(peer_infos.ident, {"error": False, "data": 1})
+            request.expire(108.0)
+            return request
+
+        mock_pyrebus.return_value.send_command_to_all.side_effect = send_command_to_all
+
+        with patch.object(self.module.command_timeouts, "add_sample") as add_sample:
+            result = self.module.send_command_to_all(
+                "my_command", "dummy", {"param1": "value1"}
+            )
+
+        self.assertDictEqual(
+            result,
+            {
+                "responses": {peer_infos.uuid: {"error": False, "data": 1}},
+                "missing": ["unknown"],
+            },
+        )
+        message = mock_pyrebus.return_value.send_command_to_all.call_args.args[0]
+        self.assertEqual(message.command, "my_command")
+        self.assertEqual(message.to, "dummy")
+        self.assertIsNone(message.peer_infos)
+        add_sample.assert_called_once_with(peer_infos.uuid, "my_command", 0.5)
+        mock_pyrebus.return_value.send_command_to_all.side_effect = None
+
+    def test_send_command_to_all_check_parameters(self):
+        self.init_session()
+
+        with self.assertRaises(MissingParameter) as cm:
+            self.module.send_command_to_all(None, "dummy")
+        self.assertEqual(str(cm.exception), 'Parameter "command" is missing')
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.send_command_to_all("my_command", "dummy", timeout=1.0)
+        self.assertEqual(str(cm.exception), "Timeout must be greater than 3.0 seconds")
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.send_command_to_all("my_command", "dummy", quorum=0)
+        self.assertEqual(str(cm.exception), "Quorum must be greater than 0")
+
+    def test_send_command_to_peer_check_parameters(self):
         self.init_session()
         peer_infos = self.make_peer_infos()
         peer_infos.online = True
@@ -664,6 +1424,136 @@ class TestsCleepbus(unittest.TestCase):
         )
         peer_infos.online = True
 
+    def test_send_file_to_peer(self):
+        self.init_session()
+        peer_infos = self.make_peer_infos()
+        peer_infos.online = True
+        self.module.peers = {
+            peer_infos.uuid: peer_infos,
+        }
+        mock_pyrebus.return_value.STREAM_CHUNK_SIZE = 4
+        chunks = []
+        mock_pyrebus.return_value.send_stream.side_effect = (
+            lambda ident, data, infos: chunks.extend(data) or len(chunks)
+        )
+        filepath = "/tmp/cleepbus_test_send.bin"
+        with open(filepath, "wb") as fd:
+            fd.write(b"0123456789")
+
+        try:
+            self.assertEqual(
+                self.module.send_file_to_peer(peer_infos.uuid, filepath), 3
+            )
+        finally:
+            os.remove(filepath)
+
+        self.assertListEqual(chunks, [b"0123", b"4567", b"89"])
+        mock_pyrebus.return_value.send_stream.assert_called_with(
+            peer_infos.ident, ANY, {"name": "cleepbus_test_send.bin", "size": 10}
+        )
+        mock_pyrebus.return_value.send_stream.side_effect = None
+
+    def test_send_file_to_peer_stream_error(self):
+        self.init_session()
+        peer_infos = self.make_peer_infos()
+        peer_infos.online = True
+        self.module.peers = {
+            peer_infos.uuid: peer_infos,
+        }
+        mock_pyrebus.return_value.send_stream.side_effect = BusStreamError("timeout")
+
+        with self.assertRaises(CommandError) as cm:
+            self.module.send_file_to_peer(peer_infos.uuid, __file__)
+        self.assertEqual(str(cm.exception), "Unable to send file: timeout")
+
+        mock_pyrebus.return_value.send_stream.side_effect = None
+
+    def test_send_file_to_peer_check_parameters(self):
+        self.init_session()
+        peer_infos = self.make_peer_infos()
+        peer_infos.online = False
+        self.module.peers = {
+            peer_infos.uuid: peer_infos,
+        }
+
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.send_file_to_peer(peer_infos.uuid, __file__)
+        self.assertEqual(
+            str(cm.exception),
+            f'Specified peer "{peer_infos.uuid}" does not exist or is not online',
+        )
+        peer_infos.online = True
+        with self.assertRaises(InvalidParameter) as cm:
+            self.module.send_file_to_peer(peer_infos.uuid, "/dummy/file")
+        self.assertEqual(str(cm.exception), 'File "/dummy/file" does not exist')
+
+    def test_on_stream_received_unknown_peer(self):
+        self.init_session()
+
+        with self.assertRaises(Exception):
+            self.module._on_stream_received("111-111-111", Mock())
+
+    def init_cleep_filesystem(self):
+        self.module.cleep_filesystem.open.side_effect = open
+        self.module.cleep_filesystem.close.side_effect = lambda fd: fd.close()
+        self.module.cleep_filesystem.rm.side_effect = os.remove
+
+    def test_on_stream_received_too_big(self):
+        self.init_session()
+        peer_infos = self.make_peer_infos()
+        self.module.peers = {peer_infos.uuid: peer_infos}
+        stream = Mock(infos={"size": Cleepbus.MAX_RECEIVED_FILE_SIZE + 1})
+
+        with self.assertRaises(Exception) as cm:
+            self.module._on_stream_received(peer_infos.ident, stream)
+        self.assertIn("is too big", str(cm.exception))
+
+    def test_receive_stream_to_file(self):
+        self.init_session()
+        self.init_cleep_filesystem()
+        self.module.file_received_event = Mock()
+        stream = Mock()
+        stream.__iter__ = Mock(return_value=iter([b"abc", b"def"]))
+        stream.infos = {"name": "file.bin"}
+
+        self.module._receive_stream_to_file("123-456-789", stream)
+
+        self.module.file_received_event.send.assert_called_with(
+            {"peer_uuid": "123-456-789", "filepath": ANY, "infos": {"name": "file.bin"}}
+        )
+        filepath = self.module.file_received_event.send.call_args[0][0]["filepath"]
+        with open(filepath, "rb") as fd:
+            self.assertEqual(fd.read(), b"abcdef")
+        os.remove(filepath)
+
+    def test_receive_stream_to_file_error(self):
+        self.init_session()
+        self.init_cleep_filesystem()
+        self.module.file_received_event = Mock()
+        stream = Mock()
+        stream.__iter__ = Mock(side_effect=BusStreamError("aborted"))
+
+        self.module._receive_stream_to_file("123-456-789", stream)
+
+        self.assertFalse(self.module.file_received_event.send.called)
+        filepath = self.module.cleep_filesystem.rm.call_args[0][0]
+        self.assertFalse(os.path.exists(filepath))
+
+    @patch.object(Cleepbus, "MAX_RECEIVED_FILE_SIZE", 5)
+    def test_receive_stream_to_file_too_big(self):
+        self.init_session()
+        self.init_cleep_filesystem()
+        self.module.file_received_event = Mock()
+        stream = Mock()
+        stream.__iter__ = Mock(return_value=iter([b"abc", b"def"]))
+
+        self.module._receive_stream_to_file("123-456-789", stream)
+
+        self.assertFalse(self.module.file_received_event.send.called)
+        self.assertTrue(stream.cancel.called)
+        filepath = self.module.cleep_filesystem.rm.call_args[0][0]
+        self.assertFalse(os.path.exists(filepath))
+
     def test_send_event_to_peer(self):
         self.init_session()
         peer_infos = self.make_peer_infos()
@@ -745,7 +1635,7 @@ class TestsFunctionnalCleepbus(unittest.TestCase):
 
         mock_shout.assert_called()
         call_args = mock_shout.call_args[0]
-        call_args_dict = json.loads(call_args[1].decode("utf8"))
+        call_args_dict = json.loads(call_args[1][0].decode("utf8"))
         logging.debug("Call args: %s" % call_args_dict)
         self.assertDictEqual(
             call_args_dict,
@@ -787,7 +1677,7 @@ class TestsFunctionnalCleepbus(unittest.TestCase):
 
         mock_whisper.assert_called_with(UUID(peer_ident), ANY)
         call_args = mock_whisper.call_args[0]
-        call_args_dict = json.loads(call_args[1].decode("utf8"))
+        call_args_dict = json.loads(call_args[1][0].decode("utf8"))
         logging.debug("Call args: %s" % call_args_dict)
         self.maxDiff = None
         self.assertDictEqual(
@@ -968,6 +1858,49 @@ class TestsPyrebus(unittest.TestCase):
 
         self.assertListEqual(macs, ["00:0c:29:20:7d:5f"])
 
+    @patch("backend.pyrebus.zhelper_get_ifaddrs")
+    def test_get_mac_addresses_cached(self, mock_getifaddrs):
+        mock_getifaddrs.return_value = self.GET_IFADDRS
+        self.init_lib()
+
+        with patch.object(
+            PyreBus, "get_interfaces_fingerprint", return_value=(("eth0", ()),)
+        ):
+            self.lib.get_mac_addresses()
+            macs = self.lib.get_mac_addresses()
+
+        self.assertListEqual(macs, ["00:0c:29:20:7d:5f"])
+        self.assertEqual(mock_getifaddrs.call_count, 1)
+
+    @patch("backend.pyrebus.zhelper_get_ifaddrs")
+    def test_get_mac_addresses_interfaces_changed(self, mock_getifaddrs):
+        mock_getifaddrs.return_value = self.GET_IFADDRS
+        self.init_lib()
+
+        with patch.object(
+            PyreBus,
+            "get_interfaces_fingerprint",
+            side_effect=[(("eth0", ()),), (("eth0", ("192.168.1.2",)),)],
+        ):
+            self.lib.get_mac_addresses()
+            self.lib.get_mac_addresses()
+
+        self.assertEqual(mock_getifaddrs.call_count, 2)
+
+    @patch("backend.pyrebus.zhelper_get_ifaddrs")
+    def test_get_mac_addresses_invalidated(self, mock_getifaddrs):
+        mock_getifaddrs.return_value = self.GET_IFADDRS
+        self.init_lib()
+
+        with patch.object(
+            PyreBus, "get_interfaces_fingerprint", return_value=(("eth0", ()),)
+        ):
+            self.lib.get_mac_addresses()
+            self.lib.invalidate_mac_addresses()
+            self.lib.get_mac_addresses()
+
+        self.assertEqual(mock_getifaddrs.call_count, 2)
+
     @patch("backend.pyrebus.Pyre")
     @patch("backend.pyrebus.zmq")
     def test_start(self, mock_zmq, mock_pyre):
@@ -979,7 +1912,7 @@ class TestsPyrebus(unittest.TestCase):
         self.assertEqual(self.lib._PyreBus__bus_channel, "TESTCHANNEL")
         mock_zmq.Context.assert_called()
         self.assertEqual(mock_zmq.Context.return_value.socket.call_count, 2)
-        mock_pyre.assert_called_with("TESTBUS")
+        mock_pyre.assert_called_with("TESTBUS", ctx=mock_zmq.Context.return_value)
         mock_pyre.return_value.join.assert_called_with("TESTCHANNEL")
         mock_pyre.return_value.set_header.assert_called_with("field1", "value1")
         mock_pyre.return_value.start.assert_called()
@@ -1026,6 +1959,102 @@ class TestsPyrebus(unittest.TestCase):
             str(cm.exception), 'Parameter "bus_channel" is not specified or invalid'
         )
 
+    @patch("backend.pyrebus.Pyre")
+    @patch("backend.pyrebus.zmq")
+    def test_start_multiple_channels(self, mock_zmq, mock_pyre):
+        self.init_lib()
+
+        self.lib.start({"field1": "value1"}, "TESTBUS", ["CHANNEL1", "CHANNEL2"])
+
+        self.assertEqual(self.lib._PyreBus__bus_channel, "CHANNEL1")
+        self.assertListEqual(self.lib._PyreBus__bus_channels, ["CHANNEL1", "CHANNEL2"])
+        self.assertEqual(mock_pyre.return_value.join.call_count, 2)
+        mock_pyre.return_value.join.assert_any_call("CHANNEL1")
+        mock_pyre.return_value.join.assert_any_call("CHANNEL2")
+
+    @patch("backend.unicastnode.UnicastNode")
+    @patch("backend.pyrebus.Pyre")
+    @patch("backend.pyrebus.zmq")
+    def test_start_static_peers(self, mock_zmq, mock_pyre, mock_unicast):
+        self.init_lib()
+        mock_unicast.return_value.endpoint.return_value = "tcp://10.0.0.1:5681"
+
+        self.lib.set_static_peers(["tcp://10.0.0.2:5680"], 5681)
+        self.lib.start({"field1": "value1"}, "TESTBUS", "TESTCHANNEL")
+
+        self.assertFalse(mock_pyre.called)
+        mock_unicast.assert_called_with(
+            "TESTBUS",
+            self.lib.context,
+            ["tcp://10.0.0.2:5680"],
+            port=5681,
+            interval=mock_unicast.INTERVAL,
+            expired=mock_unicast.EXPIRED,
+        )
+        mock_unicast.return_value.join.assert_called_with("TESTCHANNEL")
+        mock_unicast.return_value.start.assert_called()
+
+    @patch("backend.pyrebus.pyre_zbeacon")
+    @patch("backend.pyrebus.Pyre")
+    @patch("backend.pyrebus.zmq")
+    def test_start_discovery_timers(self, mock_zmq, mock_pyre, mock_zbeacon):
+        self.init_lib()
+
+        self.lib.set_discovery_timers(0.5, 2.0, 5.0)
+        self.lib.start({"field1": "value1"}, "TESTBUS", "TESTCHANNEL")
+
+        mock_pyre.return_value.set_interval.assert_called_with(500)
+        mock_pyre.return_value.set_evasive_timeout.assert_called_with(2000)
+        mock_pyre.return_value.set_expired_timeout.assert_called_with(5000)
+
+    @patch("backend.pyrebus.pyre_zbeacon")
+    @patch("backend.pyrebus.PyrePeer")
+    def test_set_node_timers_pyre_peer(self, mock_pyre_peer, mock_zbeacon):
+        self.init_lib()
+        node = Mock(spec=["set_interval"])
+
+        self.lib.set_discovery_timers(5.0, 20.0, 60.0)
+        self.lib._set_node_timers(node)
+
+        node.set_interval.assert_called_with(5000)
+        self.assertEqual(mock_zbeacon.INTERVAL_DFLT, 5.0)
+        self.assertEqual(mock_pyre_peer.PEER_EVASIVE, 20.0)
+        self.assertEqual(mock_pyre_peer.PEER_EXPIRED, 60.0)
+
+    @patch("backend.pyrebus.pyre_zbeacon")
+    @patch("backend.pyrebus.PyrePeer")
+    def test_set_node_timers_pyre_peer_restored(self, mock_pyre_peer, mock_zbeacon):
+        self.init_lib()
+        mock_zbeacon.INTERVAL_DFLT = 1.0
+        mock_pyre_peer.PEER_EVASIVE = 10.0
+        mock_pyre_peer.PEER_EXPIRED = 30.0
+        node = Mock(spec=[])
+        self.lib.set_discovery_timers(5.0, 20.0, 60.0)
+        self.lib._set_node_timers(node)
+        self.lib.set_discovery_timers(2.0, 0, 0)
+        self.lib._set_node_timers(node)
+
+        self.lib.set_discovery_timers(0, 0, 0)
+        self.lib._set_node_timers(node)
+
+        self.assertEqual(mock_zbeacon.INTERVAL_DFLT, 1.0)
+        self.assertEqual(mock_pyre_peer.PEER_EVASIVE, 10.0)
+        self.assertEqual(mock_pyre_peer.PEER_EXPIRED, 30.0)
+
+    def test_start_check_channels_parameter(self):
+        self.init_lib()
+
+        with self.assertRaises(Exception) as cm:
+            self.lib.start({"field": "value"}, "bus", [])
+        self.assertEqual(
+            str(cm.exception), 'Parameter "bus_channel" is not specified or invalid'
+        )
+        with self.assertRaises(Exception) as cm:
+            self.lib.start({"field": "value"}, "bus", ["CHANNEL1", ""])
+        self.assertEqual(
+            str(cm.exception), 'Parameter "bus_channel" is not specified or invalid'
+        )
+
     @patch("backend.pyrebus.Pyre")
     @patch("backend.pyrebus.zmq")
     def test_is_running(self, mock_zmq, mock_pyre):
@@ -1046,29 +2075,83 @@ class TestsPyrebus(unittest.TestCase):
 
         self.lib.stop()
 
-        mock_pipein.send.assert_called_with(b'"%s"' % self.lib.BUS_STOP.encode("utf8"))
-        mock_pipein.close.assert_called()
-        mock_pipeout.close.assert_called()
+        self.assertFalse(mock_pipein.send.called)
+        self.assertFalse(mock_pipein.close.called)
+        self.assertFalse(mock_pipeout.close.called)
+        self.assertIs(self.lib.pipe_in, mock_pipein)
         mock_node.stop.assert_called()
+        mock_node._ctx.destroy.assert_called_with(linger=0)
+        self.assertIsNone(self.lib.node)
         self.assertEqual(self.lib._PyreBus__externalbus_configured, False)
 
-    def test_stop_exception(self):
+    def test_stop_loop_running_in_other_thread(self):
         self.init_lib()
         mock_pipein = Mock()
         self.lib.pipe_in = mock_pipein
-        mock_pipeout = Mock()
-        self.lib.pipe_out = mock_pipeout
+        self.lib.pipe_out = Mock()
+        self.lib.node = Mock()
+        self.lib._PyreBus__loop_thread = -1
+
+        self.lib.stop()
+
+        mock_pipein.send.assert_called_with(b'"%s"' % self.lib.BUS_STOP.encode("utf8"))
+
+    def test_stop_exception(self):
+        self.init_lib()
+        self.lib.pipe_in = Mock()
+        self.lib.pipe_out = Mock()
         mock_node = Mock()
         mock_node.stop.side_effect = Exception("Test exception")
         self.lib.node = mock_node
 
         self.lib.stop()
 
-        mock_pipein.send.assert_called_with(b'"%s"' % self.lib.BUS_STOP.encode("utf8"))
-        mock_pipein.close.assert_called()
-        mock_pipeout.close.assert_called()
+        self.assertIsNone(self.lib.node)
         self.assertEqual(self.lib._PyreBus__externalbus_configured, False)
 
+    def test_stop_not_started(self):
+        self.init_lib()
+        self.lib.pipe_in = Mock()
+
+        self.lib.stop()
+
+        self.assertFalse(self.lib.pipe_in.send.called)
+
+    @patch("backend.pyrebus.Pyre")
+    @patch("backend.pyrebus.zmq")
+    def test_restart_reuses_context_and_pipe(self, mock_zmq, mock_pyre):
+        self.init_lib()
+        self.lib.start({"field1": "value1"}, "TESTBUS", "TESTCHANNEL")
+        pipe_in = self.lib.pipe_in
+        pipe_out = self.lib.pipe_out
+        pipe_out.poll.side_effect = [1, 1, 0]
+
+        self.lib.stop()
+        self.lib.start({"field1": "value1"}, "TESTBUS", "TESTCHANNEL")
+
+        mock_zmq.Context.assert_called_once()
+        self.assertEqual(mock_zmq.Context.return_value.socket.call_count, 2)
+        self.assertIs(self.lib.pipe_in, pipe_in)
+        self.assertIs(self.lib.pipe_out, pipe_out)
+        self.assertEqual(pipe_out.recv_multipart.call_count, 2)
+        self.assertEqual(mock_pyre.call_count, 2)
+        self.assertTrue(self.lib.is_running())
+
+    @patch("backend.pyrebus.Pyre")
+    @patch("backend.pyrebus.zmq")
+    def test_close(self, mock_zmq, mock_pyre):
+        self.init_lib()
+        self.lib.start({"field1": "value1"}, "TESTBUS", "TESTCHANNEL")
+        pipe_in = self.lib.pipe_in
+
+        self.lib.close()
+
+        pipe_in.close.assert_called()
+        mock_zmq.Context.return_value.term.assert_called()
+        self.assertIsNone(self.lib.pipe_in)
+        self.assertIsNone(self.lib.context)
+        self.assertFalse(self.lib.is_running())
+
     @patch("backend.pyrebus.zmq")
     def test_run_once_message_to_send(self, mock_zmq):
         mock_zmq.POLLIN = "POLLIN"
@@ -1159,6 +2242,7 @@ class TestsPyrebus(unittest.TestCase):
         self.init_lib()
         self.lib._PyreBus__bus_name = "TESTBUS"
         self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
         ident = "12345678-1234-5678-1234-567812345678"
         message = {
             "command": "acommand",
@@ -1192,72 +2276,240 @@ class TestsPyrebus(unittest.TestCase):
             },
         )
 
-    def test_message_to_receive_from_pipe_whisper(self):
+    def test_message_to_receive_from_pipe_shout_filtered_event(self):
         self.init_lib()
         self.lib._PyreBus__bus_name = "TESTBUS"
         self.lib._PyreBus__bus_channel = "TESTCHANNEL"
-        ident = "12345678-1234-5678-1234-567812345678"
-        message = {
-            "command": "acommand",
-            "params": {"key1": "val1"},
-            "to": "dummy",
-        }
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
+        self.lib.set_event_filter(["system.*"])
         mock_node = Mock()
         mock_node.recv.return_value = [
-            b"WHISPER",
+            b"SHOUT",
             b"\x12\x34\x56\x78" * 4,
             b"TESTBUS",
-            json.dumps(message).encode(),
+            b"TESTCHANNEL",
+            b"invalid json content never decoded",
+            b"E|alarm.alarm.triggered",
         ]
         self.lib.node = mock_node
 
         self.assertTrue(self.lib._message_to_receive_from_pipe())
-        logging.debug("Messages: %s" % self.messages)
 
-        self.assertEqual(len(self.peers), 0)
-        self.assertEqual(len(self.messages), 1)
-        self.assertEqual(self.messages[0]["peer_id"], ident)
-        self.assertDictEqual(
-            self.messages[0]["message"].to_dict(),
-            {
-                "broadcast": ANY,
-                "command": message["command"],
-                "params": message["params"],
-                "to": message["to"],
-                "sender": None,
-            },
-        )
+        self.assertEqual(len(self.messages), 0)
+        self.assertEqual(self.lib.get_stats()["filtered"], 1)
 
-    def test_message_to_receive_from_pipe_enter(self):
+    def test_message_to_receive_from_pipe_shout_accepted_event(self):
         self.init_lib()
         self.lib._PyreBus__bus_name = "TESTBUS"
         self.lib._PyreBus__bus_channel = "TESTCHANNEL"
-        ident = "12345678-1234-5678-1234-567812345678"
-        infos = PeerInfos()
-        infos.info1 = "info1"
-        infos.info2 = "info2"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
+        self.lib.set_event_filter(["system.*"])
+        message = {"event": "system.device.reboot", "params": {}}
         mock_node = Mock()
         mock_node.recv.return_value = [
-            b"ENTER",
+            b"SHOUT",
             b"\x12\x34\x56\x78" * 4,
             b"TESTBUS",
-            json.dumps(infos.to_dict()).encode(),
+            b"TESTCHANNEL",
+            json.dumps(message).encode(),
+            b"E|system.device.reboot",
         ]
-        mock_node.peer_address.return_value = "http://192.168.1.1"
         self.lib.node = mock_node
 
         self.assertTrue(self.lib._message_to_receive_from_pipe())
-        logging.debug("Peers: %s" % self.peers)
+
+        self.assertEqual(len(self.messages), 1)
+        self.assertEqual(self.messages[0]["message"].event, "system.device.reboot")
+        self.assertEqual(self.lib.get_stats()["filtered"], 0)
+
+    def test_message_to_receive_from_pipe_whisper_compressed(self):
+        self.init_lib()
+        self.lib._PyreBus__bus_name = "TESTBUS"
+        message = {
+            "command": "acommand",
+            "params": {"data": "a" * 10000},
+            "to": "dummy",
+        }
+        mock_node = Mock()
+        mock_node.recv.return_value = [
+            b"WHISPER",
+            b"\x12\x34\x56\x78" * 4,
+            b"TESTBUS",
+            zlib.compress(json.dumps(message).encode()),
+            b"C|acommand|z",
+        ]
+        self.lib.node = mock_node
+
+        self.assertTrue(self.lib._message_to_receive_from_pipe())
+
+        self.assertEqual(len(self.messages), 1)
+        self.assertDictEqual(self.messages[0]["message"].params, message["params"])
+        self.assertEqual(self.lib.get_stats()["compression"]["decompressed"], 1)
+
+    def test_message_to_receive_from_pipe_whisper(self):
+        self.init_lib()
+        self.lib._PyreBus__bus_name = "TESTBUS"
+        self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
+        ident = "12345678-1234-5678-1234-567812345678"
+        message = {
+            "command": "acommand",
+            "params": {"key1": "val1"},
+            "to": "dummy",
+        }
+        mock_node = Mock()
+        mock_node.recv.return_value = [
+            b"WHISPER",
+            b"\x12\x34\x56\x78" * 4,
+            b"TESTBUS",
+            json.dumps(message).encode(),
+        ]
+        self.lib.node = mock_node
+
+        self.assertTrue(self.lib._message_to_receive_from_pipe())
+        logging.debug("Messages: %s" % self.messages)
+
+        self.assertEqual(len(self.peers), 0)
+        self.assertEqual(len(self.messages), 1)
+        self.assertEqual(self.messages[0]["peer_id"], ident)
+        self.assertDictEqual(
+            self.messages[0]["message"].to_dict(),
+            {
+                "broadcast": ANY,
+                "command": message["command"],
+                "params": message["params"],
+                "to": message["to"],
+                "sender": None,
+            },
+        )
+
+    def test_message_to_receive_from_pipe_enter(self):
+        self.init_lib()
+        self.lib._PyreBus__bus_name = "TESTBUS"
+        self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
+        ident = "12345678-1234-5678-1234-567812345678"
+        infos = PeerInfos()
+        infos.info1 = "info1"
+        infos.info2 = "info2"
+        mock_node = Mock()
+        mock_node.recv.return_value = [
+            b"ENTER",
+            b"\x12\x34\x56\x78" * 4,
+            b"TESTBUS",
+            json.dumps(infos.to_dict()).encode(),
+        ]
+        mock_node.peer_address.return_value = "http://192.168.1.1"
+        self.lib.node = mock_node
+
+        self.assertTrue(self.lib._message_to_receive_from_pipe())
+        logging.debug("Peers: %s" % self.peers)
 
         self.assertEqual(len(self.messages), 0)
         self.assertEqual(len(list(self.peers.keys())), 1)
         self.assertDictEqual(self.peers[ident].to_dict(), self.peer_infos.to_dict())
         self.assertTrue(self.online[ident])
 
+    def test_message_to_receive_from_pipe_enter_save_subscriptions(self):
+        self.init_lib()
+        self.lib._PyreBus__bus_name = "TESTBUS"
+        self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
+        mock_node = Mock()
+        mock_node.recv.return_value = [
+            b"ENTER",
+            b"\x12\x34\x56\x78" * 4,
+            b"TESTBUS",
+            json.dumps({"subscriptions": '["system.*"]'}).encode(),
+        ]
+        mock_node.peer_address.return_value = "http://192.168.1.1"
+        self.lib.node = mock_node
+
+        self.assertTrue(self.lib._message_to_receive_from_pipe())
+
+        bus_peer = self.lib.peers[self.peer_infos.ident]
+        self.assertTrue(bus_peer.is_interested("system.device.reboot"))
+        self.assertFalse(bus_peer.is_interested("alarm.alarm.triggered"))
+
+    def test_message_to_receive_from_pipe_shout_secondary_channel(self):
+        self.init_lib()
+        self.lib._PyreBus__bus_name = "TESTBUS"
+        self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL", "FLOOR1"]
+        self.lib.stats["channels"] = {
+            "TESTCHANNEL": {"received": 0, "sent": 0},
+            "FLOOR1": {"received": 0, "sent": 0},
+        }
+        message = {"event": "light.light.on", "params": {}}
+        mock_node = Mock()
+        mock_node.recv.return_value = [
+            b"SHOUT",
+            b"\x12\x34\x56\x78" * 4,
+            b"TESTBUS",
+            b"FLOOR1",
+            json.dumps(message).encode(),
+        ]
+        self.lib.node = mock_node
+
+        self.assertTrue(self.lib._message_to_receive_from_pipe())
+
+        self.assertEqual(len(self.messages), 1)
+        self.assertEqual(self.lib.get_stats()["channels"]["FLOOR1"]["received"], 1)
+        self.assertEqual(self.lib.get_stats()["channels"]["TESTCHANNEL"]["received"], 0)
+
+    def test_message_to_receive_from_pipe_join_leave(self):
+        self.init_lib()
+        self.lib._PyreBus__bus_name = "TESTBUS"
+        ident = "12345678-1234-5678-1234-567812345678"
+        self.lib.peers = {ident: self.lib._make_bus_peer(ident, {})}
+        mock_node = Mock()
+        mock_node.recv.return_value = [
+            b"JOIN",
+            b"\x12\x34\x56\x78" * 4,
+            b"TESTBUS",
+            b"FLOOR1",
+        ]
+        self.lib.node = mock_node
+
+        self.assertTrue(self.lib._message_to_receive_from_pipe())
+        self.assertSetEqual(self.lib.peers[ident].groups, {"FLOOR1"})
+
+        mock_node.recv.return_value = [
+            b"LEAVE",
+            b"\x12\x34\x56\x78" * 4,
+            b"TESTBUS",
+            b"FLOOR1",
+        ]
+        self.assertTrue(self.lib._message_to_receive_from_pipe())
+        self.assertSetEqual(self.lib.peers[ident].groups, set())
+
+    @patch("backend.pyrebus.time")
+    def test_message_to_receive_from_pipe_update_last_seen(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        self.init_lib()
+        self.lib._PyreBus__bus_name = "TESTBUS"
+        ident = "12345678-1234-5678-1234-567812345678"
+        self.lib.peers = {ident: self.lib._make_bus_peer(ident, {})}
+        mock_node = Mock()
+        mock_node.recv.return_value = [
+            b"JOIN",
+            b"\x12\x34\x56\x78" * 4,
+            b"TESTBUS",
+            b"FLOOR1",
+        ]
+        self.lib.node = mock_node
+        mock_time.time.return_value = 1010.0
+
+        self.assertTrue(self.lib._message_to_receive_from_pipe())
+
+        self.assertEqual(self.lib.get_peer_last_seen(ident), 1010.0)
+        self.assertIsNone(self.lib.get_peer_last_seen("unknown"))
+
     def test_message_to_receive_from_pipe_exit(self):
         self.init_lib()
         self.lib._PyreBus__bus_name = "TESTBUS"
         self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
         ident = "12345678-1234-5678-1234-567812345678"
         infos = PeerInfos()
         infos.info1 = "info1"
@@ -1280,6 +2532,7 @@ class TestsPyrebus(unittest.TestCase):
         self.init_lib()
         self.lib._PyreBus__bus_name = "TESTBUS"
         self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
         ident = "12345678-1234-5678-1234-567812345678"
         infos = PeerInfos()
         infos.info1 = "info1"
@@ -1301,6 +2554,7 @@ class TestsPyrebus(unittest.TestCase):
         self.init_lib()
         self.lib._PyreBus__bus_name = "TESTBUS"
         self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
         ident = "12345678-1234-5678-1234-567812345678"
         message = {
             "command": "acommand",
@@ -1327,6 +2581,7 @@ class TestsPyrebus(unittest.TestCase):
         self.init_lib()
         self.lib._PyreBus__bus_name = "TESTBUS"
         self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
         ident = "12345678-1234-5678-1234-567812345678"
         message = {
             "command": "acommand",
@@ -1353,6 +2608,7 @@ class TestsPyrebus(unittest.TestCase):
         self.init_lib()
         self.lib._PyreBus__bus_name = "TESTBUS"
         self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
         ident = "12345678-1234-5678-1234-567812345678"
         infos = PeerInfos()
         infos.info1 = "info1"
@@ -1377,6 +2633,7 @@ class TestsPyrebus(unittest.TestCase):
         self.init_lib()
         self.lib._PyreBus__bus_name = "TESTBUS"
         self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
         ident = "12345678-1234-5678-1234-567812345678"
         infos = PeerInfos()
         infos.info1 = "info1"
@@ -1408,7 +2665,7 @@ class TestsPyrebus(unittest.TestCase):
             "peer_infos": peer_infos.to_dict(),
         }
         mock_pipeout = Mock()
-        mock_pipeout.recv.return_value = json.dumps(message).encode()
+        mock_pipeout.recv_multipart.return_value = [json.dumps(message).encode()]
         self.lib.pipe_out = mock_pipeout
         mock_node = Mock()
         self.lib.node = mock_node
@@ -1420,7 +2677,7 @@ class TestsPyrebus(unittest.TestCase):
         call_args = mock_node.whisper.call_args[0]
         self.assertEqual(call_args[0], UUID("12345678-1234-5678-1234-567812345678"))
         self.assertDictEqual(
-            json.loads(call_args[1].decode("utf-8")),
+            json.loads(call_args[1][0].decode("utf-8")),
             {
                 "to": message["to"],
                 "timeout": 5.0,
@@ -1430,6 +2687,7 @@ class TestsPyrebus(unittest.TestCase):
                 "command_uuid": None,
             },
         )
+        self.assertEqual(call_args[1][1], b"C|my_command|||1")
 
     def test_message_to_send_to_pipe_shout(self):
         self.init_lib()
@@ -1440,7 +2698,7 @@ class TestsPyrebus(unittest.TestCase):
             "params": {"param1": "value1"},
         }
         mock_pipeout = Mock()
-        mock_pipeout.recv.return_value = json.dumps(message).encode()
+        mock_pipeout.recv_multipart.return_value = [json.dumps(message).encode()]
         self.lib.pipe_out = mock_pipeout
         mock_node = Mock()
         self.lib.node = mock_node
@@ -1452,7 +2710,7 @@ class TestsPyrebus(unittest.TestCase):
         call_args = mock_node.shout.call_args[0]
         self.assertIsNone(call_args[0])
         self.assertDictEqual(
-            json.loads(call_args[1].decode("utf-8")),
+            json.loads(call_args[1][0].decode("utf-8")),
             {
                 "to": message["to"],
                 "command": message["command"],
@@ -1460,24 +2718,55 @@ class TestsPyrebus(unittest.TestCase):
                 "sender": "mod1",
             },
         )
+        self.assertEqual(call_args[1][1], b"C|my_command|||1@None")
 
-    def test_message_to_send_to_pipe_stop(self):
+    def test_message_to_send_to_pipe_event_to_subscribed_peers(self):
         self.init_lib()
+        ident1 = "12345678-1234-5678-1234-567812345678"
+        ident2 = "87654321-4321-8765-4321-876543218765"
+        self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
+        self.lib.peers = {
+            ident1: self.lib._make_bus_peer(ident1, {"subscriptions": '["system.*"]'}),
+            ident2: self.lib._make_bus_peer(ident2, {"subscriptions": '["alarm.*"]'}),
+        }
+        self.lib.peers[ident1].groups.add("TESTCHANNEL")
+        self.lib.peers[ident2].groups.add("TESTCHANNEL")
+        message = {
+            "event": "system.device.reboot",
+            "sender": "system",
+            "params": {},
+        }
         mock_pipeout = Mock()
-        mock_pipeout.recv.return_value = json.dumps(self.lib.BUS_STOP).encode()
+        mock_pipeout.recv_multipart.return_value = [json.dumps(message).encode()]
         self.lib.pipe_out = mock_pipeout
         mock_node = Mock()
         self.lib.node = mock_node
 
-        self.assertFalse(self.lib._message_to_send_to_pipe())
+        self.assertTrue(self.lib._message_to_send_to_pipe())
 
-        self.assertFalse(mock_node.whisper.called)
         self.assertFalse(mock_node.shout.called)
+        mock_node.whisper.assert_called_once_with(UUID(ident1), ANY)
 
-    def test_message_to_send_to_pipe_exception(self):
+    def test_message_to_send_to_pipe_event_all_peers_subscribed(self):
         self.init_lib()
+        ident1 = "12345678-1234-5678-1234-567812345678"
+        ident2 = "87654321-4321-8765-4321-876543218765"
+        self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL"]
+        self.lib.peers = {
+            ident1: self.lib._make_bus_peer(ident1, {"subscriptions": '["*"]'}),
+            ident2: self.lib._make_bus_peer(ident2, {}),
+        }
+        self.lib.peers[ident1].groups.add("TESTCHANNEL")
+        self.lib.peers[ident2].groups.add("TESTCHANNEL")
+        message = {
+            "event": "system.device.reboot",
+            "sender": "system",
+            "params": {},
+        }
         mock_pipeout = Mock()
-        mock_pipeout.recv.side_effect = Exception("Test exception")
+        mock_pipeout.recv_multipart.return_value = [json.dumps(message).encode()]
         self.lib.pipe_out = mock_pipeout
         mock_node = Mock()
         self.lib.node = mock_node
@@ -1485,76 +2774,2014 @@ class TestsPyrebus(unittest.TestCase):
         self.assertTrue(self.lib._message_to_send_to_pipe())
 
         self.assertFalse(mock_node.whisper.called)
-        self.assertFalse(mock_node.shout.called)
+        mock_node.shout.assert_called()
 
-    def test_run(self):
+    def test_message_to_send_to_pipe_event_routed_channel(self):
         self.init_lib()
-        self.lib._PyreBus__externalbus_configured = True
-        self.lib.run_once = Mock(side_effect=[True, True, False])
+        self.lib._PyreBus__bus_channel = "TESTCHANNEL"
+        self.lib._PyreBus__bus_channels = ["TESTCHANNEL", "FLOOR1"]
+        self.lib.set_channel_routes({"FLOOR1": ["light.*"], "UNJOINED": ["*"]})
+        mock_pipeout = Mock()
+        self.lib.pipe_out = mock_pipeout
+        mock_node = Mock()
+        self.lib.node = mock_node
 
-        self.lib.run()
+        mock_pipeout.recv_multipart.return_value = [
+            json.dumps({"event": "light.light.on", "params": {}}).encode()
+        ]
+        self.assertTrue(self.lib._message_to_send_to_pipe())
+        mock_node.shout.assert_called_with("FLOOR1", ANY)
 
-        self.assertEqual(self.lib.run_once.call_count, 3)
+        mock_pipeout.recv_multipart.return_value = [
+            json.dumps({"event": "system.device.reboot", "params": {}}).encode()
+        ]
+        self.assertTrue(self.lib._message_to_send_to_pipe())
+        mock_node.shout.assert_called_with("TESTCHANNEL", ANY)
 
-    def test_run_external_bus_not_configured(self):
+    def test_message_to_send_to_pipe_whisper_compressed(self):
         self.init_lib()
-        self.lib._PyreBus__externalbus_configured = False
-        self.lib.run_once = Mock(side_effect=[False])
+        ident = "12345678-1234-5678-1234-567812345678"
+        self.lib.peers = {
+            ident: self.lib._make_bus_peer(ident, {"busfeatures": "zlib"})
+        }
+        peer_infos = PeerInfos(uuid="123-456-789", ident=ident)
+        message = {
+            "command": "my_command",
+            "to": "recipient",
+            "params": {"data": "a" * 10000},
+            "peer_infos": peer_infos.to_dict(),
+        }
+        mock_pipeout = Mock()
+        mock_pipeout.recv_multipart.return_value = [json.dumps(message).encode()]
+        self.lib.pipe_out = mock_pipeout
+        mock_node = Mock()
+        self.lib.node = mock_node
 
-        def set_externabus_configured():
-            self.lib._PyreBus__externalbus_configured = True
+        self.assertTrue(self.lib._message_to_send_to_pipe())
 
-        t = Timer(1.0, set_externabus_configured)
-        t.start()
+        frames = mock_node.whisper.call_args[0][1]
+        self.assertEqual(frames[1], b"C|my_command|z||1")
+        content = json.loads(zlib.decompress(frames[0]).decode("utf-8"))
+        self.assertEqual(content["params"], message["params"])
+        stats = self.lib.get_stats()["compression"]
+        self.assertEqual(stats["compressed"], 1)
+        self.assertLess(stats["ratio"], 0.1)
+
+    @patch("backend.pyrebus.time")
+    def test_compression_cpu_time(self, mock_time):
+        mock_time.thread_time.side_effect = [1.0, 1.25, 2.0, 2.5]
+        self.init_lib()
 
-        self.lib.run()
+        compressed = self.lib._compress(b"a" * 10000)
+        self.lib._decompress(compressed)
 
-        self.assertEqual(self.lib.run_once.call_count, 1)
+        stats = self.lib.get_stats()["compression"]
+        self.assertEqual(stats["compress_time"], 0.25)
+        self.assertEqual(stats["decompress_time"], 0.5)
 
-    def test_run_exception(self):
+    def test_message_to_send_to_pipe_whisper_not_compressed(self):
         self.init_lib()
-        self.lib._PyreBus__externalbus_configured = True
-        self.lib.run_once = Mock(side_effect=[Exception("Test exception"), False])
+        ident = "12345678-1234-5678-1234-567812345678"
+        self.lib.peers = {ident: self.lib._make_bus_peer(ident, {})}
+        peer_infos = PeerInfos(uuid="123-456-789", ident=ident)
+        message = {
+            "command": "my_command",
+            "to": "recipient",
+            "params": {"data": "a" * 10000},
+            "peer_infos": peer_infos.to_dict(),
+        }
+        mock_pipeout = Mock()
+        mock_pipeout.recv_multipart.return_value = [json.dumps(message).encode()]
+        self.lib.pipe_out = mock_pipeout
+        mock_node = Mock()
+        self.lib.node = mock_node
 
-        self.lib.run()
+        self.assertTrue(self.lib._message_to_send_to_pipe())
 
-        self.assertEqual(self.lib.run_once.call_count, 2)
+        frames = mock_node.whisper.call_args[0][1]
+        self.assertEqual(frames[1], b"C|my_command|||1")
+        self.assertEqual(
+            json.loads(frames[0].decode("utf-8"))["params"], message["params"]
+        )
+        self.assertEqual(self.lib.get_stats()["compression"]["compressed"], 0)
 
-    def test_broadcast_message(self):
+    def test_message_to_send_to_pipe_raw_frames(self):
         self.init_lib()
-        self.lib._send_message = Mock()
+        ident = "12345678-1234-5678-1234-567812345678"
+        mock_pipeout = Mock()
+        mock_pipeout.recv_multipart.return_value = [
+            PyreBus.PIPE_FRAMES,
+            ident.encode(),
+            b"chunk",
+            b"S|1234|e|2",
+        ]
+        self.lib.pipe_out = mock_pipeout
+        mock_node = Mock()
+        self.lib.node = mock_node
 
-        self.lib._broadcast_message(MessageRequest())
+        self.assertTrue(self.lib._message_to_send_to_pipe())
 
-        self.lib._send_message.assert_called_once()
+        mock_node.whisper.assert_called_with(UUID(ident), [b"chunk", b"S|1234|e|2"])
 
-    def test_send_message(self):
+    def test_message_to_send_to_pipe_event_from_template(self):
         self.init_lib()
         self.lib._PyreBus__externalbus_configured = True
-        mock_pipein = Mock()
-        self.lib.pipe_in = mock_pipein
+        self.lib.pipe_in = Mock()
         message = MessageRequest()
-        message.event = "dummy.test.event"
-
+        message.event = "system.device.reboot"
+        message.params = {"param1": "value1"}
+        message.sender = "system"
         self.lib._send_message(message)
+        self.lib.pipe_out = Mock()
+        self.lib.pipe_out.recv_multipart.return_value = [
+            self.lib.pipe_in.send.call_args.args[0]
+        ]
+        self.lib.node = Mock()
+        self.assertTrue(self.lib._message_to_send_to_pipe())
+        expected = self.lib.node.shout.call_args.args
 
-        mock_pipein.send.assert_called_with(
-            json.dumps(message.to_dict()).encode("utf8")
+        self.lib.send_event("system.device.reboot", {"param1": "value1"}, "system")
+        self.lib.pipe_out.recv_multipart.return_value = (
+            self.lib.pipe_in.send_multipart.call_args.args[0]
         )
+        self.assertTrue(self.lib._message_to_send_to_pipe())
 
-    def test_send_message_external_bus_not_configured(self):
+        self.assertEqual(self.lib.node.shout.call_args.args[1][0], expected[1][0])
+        self.assertEqual(expected[1][1], b"E|system.device.reboot|||1@None")
+        self.assertEqual(
+            self.lib.node.shout.call_args.args[1][1], b"E|system.device.reboot|||2@None"
+        )
+
+    def test_send_event_tracing_enabled(self):
         self.init_lib()
-        self.lib._PyreBus__externalbus_configured = False
-        mock_pipein = Mock()
-        self.lib.pipe_in = mock_pipein
-        message = MessageRequest()
-        message.event = "dummy.test.event"
+        self.lib._send_message = Mock()
+        self.lib.tracer.enabled = True
 
-        self.lib._send_message(message)
+        self.lib.send_event("my.event", {"param1": "value1"}, "mod1")
 
-        self.assertFalse(mock_pipein.send.called)
+        message = self.lib._send_message.call_args.args[0]
+        self.assertEqual(message.event, "my.event")
+        self.assertEqual(message.params, {"param1": "value1"})
+        self.assertEqual(message.sender, "mod1")
 
+    def test_send_event_external_bus_not_configured(self):
+        self.init_lib()
+        self.lib.pipe_in = Mock()
 
-if __name__ == "__main__":
-    # coverage run --include="**/backend/**/*.py" --concurrency=thread test_cleepbus.py; coverage report -m -i
-    unittest.main()
+        self.lib.send_event("my.event")
+
+        self.assertFalse(self.lib.pipe_in.send_multipart.called)
+
+    def test_message_templates(self):
+        templates = MessageTemplates(PyreBus.clean_message, max_templates=2)
+
+        for params in ({"param1": "value1"}, None, {"text": "\x00params\x00"}):
+            message = MessageRequest()
+            message.event = "my.event"
+            message.params = params
+            message.sender = "mod1"
+            self.assertEqual(
+                templates.encode("my.event", params, "mod1"),
+                json.dumps(PyreBus.clean_message(message)).encode("utf-8"),
+            )
+        self.assertEqual((templates.hits, templates.misses), (2, 1))
+
+        templates.encode("other.event")
+        templates.encode("my.event", {}, "mod2")
+        self.assertEqual(len(templates), 2)
+        templates.encode("my.event", {}, "mod1")
+        self.assertEqual(templates.misses, 4)
+        templates.clear()
+        self.assertEqual(len(templates), 0)
+
+    def test_message_to_send_to_pipe_stop(self):
+        self.init_lib()
+        mock_pipeout = Mock()
+        mock_pipeout.recv_multipart.return_value = [
+            json.dumps(self.lib.BUS_STOP).encode()
+        ]
+        self.lib.pipe_out = mock_pipeout
+        mock_node = Mock()
+        self.lib.node = mock_node
+
+        self.assertFalse(self.lib._message_to_send_to_pipe())
+
+        self.assertFalse(mock_node.whisper.called)
+        self.assertFalse(mock_node.shout.called)
+
+    def test_message_to_send_to_pipe_exception(self):
+        self.init_lib()
+        mock_pipeout = Mock()
+        mock_pipeout.recv_multipart.side_effect = Exception("Test exception")
+        self.lib.pipe_out = mock_pipeout
+        mock_node = Mock()
+        self.lib.node = mock_node
+
+        self.assertTrue(self.lib._message_to_send_to_pipe())
+
+        self.assertFalse(mock_node.whisper.called)
+        self.assertFalse(mock_node.shout.called)
+
+    def init_stream_peer(self, features="zlib,stream"):
+        ident = "12345678-1234-5678-1234-567812345678"
+        self.lib._PyreBus__bus_name = "TESTBUS"
+        self.lib._PyreBus__externalbus_configured = True
+        self.lib.peers = {
+            ident: self.lib._make_bus_peer(ident, {"busfeatures": features})
+        }
+        self.lib.pipe_in = Mock()
+        return ident
+
+    def receive_frames(self, frames):
+        self.lib.node = Mock()
+        self.lib.node.recv.return_value = [
+            b"WHISPER",
+            b"\x12\x34\x56\x78" * 4,
+            b"TESTBUS",
+        ] + frames
+        self.assertTrue(self.lib._message_to_receive_from_pipe())
+
+    def test_ping_peers(self):
+        self.init_lib()
+        ident = self.init_stream_peer("zlib,stream,ping")
+        self.lib.peers["87654321-4321-8765-4321-876543218765"] = (
+            self.lib._make_bus_peer("87654321-4321-8765-4321-876543218765", {})
+        )
+        self.lib.node = Mock()
+
+        self.lib._ping_peers()
+
+        self.lib.node.whisper.assert_called_once_with(uuid.UUID(ident), [b"", b"P|||1"])
+        self.assertEqual(self.lib.peers[ident].link.sent, 1)
+
+    def test_receive_ping_answers_pong(self):
+        self.init_lib()
+        ident = self.init_stream_peer("ping")
+
+        self.receive_frames([b"", b"P|||7"])
+
+        self.lib.node.whisper.assert_called_once_with(uuid.UUID(ident), [b"", b"Q|||7"])
+
+    @patch("backend.pyrebus.time")
+    def test_receive_pong_updates_link_stats(self, mock_time):
+        self.init_lib()
+        ident = self.init_stream_peer("ping")
+        self.lib.node = Mock()
+        mock_time.time.return_value = 100.0
+        self.lib._ping_peers()
+
+        mock_time.time.return_value = 100.25
+        self.receive_frames([b"", b"Q|||1"])
+        mock_time.time.return_value = 200.0
+        self.lib._ping_peers()
+        mock_time.time.return_value = 300.0
+        self.lib._ping_peers()
+
+        link = self.lib.get_peer_link_stats(ident)
+        self.assertEqual(link["rtt"], 0.25)
+        self.assertEqual(link["sent"], 3)
+        self.assertEqual(link["received"], 1)
+        self.assertEqual(link["lost"], 1)
+        self.assertEqual(link["loss"], 0.5)
+        self.assertIsNone(self.lib.get_peer_link_stats("unknown"))
+
+    def test_peer_link_stats_jitter(self):
+        link = PeerLinkStats()
+        for rtt in (0.1, 0.2, 0.1):
+            link.add_sample(rtt)
+
+        self.assertAlmostEqual(link.jitter, 0.1 / 16 + (0.1 - 0.1 / 16) / 16)
+        self.assertEqual(link.min_rtt, 0.1)
+        self.assertEqual(link.max_rtt, 0.2)
+        self.assertEqual(link.percentile(99), 0.2)
+
+    def test_send_command_to_all_without_peer(self):
+        self.init_lib()
+        self.init_stream_peer("zlib")
+        self.lib._PyreBus__bus_channel = "CLEEP"
+        message = MessageRequest()
+        message.command = "my_command"
+
+        request = self.lib.send_command_to_all(message, 5.0)
+
+        self.assertTrue(request.completed)
+        self.assertEqual(list(request), [])
+        self.assertFalse(self.lib.pipe_in.send.called)
+
+    def test_send_command_to_peer_without_response_support(self):
+        self.init_lib()
+        ident = self.init_stream_peer("zlib")
+        message = MessageRequest()
+        message.command = "my_command"
+        message.peer_infos = PeerInfos(ident=ident)
+
+        self.assertIsNone(self.lib.send_command_to_peer(message, 5.0, Mock()))
+        self.assertFalse(self.lib.pipe_in.send.called)
+
+    @patch("backend.pyrebus.time")
+    def test_send_command_to_all_expire_and_stop(self, mock_time):
+        mock_time.time.return_value = 100.0
+        self.init_lib()
+        ident = self.init_stream_peer("response")
+        other = "87654321-4321-8765-4321-876543218765"
+        self.lib.peers[other] = self.lib._make_bus_peer(
+            other, {"busfeatures": "response"}
+        )
+        for peer in self.lib.peers.values():
+            peer.groups.add("CLEEP")
+        self.lib._PyreBus__bus_channel = "CLEEP"
+        message = MessageRequest()
+        message.command = "my_command"
+
+        request = self.lib.send_command_to_all(
+            message, lambda peer_id: 1.0 if peer_id == ident else 10.0
+        )
+        sent = json.loads(self.lib.pipe_in.send.call_args.args[0])
+        self.assertEqual(sent["request_id"], request.request_id)
+
+        self.lib._expire_requests(101.0)
+        self.assertEqual(request.missing, [ident])
+        self.assertFalse(request.completed)
+
+        # unknown request is ignored, late response is dropped
+        self.receive_frames([b"{}", b"R|my_command||666"])
+        self.receive_frames([b"{}", b"R|my_command||%d" % request.request_id])
+        self.assertEqual(request.responses, {})
+
+        self.lib.node = Mock()
+        self.lib.stop()
+        self.assertTrue(request.completed)
+        self.assertEqual(request.missing, [ident, other])
+
+    def test_broadcast_request_quorum(self):
+        on_response = Mock()
+        request = BroadcastRequest(
+            1, {"peer1": 10.0, "peer2": 10.0, "peer3": 10.0}, 2, on_response
+        )
+
+        self.assertFalse(request.add_response("peer1", {"data": 1}))
+        self.assertFalse(request.add_response("peer1", {"data": 1}))
+        self.assertFalse(request.add_response("unknown", {"data": 1}))
+        self.assertTrue(request.add_response("peer2", {"data": 2}))
+        self.assertTrue(request.add_response("peer3", {"data": 3}))
+
+        self.assertEqual(on_response.call_count, 2)
+        self.assertEqual(
+            list(request), [("peer1", {"data": 1}), ("peer2", {"data": 2})]
+        )
+        self.assertDictEqual(
+            request.to_dict(),
+            {
+                "responses": {"peer1": {"data": 1}, "peer2": {"data": 2}},
+                "missing": ["peer3"],
+                "completed": True,
+            },
+        )
+        self.assertTrue(request.wait(0))
+
+    def test_broadcast_request_iteration_deadline(self):
+        request = BroadcastRequest(
+            1, BroadcastRequest.make_deadlines(["peer1"], 0.05, now=time.time())
+        )
+        request.expires_at = request.deadlines["peer1"]
+
+        self.assertEqual(list(request), [])
+        self.assertTrue(request.completed)
+        self.assertEqual(request.missing, ["peer1"])
+
+    def test_broadcast_request_peer_left(self):
+        request = BroadcastRequest(
+            1, BroadcastRequest.make_deadlines(["peer1", "peer2"], 5.0, now=10.0)
+        )
+        self.assertEqual(request.deadlines, {"peer1": 15.0, "peer2": 15.0})
+
+        self.assertFalse(request.remove_peer("peer1"))
+        self.assertFalse(request.remove_peer("unknown"))
+        self.assertTrue(request.remove_peer("peer2"))
+        self.assertEqual(request.missing, ["peer1", "peer2"])
+
+    def receive_ordered_event(self, order, flags=b""):
+        self.receive_frames(
+            [
+                json.dumps({"event": "my.event", "params": {}}).encode("utf-8"),
+                PyreBus.make_meta(PyreBus.KIND_EVENT, b"my.event", flags, order=order),
+            ]
+        )
+
+    def test_peer_sequence(self):
+        sequence = PeerSequence()
+
+        self.assertEqual(sequence.check("", 10), (True, []))
+        self.assertEqual(sequence.check("", 11), (True, []))
+        self.assertEqual(sequence.check("", 14), (True, [12, 13]))
+        self.assertEqual(sequence.check("", 13), (True, []))
+        self.assertEqual(sequence.check("", 12, replayed=True), (True, []))
+        self.assertEqual(sequence.check("", 12), (False, []))
+        self.assertEqual(sequence.check("", 15), (True, []))
+        # streams are independent
+        self.assertEqual(sequence.check("CLEEP", 1), (True, []))
+
+        self.assertDictEqual(
+            sequence.to_dict(),
+            {
+                "received": 7,
+                "lost": 0,
+                "duplicated": 1,
+                "reordered": 1,
+                "recovered": 1,
+            },
+        )
+
+    def test_peer_sequence_missing_is_bounded(self):
+        sequence = PeerSequence()
+        sequence.check("", 1)
+
+        accepted, missing = sequence.check("", 1000)
+
+        self.assertTrue(accepted)
+        self.assertEqual(len(missing), PeerSequence.MAX_MISSING)
+        self.assertEqual(sequence.lost, 998)
+        # late numbers no longer reported as missing are delivered once
+        self.assertEqual(sequence.check("", 10), (True, []))
+        self.assertEqual(sequence.check("", 10), (False, []))
+        self.assertEqual(sequence.check("", 1), (False, []))
+        self.assertEqual(sequence.check("", 1000), (False, []))
+        self.assertEqual(sequence.lost, 997)
+        self.assertEqual(sequence.reordered, 1)
+        self.assertEqual(sequence.duplicated, 3)
+
+    def test_peer_sequence_out_of_received_bitmap(self):
+        sequence = PeerSequence()
+        sequence.check("", 1)
+        sequence.check("", 1 + PeerSequence.MAX_RECEIVED + 10)
+
+        lost = sequence.lost
+        self.assertEqual(sequence.check("", 5), (True, []))
+        self.assertEqual(sequence.check("", 1), (True, []))
+        # out of bitmap numbers were not tracked as lost
+        self.assertEqual(sequence.lost, lost)
+        self.assertEqual(sequence.check("", 20), (True, []))
+        self.assertEqual(sequence.check("", 20), (False, []))
+        self.assertEqual(sequence.lost, lost - 1)
+
+    def test_peer_sequence_lost_never_negative(self):
+        sequence = PeerSequence()
+        sequence.check("", 5000)
+
+        # numbers before first one, out of bitmap
+        for seq in range(1, 5):
+            self.assertEqual(sequence.check("", seq), (True, []))
+
+        self.assertEqual(sequence.lost, 0)
+
+    def test_message_sequence_numbers(self):
+        self.init_lib()
+        ident = self.init_stream_peer()
+        self.lib.peers[ident].groups.add("CLEEP")
+        self.lib._PyreBus__bus_channel = "CLEEP"
+        self.lib.node = Mock()
+        message = MessageRequest()
+        message.event = "my.event"
+
+        self.lib._send_content(message, b"{}")
+        self.lib._send_content(message, b"{}")
+        message.peer_infos = PeerInfos(ident=ident)
+        self.lib._send_content(message, b"{}")
+
+        self.assertEqual(
+            [call.args[1][1] for call in self.lib.node.shout.call_args_list],
+            [b"E|my.event|||1@CLEEP", b"E|my.event|||2@CLEEP"],
+        )
+        self.assertEqual(self.lib.node.whisper.call_args.args[1][1], b"E|my.event|||1")
+
+    def test_receive_sequence_gap_and_duplicate(self):
+        self.init_lib()
+        ident = self.init_stream_peer("replay")
+
+        self.receive_ordered_event(b"1@CLEEP")
+        self.receive_ordered_event(b"3@CLEEP")
+        self.assertFalse(self.lib.node.whisper.called)
+        self.receive_ordered_event(b"3@CLEEP")
+        self.receive_ordered_event(b"1")
+
+        self.assertEqual(len(self.messages), 3)
+        self.assertDictEqual(
+            self.lib.get_peer_sequence_stats(ident),
+            {
+                "received": 3,
+                "lost": 1,
+                "duplicated": 1,
+                "reordered": 0,
+                "recovered": 0,
+            },
+        )
+        self.assertIsNone(self.lib.get_peer_sequence_stats("unknown"))
+
+    def test_receive_sequence_gap_requests_replay(self):
+        self.init_lib()
+        ident = self.init_stream_peer("replay")
+        self.lib.set_replay_window(8)
+
+        self.receive_ordered_event(b"1@CLEEP")
+        self.receive_ordered_event(b"4@CLEEP")
+
+        peer_uuid, frames = self.lib.node.whisper.call_args.args
+        self.assertEqual(peer_uuid, uuid.UUID(ident))
+        self.assertEqual(json.loads(frames[0]), {"stream": "CLEEP", "seqs": [2, 3]})
+        self.assertEqual(frames[1], b"N")
+
+        self.receive_ordered_event(b"2@CLEEP", PyreBus.FLAG_REPLAYED)
+        self.assertEqual(self.lib.get_peer_sequence_stats(ident)["recovered"], 1)
+
+    def test_handle_replay_request(self):
+        self.init_lib()
+        ident = self.init_stream_peer()
+        self.lib.peers[ident].groups.add("CLEEP")
+        self.lib._PyreBus__bus_channel = "CLEEP"
+        self.lib.set_replay_window(2)
+        self.lib.node = Mock()
+        message = MessageRequest()
+        message.event = "my.event"
+        for index in range(3):
+            self.lib._send_content(message, b"%d" % index)
+
+        self.receive_frames(
+            [json.dumps({"stream": "CLEEP", "seqs": [1, 2, 3]}).encode(), b"N"]
+        )
+
+        # first message is not in replay window anymore
+        self.assertEqual(
+            [call.args for call in self.lib.node.whisper.call_args_list],
+            [
+                (uuid.UUID(ident), [b"1", b"E|my.event|r||2@CLEEP"]),
+                (uuid.UUID(ident), [b"2", b"E|my.event|r||3@CLEEP"]),
+            ],
+        )
+
+        self.lib.node.whisper.reset_mock()
+        self.receive_frames([b"invalid", b"N"])
+        self.assertFalse(self.lib.node.whisper.called)
+
+    def test_reliable_sender(self):
+        sender = ReliableSender(3)
+
+        self.assertEqual(sender.base, 1)
+        for index in range(4):
+            self.assertEqual(sender.add(b"ev", b"%d" % index, b"", 10.0), index + 1)
+
+        # oldest message given up
+        self.assertEqual(sender.dropped, 1)
+        self.assertEqual(sender.base, 2)
+        self.assertEqual(sender.due(11.0, 2.0), [])
+        self.assertEqual([seq for seq, _, _, _ in sender.due(12.0, 2.0)], [2, 3, 4])
+        self.assertEqual(sender.retransmitted, 3)
+        self.assertEqual(sender.ack(3), 2)
+        self.assertEqual(list(sender.pending), [4])
+        self.assertEqual(sender.due(12.0, 0.0), [(4, b"ev", b"3", b"")])
+
+    def test_reliable_receiver(self):
+        receiver = ReliableReceiver()
+
+        self.assertTrue(receiver.receive(1, 1))
+        self.assertTrue(receiver.receive(3, 1))
+        self.assertEqual(receiver.acked, 1)
+        self.assertTrue(receiver.is_duplicate(3, 1))
+        self.assertTrue(receiver.receive(2, 1))
+        self.assertEqual(receiver.acked, 3)
+        self.assertTrue(receiver.is_duplicate(2, 1))
+        self.assertFalse(receiver.is_duplicate(4, 1))
+        self.assertEqual(receiver.duplicated, 2)
+
+        # sender gave up messages 4 to 5
+        self.assertTrue(receiver.receive(7, 6))
+        self.assertEqual(receiver.acked, 5)
+        self.assertTrue(receiver.receive(6, 6))
+        self.assertEqual(receiver.acked, 7)
+
+    def init_reliable_peer(self, features="zlib,stream,reliable"):
+        ident = self.init_stream_peer(features)
+        self.lib.peers[ident] = self.lib._make_bus_peer(
+            ident, {"busfeatures": features, "uuid": "device-uuid"}
+        )
+        self.lib.peers[ident].groups.add("CLEEP")
+        self.lib._PyreBus__bus_channel = "CLEEP"
+        self.lib.set_reliable_events(["alarm.*"])
+        self.lib.node = Mock()
+        return ident
+
+    @patch("backend.pyrebus.time")
+    def test_send_reliable_event(self, mock_time):
+        mock_time.time.return_value = 100.0
+        self.init_lib()
+        ident = self.init_reliable_peer()
+        message = MessageRequest()
+        message.event = "alarm.motion.on"
+
+        self.lib._send_content(message, b"1")
+        self.lib._send_content(message, b"2")
+        message.event = "sensors.temperature.update"
+        self.lib._send_content(message, b"3")
+
+        epoch = self.lib._PyreBus__reliable_senders["device-uuid"].epoch.encode()
+        self.assertEqual(
+            [call.args for call in self.lib.node.whisper.call_args_list],
+            [
+                (uuid.UUID(ident), [b"1", b"E|alarm.motion.on|k|1|1@" + epoch]),
+                (uuid.UUID(ident), [b"2", b"E|alarm.motion.on|k|2|1@" + epoch]),
+            ],
+        )
+        # other events are still shouted
+        self.assertEqual(
+            self.lib.node.shout.call_args.args[1][1],
+            b"E|sensors.temperature.update|||1@CLEEP",
+        )
+        self.assertEqual(self.lib.get_stats()["reliable"]["pending"], 2)
+
+        # acknowledgement removes pending messages
+        self.receive_frames([b"", b"K|||1"])
+        self.assertEqual(self.lib.get_stats()["reliable"]["pending"], 1)
+        self.assertEqual(self.lib.stats["reliable"]["acked"], 1)
+
+    def test_send_reliable_event_to_peer_without_feature(self):
+        self.init_lib()
+        ident = self.init_reliable_peer("zlib,stream")
+        message = MessageRequest()
+        message.event = "alarm.motion.on"
+
+        self.lib._send_content(message, b"1")
+
+        self.lib.node.whisper.assert_called_once_with(
+            uuid.UUID(ident), [b"1", b"E|alarm.motion.on|||1"]
+        )
+        self.assertEqual(self.lib.get_stats()["reliable"]["pending"], 0)
+
+    @patch("backend.pyrebus.time")
+    def test_retransmit_reliable(self, mock_time):
+        mock_time.time.return_value = 100.0
+        self.init_lib()
+        ident = self.init_reliable_peer()
+        message = MessageRequest()
+        message.event = "alarm.motion.on"
+        self.lib._send_content(message, b"1")
+        self.lib.node.whisper.reset_mock()
+
+        self.lib._retransmit_reliable(101.0)
+        self.assertFalse(self.lib.node.whisper.called)
+        self.lib._retransmit_reliable(100.0 + PyreBus.RELIABLE_TIMEOUT)
+        epoch = self.lib._PyreBus__reliable_senders["device-uuid"].epoch.encode()
+        self.lib.node.whisper.assert_called_once_with(
+            uuid.UUID(ident), [b"1", b"E|alarm.motion.on|k|1|1@" + epoch]
+        )
+
+        # peer reconnection sends pending messages at once
+        self.lib.node.whisper.reset_mock()
+        self.lib._retransmit_reliable(103.0, self.lib.peers[ident], timeout=0.0)
+        self.assertEqual(self.lib.node.whisper.call_count, 1)
+        self.assertEqual(self.lib.stats["reliable"]["retransmitted"], 2)
+
+    def test_receive_reliable_event(self):
+        self.init_lib()
+        ident = self.init_stream_peer("reliable")
+        reliable_frames = [
+            json.dumps({"event": "alarm.motion.on", "params": {}}).encode("utf-8"),
+            b"E|alarm.motion.on|k|1|1",
+        ]
+
+        self.receive_frames(reliable_frames)
+        self.receive_frames(reliable_frames)
+        self.lib._send_acks()
+
+        self.assertEqual(len(self.messages), 1)
+        self.assertEqual(self.lib.stats["reliable"]["duplicated"], 1)
+        # duplicate is acknowledged again
+        self.lib.node.whisper.assert_called_once_with(uuid.UUID(ident), [b"", b"K|||1"])
+
+    @patch("backend.pyrebus.time")
+    def test_expire_reliable_senders(self, mock_time):
+        mock_time.time.return_value = 100.0
+        self.init_lib()
+        ident = self.init_reliable_peer()
+        message = MessageRequest()
+        message.event = "alarm.motion.on"
+        self.lib._send_content(message, b"1")
+        senders = self.lib._PyreBus__reliable_senders
+
+        # connected peer device is kept
+        self.lib._expire_reliable_senders(1000.0)
+        self.assertIn("device-uuid", senders)
+
+        # gone peer device is given up after RELIABLE_GIVE_UP
+        self.lib.peers.pop(ident)
+        self.lib._expire_reliable_senders(1000.0)
+        self.lib._expire_reliable_senders(1000.0 + PyreBus.RELIABLE_GIVE_UP - 1)
+        self.assertIn("device-uuid", senders)
+        self.lib._expire_reliable_senders(1000.0 + PyreBus.RELIABLE_GIVE_UP)
+        self.assertNotIn("device-uuid", senders)
+        self.assertEqual(self.lib.stats["reliable"]["dropped"], 1)
+
+    def test_expire_reliable_senders_peer_back(self):
+        self.init_lib()
+        ident = self.init_reliable_peer()
+        message = MessageRequest()
+        message.event = "alarm.motion.on"
+        self.lib._send_content(message, b"1")
+        peer = self.lib.peers.pop(ident)
+        self.lib._expire_reliable_senders(1000.0)
+
+        self.lib.peers[ident] = peer
+        self.lib._expire_reliable_senders(1000.0 + PyreBus.RELIABLE_GIVE_UP)
+
+        self.assertEqual(self.lib.get_stats()["reliable"]["pending"], 1)
+
+    def test_receive_reliable_event_keyed_by_device_and_epoch(self):
+        self.init_lib()
+        ident = self.init_stream_peer("reliable")
+        self.lib.peers[ident].device_uuid = "device-uuid"
+        event = json.dumps({"event": "alarm.motion.on", "params": {}}).encode()
+        self.receive_frames([event, b"E|alarm.motion.on|k|1|1@epoch1"])
+
+        # peer restarted with a new pyre identifier, same numbering
+        other = "87654321-4321-8765-4321-876543218765"
+        self.lib.peers = {
+            other: self.lib._make_bus_peer(
+                other, {"busfeatures": "reliable", "uuid": "device-uuid"}
+            )
+        }
+        self.lib.node = Mock()
+        for order in (b"1@epoch1", b"1@epoch2", b"1@epoch2"):
+            self.lib.node.recv.return_value = [
+                b"WHISPER",
+                uuid.UUID(other).bytes,
+                b"TESTBUS",
+                event,
+                b"E|alarm.motion.on|k|1|" + order,
+            ]
+            self.lib._message_to_receive_from_pipe()
+        self.lib._send_acks()
+
+        # sender restarted its numbering: message is processed
+        self.assertEqual(len(self.messages), 2)
+        self.assertEqual(self.lib.stats["reliable"]["duplicated"], 2)
+        self.lib.node.whisper.assert_called_once_with(uuid.UUID(other), [b"", b"K|||1"])
+
+    @patch("backend.pyrebus.time")
+    def test_receive_reliable_event_throttled_not_acknowledged(self, mock_time):
+        mock_time.time.return_value = 100.0
+        self.init_lib()
+        self.init_stream_peer("reliable")
+        self.lib.set_rate_limit(1, 1)
+        for seq in (b"1", b"2"):
+            self.receive_frames(
+                [
+                    json.dumps({"event": "alarm.motion.on", "params": {}}).encode(),
+                    b"E|alarm.motion.on|k|" + seq + b"|1",
+                ]
+            )
+
+        self.lib._send_acks()
+
+        self.lib.node.whisper.assert_called_once_with(ANY, [b"", b"K|||1"])
+
+    def receive_event_from(self, ident, event):
+        self.lib.node.recv.return_value = [
+            b"WHISPER",
+            uuid.UUID(ident).bytes,
+            b"TESTBUS",
+            json.dumps({"event": event, "params": {}}).encode("utf-8"),
+            PyreBus.make_meta(PyreBus.KIND_EVENT, event.encode("utf-8")),
+        ]
+        return self.lib._message_to_receive_from_pipe(dispatch=False)
+
+    @patch("backend.pyrebus.time")
+    def test_inbound_rate_limit(self, mock_time):
+        mock_time.time.return_value = 100.0
+        self.init_lib()
+        ident = self.init_stream_peer()
+        self.lib.node = Mock()
+        self.lib.set_rate_limit(1, 2)
+
+        for _ in range(3):
+            self.receive_event_from(ident, "my.event")
+        mock_time.time.return_value = 101.0
+        self.receive_event_from(ident, "my.event")
+        self.lib._dispatch_inbound_messages()
+
+        self.assertEqual(len(self.messages), 3)
+        self.assertEqual(self.lib.get_peer_throttled(ident), 1)
+        self.assertEqual(self.lib.get_stats()["throttled"], 1)
+
+    @patch("backend.pyrebus.time")
+    def test_inbound_rate_limit_warns_once_per_throttling(self, mock_time):
+        mock_time.time.return_value = 100.0
+        self.init_lib()
+        ident = self.init_stream_peer()
+        self.lib.node = Mock()
+        self.lib.set_rate_limit(1, 1)
+
+        with self.assertLogs(self.lib.logger, logging.WARNING) as logs:
+            for _ in range(3):
+                self.receive_event_from(ident, "my.event")
+            mock_time.time.return_value = 102.0
+            for _ in range(2):
+                self.receive_event_from(ident, "my.event")
+
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(self.lib.get_peer_throttled(ident), 3)
+
+    def test_inbound_fair_scheduling(self):
+        self.init_lib()
+        ident1 = self.init_stream_peer()
+        ident2 = "87654321-4321-8765-4321-876543218765"
+        self.lib.peers[ident2] = self.lib._make_bus_peer(ident2, {})
+        self.lib.node = Mock()
+        self.lib.INBOUND_QUEUE_SIZE = 3
+
+        for index in range(4):
+            self.receive_event_from(ident1, f"flood.{index}")
+        self.receive_event_from(ident2, "quiet.0")
+        self.lib._dispatch_inbound_messages()
+
+        self.assertEqual(
+            [message["message"].event for message in self.messages],
+            ["flood.0", "quiet.0", "flood.1", "flood.2"],
+        )
+        self.assertEqual(self.lib.get_peer_throttled(ident1), 1)
+        self.assertEqual(self.lib.get_peer_throttled(ident2), 0)
+
+    @patch("backend.pyrebus.zmq")
+    def test_receive_from_bus_drains_socket(self, mock_zmq):
+        mock_zmq.POLLIN = "POLLIN"
+        self.init_lib()
+        self.lib.node_socket = Mock()
+        self.lib.node_socket.poll.side_effect = ["POLLIN", "POLLIN", 0]
+        self.lib._message_to_receive_from_pipe = Mock(return_value=True)
+        self.lib._dispatch_inbound_messages = Mock()
+
+        self.assertTrue(self.lib._receive_from_bus())
+
+        self.assertEqual(self.lib._message_to_receive_from_pipe.call_count, 3)
+        self.lib._dispatch_inbound_messages.assert_called_once()
+
+    def test_profiler_records_receive_stages(self):
+        self.init_lib()
+        ident = self.init_stream_peer()
+        self.lib.node = Mock()
+        self.lib.profiler.enable()
+        self.lib.profiler.begin()
+
+        self.receive_event_from(ident, "my.event")
+        self.lib._dispatch_inbound_messages()
+
+        summary = self.lib.profiler.get_summary()
+        self.assertCountEqual(summary.keys(), ["recv", "decode", "callback"])
+        self.assertEqual(summary["decode"]["count"], 1)
+
+    def test_profiler_disabled(self):
+        self.init_lib()
+        self.lib.profiler.begin()
+
+        self.assertIsNone(self.lib.profiler.start())
+
+    @patch("backend.busprofiler.time")
+    def test_profiler_stacks(self, mock_time):
+        profiler = BusProfiler()
+        profiler.enable(sample_every=2)
+        profiler.begin()
+        self.assertIsNone(profiler.start())
+        profiler.begin()
+
+        mock_time.perf_counter.return_value = 1.0
+        callback_start = profiler.start()
+        handler_start = profiler.start()
+        mock_time.perf_counter.return_value = 1.003
+        profiler.record("handler", handler_start, "my.event")
+        mock_time.perf_counter.return_value = 1.004
+        profiler.record("callback", callback_start)
+
+        self.assertEqual(
+            profiler.get_stacks(),
+            "run_once;receive;callback 1000\nrun_once;receive;callback;handler;my.event 3000",
+        )
+        self.assertAlmostEqual(profiler.get_summary()["callback"]["max"], 0.004)
+
+    def test_tracing_send_message(self):
+        self.init_lib()
+        self.lib._PyreBus__externalbus_configured = True
+        self.lib.pipe_in = Mock()
+        self.lib.tracer.enabled = True
+        message = MessageRequest()
+        message.command = "my_command"
+        message.to = "recipient"
+        message.peer_infos = PeerInfos(
+            uuid="123-456-789", ident="12345678-1234-5678-1234-567812345678"
+        )
+
+        self.lib._send_message(message)
+        sent = self.lib.pipe_in.send.call_args.args[0]
+        self.lib.pipe_out = Mock()
+        self.lib.pipe_out.recv_multipart.return_value = [sent]
+        self.lib.node = Mock()
+        self.assertTrue(self.lib._message_to_send_to_pipe())
+
+        content = json.loads(self.lib.node.whisper.call_args[0][1][0])
+        trace = content["trace"]
+        self.assertEqual(len(trace["trace_id"]), 32)
+        self.assertIsNone(trace["parent_id"])
+        self.assertIn("sent", trace)
+        spans = self.lib.tracer.get_spans(trace["trace_id"])
+        self.assertEqual(len(spans), 1)
+        self.assertEqual(spans[0]["kind"], "send")
+        self.assertEqual(spans[0]["name"], "my_command")
+        self.assertEqual(spans[0]["peer"], "12345678-1234-5678-1234-567812345678")
+
+    def test_tracing_receive_message(self):
+        self.init_lib()
+        ident = self.init_stream_peer()
+        self.lib.tracer.enabled = True
+        contexts = []
+        self.lib.on_message_received = lambda peer_id, message: contexts.append(
+            self.lib.tracer.get_current()
+        )
+
+        self.receive_frames(
+            [
+                json.dumps(
+                    {
+                        "event": "my.event",
+                        "params": {},
+                        "trace": {"trace_id": "t1", "span_id": "s1", "sent": 1.0},
+                    }
+                ).encode("utf-8"),
+                b"E|my.event",
+            ]
+        )
+
+        receive_span, handler_span = self.lib.tracer.get_spans("t1")
+        self.assertEqual(receive_span["kind"], "receive")
+        self.assertEqual(receive_span["parent_id"], "s1")
+        self.assertEqual(receive_span["start"], 1.0)
+        self.assertEqual(receive_span["peer"], ident)
+        self.assertEqual(handler_span["kind"], "handler")
+        self.assertEqual(handler_span["parent_id"], receive_span["span_id"])
+        self.assertEqual(contexts[0]["span_id"], handler_span["span_id"])
+        self.assertIsNone(self.lib.tracer.get_current())
+
+        # child messages sent while handling message belong to the same trace
+        self.lib.tracer.activate(contexts[0])
+        child = self.lib.tracer.new_context()
+        self.lib.tracer.activate(None)
+        self.assertEqual(child["trace_id"], "t1")
+        self.assertEqual(child["parent_id"], handler_span["span_id"])
+
+    @patch("backend.pyrebus.Pyre")
+    def test_import_dependencies_keeps_mocks(self, mock_pyre):
+        import_dependencies()
+
+        self.assertIs(pyrebus_module.Pyre, mock_pyre)
+        self.assertIsNotNone(pyrebus_module.zmq)
+        self.assertIsNotNone(pyrebus_module.netifaces)
+
+    def test_sampled_message_log(self):
+        self.init_lib()
+        ident = self.init_stream_peer()
+        self.lib.node = Mock()
+        self.lib.logger = Mock()
+        self.lib.logger.isEnabledFor.return_value = False
+        self.lib.set_message_log_sampling(2)
+
+        for _ in range(4):
+            self.receive_event_from(ident, "my.event")
+        self.lib._dispatch_inbound_messages()
+
+        self.assertEqual(len(self.messages), 4)
+        self.assertEqual(self.lib.logger.info.call_count, 2)
+        self.lib.logger.info.assert_called_with(
+            ANY, "received", 2, ident, "my.event", ANY
+        )
+        self.assertFalse(self.lib.logger.debug.called)
+        self.assertFalse(self.lib.logger.trace.called)
+
+    def test_make_meta(self):
+        self.assertEqual(PyreBus.make_meta(b"E", b"my.event"), b"E|my.event")
+        self.assertEqual(PyreBus.make_meta(b"S", b"id", b"e", 3), b"S|id|e|3")
+        self.assertEqual(PyreBus.make_meta(b"S", b"id", seq=3), b"S|id||3")
+        meta = PyreBus.parse_message_meta(b"S|id||3")
+        self.assertEqual(meta.kind, b"S")
+        self.assertEqual(meta.flags, b"")
+        self.assertEqual(meta.seq, b"3")
+
+    def test_send_stream(self):
+        self.init_lib()
+        ident = self.init_stream_peer()
+        self.lib.STREAM_WINDOW = 2
+        sent = []
+
+        def send_multipart(frames, copy=True):
+            sent.append(frames[2:])
+            meta = PyreBus.parse_message_meta(frames[3])
+            if meta.kind == PyreBus.KIND_STREAM:
+                # peer acknowledges each chunk
+                self.receive_frames(
+                    [b"", PyreBus.make_meta(b"A", meta.name, seq=int(meta.seq))]
+                )
+
+        self.lib.pipe_in.send_multipart.side_effect = send_multipart
+
+        self.assertEqual(
+            self.lib.send_stream(ident, iter([b"a", b"b", b"c"]), {"name": "file"}), 3
+        )
+
+        self.assertEqual(len(sent), 5)
+        self.assertEqual(json.loads(sent[0][0]), {"name": "file"})
+        self.assertTrue(sent[0][1].startswith(b"O|"))
+        self.assertEqual([frames[0] for frames in sent[1:4]], [b"a", b"b", b"c"])
+        self.assertTrue(sent[4][1].endswith(b"|e|4"))
+
+    def test_send_stream_peer_aborts(self):
+        self.init_lib()
+        ident = self.init_stream_peer()
+
+        def send_multipart(frames, copy=True):
+            meta = PyreBus.parse_message_meta(frames[3])
+            if meta.kind == PyreBus.KIND_STREAM:
+                self.receive_frames([b"", PyreBus.make_meta(b"A", meta.name, b"a")])
+
+        self.lib.pipe_in.send_multipart.side_effect = send_multipart
+
+        with self.assertRaises(BusStreamError):
+            self.lib.send_stream(ident, iter([b"a", b"b", b"c"]))
+
+    def test_send_stream_peer_not_supported(self):
+        self.init_lib()
+        ident = self.init_stream_peer(features="zlib")
+
+        with self.assertRaises(BusStreamError) as cm:
+            self.lib.send_stream(ident, iter([b"a"]))
+        self.assertEqual(str(cm.exception), f'Peer "{ident}" does not support streams')
+
+    def test_receive_stream(self):
+        self.init_lib()
+        self.init_stream_peer()
+        streams = []
+        self.lib.on_stream_received = lambda peer_id, stream: streams.append(stream)
+
+        self.receive_frames([b'{"name": "file"}', b"O|1234"])
+        self.receive_frames([b"chunk1", b"S|1234||1"])
+        self.receive_frames([b"chunk2", b"S|1234||2"])
+        self.receive_frames([b"", b"S|1234|e|3"])
+
+        self.assertEqual(len(streams), 1)
+        self.assertDictEqual(streams[0].infos, {"name": "file"})
+        self.assertListEqual(list(streams[0]), [b"chunk1", b"chunk2"])
+        ack = self.lib.pipe_in.send_multipart.call_args[0][0]
+        self.assertEqual(ack[3], b"A|1234||3")
+
+    def test_receive_stream_invalid_chunk(self):
+        self.init_lib()
+        self.init_stream_peer()
+        streams = []
+        self.lib.on_stream_received = lambda peer_id, stream: streams.append(stream)
+
+        self.receive_frames([b"{}", b"O|1234"])
+        self.receive_frames([b"chunk2", b"S|1234||2"])
+
+        with self.assertRaises(BusStreamError):
+            list(streams[0])
+        ack = self.lib.pipe_in.send_multipart.call_args[0][0]
+        self.assertEqual(ack[3], b"A|1234|a")
+
+    def test_receive_stream_not_handled(self):
+        self.init_lib()
+        self.init_stream_peer()
+
+        self.receive_frames([b"{}", b"O|1234"])
+
+        ack = self.lib.pipe_in.send_multipart.call_args[0][0]
+        self.assertEqual(ack[3], b"A|1234|a")
+
+    def test_peer_exit_aborts_streams_and_queued_messages(self):
+        self.init_lib()
+        ident = self.init_stream_peer()
+        streams = []
+        self.lib.on_stream_received = lambda peer_id, stream: streams.append(stream)
+        self.receive_frames([b"{}", b"O|1234"])
+        outgoing = BusOutgoingStream("5678", ident, 2)
+        self.lib._PyreBus__outgoing_streams["5678"] = outgoing
+        self.lib.node.recv.return_value = [
+            b"WHISPER",
+            uuid.UUID(ident).bytes,
+            b"TESTBUS",
+            json.dumps({"event": "my.event", "params": {}}).encode("utf-8"),
+        ]
+        self.lib._message_to_receive_from_pipe(dispatch=False)
+
+        self.lib.node.recv.return_value = [b"EXIT", uuid.UUID(ident).bytes, b"TESTBUS"]
+        self.lib._message_to_receive_from_pipe()
+        self.lib._dispatch_inbound_messages()
+
+        with self.assertRaises(BusStreamError):
+            list(streams[0])
+        self.assertTrue(outgoing.aborted)
+        self.assertEqual(len(self.messages), 0)
+
+    def test_expire_incoming_streams(self):
+        self.init_lib()
+        self.init_stream_peer()
+        streams = []
+        self.lib.on_stream_received = lambda peer_id, stream: streams.append(stream)
+        self.receive_frames([b"{}", b"O|1234"])
+        self.receive_frames([b"{}", b"O|5678"])
+        self.receive_frames([b"{}", b"O|9012"])
+        streams[1].cancel()
+
+        self.lib._expire_incoming_streams(streams[0].updated_at + 1.0)
+
+        self.assertEqual(
+            [
+                call.args[0][3]
+                for call in self.lib.pipe_in.send_multipart.call_args_list
+            ],
+            [b"A|5678|a"],
+        )
+        self.lib._expire_incoming_streams(
+            streams[0].updated_at + PyreBus.STREAM_TIMEOUT + 1.0
+        )
+        self.assertEqual(self.lib.pipe_in.send_multipart.call_count, 3)
+        with self.assertRaises(BusStreamError):
+            list(streams[0])
+
+    def test_run(self):
+        self.init_lib()
+        self.lib._PyreBus__externalbus_configured = True
+        self.lib.run_once = Mock(side_effect=[True, True, False])
+
+        self.lib.run()
+
+        self.assertEqual(self.lib.run_once.call_count, 3)
+
+    def test_run_external_bus_not_configured(self):
+        self.init_lib()
+        self.lib._PyreBus__externalbus_configured = False
+        self.lib.run_once = Mock(side_effect=[False])
+
+        def set_externabus_configured():
+            self.lib._PyreBus__externalbus_configured = True
+
+        t = Timer(1.0, set_externabus_configured)
+        t.start()
+
+        self.lib.run()
+
+        self.assertEqual(self.lib.run_once.call_count, 1)
+
+    def test_run_exception(self):
+        self.init_lib()
+        self.lib._PyreBus__externalbus_configured = True
+        self.lib.run_once = Mock(side_effect=[Exception("Test exception"), False])
+
+        self.lib.run()
+
+        self.assertEqual(self.lib.run_once.call_count, 2)
+
+    def test_broadcast_message(self):
+        self.init_lib()
+        self.lib._send_message = Mock()
+
+        self.lib._broadcast_message(MessageRequest())
+
+        self.lib._send_message.assert_called_once()
+
+    def test_send_message(self):
+        self.init_lib()
+        self.lib._PyreBus__externalbus_configured = True
+        mock_pipein = Mock()
+        self.lib.pipe_in = mock_pipein
+        message = MessageRequest()
+        message.event = "dummy.test.event"
+
+        self.lib._send_message(message)
+
+        mock_pipein.send.assert_called_with(
+            json.dumps(message.to_dict()).encode("utf8")
+        )
+
+    def test_send_message_external_bus_not_configured(self):
+        self.init_lib()
+        self.lib._PyreBus__externalbus_configured = False
+        mock_pipein = Mock()
+        self.lib.pipe_in = mock_pipein
+        message = MessageRequest()
+        message.event = "dummy.test.event"
+
+        self.lib._send_message(message)
+
+        self.assertFalse(mock_pipein.send.called)
+
+
+class FakeSocket:
+    """
+    In memory zmq PAIR socket
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.peer = None
+        self.queue = deque()
+
+    def setsockopt(self, option, value):
+        pass
+
+    def bind(self, address):
+        self.context.bound[address] = self
+
+    def connect(self, address):
+        self.peer = self.context.bound[address]
+        self.peer.peer = self
+
+    def send(self, data):
+        self.send_multipart([data])
+
+    def send_multipart(self, frames, copy=True, flags=0):
+        self.peer.queue.append(list(frames))
+
+    def recv_multipart(self, copy=True):
+        return self.queue.popleft()
+
+    def poll(self, timeout=None, flags=None):
+        return 1 if self.queue else 0
+
+    def close(self):
+        pass
+
+
+class FakeContext:
+    def __init__(self):
+        self.bound = {}
+
+    def socket(self, socket_type):
+        return FakeSocket(self)
+
+    def term(self):
+        pass
+
+
+class FakePoller:
+    """
+    zmq poller over FakeSockets. Remote buses are processed before each poll to simulate
+    peers running concurrently
+    """
+
+    def __init__(self, sockets, pollin, before_poll=None):
+        self.sockets = sockets
+        self.pollin = pollin
+        self.before_poll = before_poll
+
+    def poll(self, timeout=None):
+        if self.before_poll:
+            self.before_poll()
+        return [(socket, self.pollin) for socket in self.sockets if socket.poll()]
+
+
+class FakeDealer:
+    """
+    zmq DEALER socket connected to a UnicastNode. Like zmq, queued messages are discarded on
+    close unless socket lingers
+    """
+
+    def __init__(self, remote, identity, linger_option):
+        self.remote = remote
+        self.identity = identity
+        self.linger_option = linger_option
+        self.linger = 0
+        self.queue = []
+
+    def setsockopt(self, option, value):
+        if option == self.linger_option:
+            self.linger = value
+
+    def send_multipart(self, frames, flags=None):
+        self.queue.append(list(frames))
+
+    def close(self):
+        if self.linger:
+            for frames in self.queue:
+                self.remote._handle_message([self.identity.bytes] + frames)
+        self.queue.clear()
+
+
+@patch("backend.pyrebus.zmq")
+class TestsLoopbackBus(unittest.TestCase):
+    def setUp(self):
+        logging.basicConfig(level=logging.FATAL)
+        self.registry = LoopbackRegistry()
+        self.context = FakeContext()
+
+    def make_bus(self, uuid_value):
+        bus = LoopbackBus(
+            Mock(),
+            Mock(),
+            Mock(),
+            lambda infos: PeerInfos(uuid=infos["uuid"]),
+            False,
+            Mock(),
+            registry=self.registry,
+        )
+        bus.logger.setLevel(logging.FATAL)
+        bus.context = self.context
+        bus.start({"uuid": uuid_value}, "TESTBUS", "CLEEP")
+        return bus
+
+    def process(self, bus):
+        while bus.node_socket.poll():
+            bus._message_to_receive_from_pipe()
+
+    def test_discovery_and_messages(self, mock_zmq):
+        bus1 = self.make_bus("uuid1")
+        bus2 = self.make_bus("uuid2")
+        self.process(bus1)
+        self.process(bus2)
+
+        bus1.on_peer_connected.assert_called_once()
+        peer_id, peer_infos = bus1.on_peer_connected.call_args.args
+        self.assertEqual(peer_infos.uuid, "uuid2")
+        self.assertEqual(peer_id, str(bus2.node.uuid()))
+        self.assertEqual(bus1.peers[peer_id].groups, {"CLEEP"})
+        self.assertNotEqual(bus1.get_mac_addresses(), bus2.get_mac_addresses())
+
+        # broadcast event
+        message = MessageRequest()
+        message.event = "my.event"
+        message.params = {"value": 1}
+        bus2._send_message(message)
+        bus2._message_to_send_to_pipe()
+        self.process(bus1)
+        received_peer_id, received = bus1.on_message_received.call_args.args
+        self.assertEqual(received_peer_id, str(bus2.node.uuid()))
+        self.assertEqual(received.event, "my.event")
+        self.assertEqual(received.params, {"value": 1})
+
+        # peer leaves
+        bus2.node.stop()
+        self.process(bus1)
+        bus1.on_peer_disconnected.assert_called_once_with(str(bus2.node.uuid()))
+        self.assertEqual(self.registry.nodes.keys(), {bus1.node.uuid()})
+
+    def test_send_command_to_all(self, mock_zmq):
+        bus1 = self.make_bus("uuid1")
+        bus2 = self.make_bus("uuid2")
+        bus3 = self.make_bus("uuid3")
+        for bus in (bus1, bus2, bus3):
+            self.process(bus)
+        bus2.on_message_received.return_value = Mock(error=False, message="", data=2)
+        bus3.on_message_received.return_value = None
+        on_response = Mock()
+
+        message = MessageRequest()
+        message.to = "dummy"
+        message.command = "my_command"
+        request = bus1.send_command_to_all(message, 5.0, on_response=on_response)
+        bus1._message_to_send_to_pipe()
+        self.process(bus2)
+        self.process(bus3)
+        self.process(bus1)
+
+        self.assertEqual(
+            bus2.on_message_received.call_args.args[1].command, "my_command"
+        )
+        self.assertTrue(request.completed)
+        self.assertDictEqual(
+            request.responses,
+            {
+                str(bus2.node.uuid()): {"error": False, "message": "", "data": 2},
+                str(bus3.node.uuid()): {"error": True, "message": "", "data": None},
+            },
+        )
+        self.assertEqual(on_response.call_count, 2)
+        self.assertEqual(len(list(request)), 2)
+
+    def test_send_command_to_all_iterated_from_bus_thread(self, mock_zmq):
+        bus1 = self.make_bus("uuid1")
+        bus2 = self.make_bus("uuid2")
+        bus3 = self.make_bus("uuid3")
+        for bus in (bus1, bus2, bus3):
+            self.process(bus)
+        bus2.on_message_received.return_value = Mock(error=False, message="", data=2)
+        bus3.on_message_received.return_value = Mock(error=False, message="", data=3)
+        bus1.poller = FakePoller(
+            [bus1.pipe_out, bus1.node_socket],
+            mock_zmq.POLLIN,
+            lambda: [self.process(bus) for bus in (bus2, bus3)],
+        )
+        # bus thread is current thread
+        bus1.run_once()
+
+        message = MessageRequest()
+        message.to = "dummy"
+        message.command = "my_command"
+        request = bus1.send_command_to_all(message, 5.0)
+        responses = dict(request)
+
+        self.assertTrue(request.completed)
+        self.assertDictEqual(
+            responses,
+            {
+                str(bus2.node.uuid()): {"error": False, "message": "", "data": 2},
+                str(bus3.node.uuid()): {"error": False, "message": "", "data": 3},
+            },
+        )
+
+    def test_send_command_to_all_iterated_from_bus_thread_without_response(
+        self, mock_zmq
+    ):
+        bus1 = self.make_bus("uuid1")
+        bus2 = self.make_bus("uuid2")
+        for bus in (bus1, bus2):
+            self.process(bus)
+        # bus2 never processes its messages
+        bus1.poller = FakePoller([bus1.pipe_out, bus1.node_socket], mock_zmq.POLLIN)
+        bus1.run_once()
+
+        message = MessageRequest()
+        message.to = "dummy"
+        message.command = "my_command"
+        request = bus1.send_command_to_all(message, 0.05)
+        responses = dict(request)
+
+        self.assertTrue(request.completed)
+        self.assertDictEqual(responses, {})
+        self.assertEqual(request.missing, [str(bus2.node.uuid())])
+
+    def test_deliver_drops_events_when_inbox_is_full(self, mock_zmq):
+        mock_zmq.Again = type("Again", (Exception,), {})
+        bus1 = self.make_bus("uuid1")
+        bus1.node._LoopbackNode__outbox = Mock(
+            send_multipart=Mock(side_effect=mock_zmq.Again())
+        )
+
+        bus2 = self.make_bus("uuid2")
+        bus2.node.stop()
+
+        # ENTER, JOIN and EXIT are dropped without blocking senders
+        self.assertEqual(bus1.node.dropped, 3)
+        self.assertEqual(
+            bus1.node._LoopbackNode__outbox.send_multipart.call_args.kwargs,
+            {"flags": mock_zmq.NOBLOCK},
+        )
+
+    @patch("backend.cleepbus.Hostname", mock_hostname)
+    @patch("backend.cleepbus.Tools", mock_tools)
+    def test_simulation(self, mock_zmq):
+        mock_zmq.Context.return_value = self.context
+        mock_zmq.Again = type("Again", (Exception,), {})
+        mock_tools.raspberry_pi_infos.return_value = TestsCleepbus.GET_RASPBERRY_INFOS
+        mock_hostname.return_value.get_hostname.return_value = "hostname"
+        spec = importlib.util.spec_from_file_location(
+            "simulation",
+            os.path.join(os.path.dirname(__file__), "../benchmarks/simulation.py"),
+        )
+        simulation = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(simulation)
+        transport = os.environ.get(Cleepbus.TRANSPORT_ENV)
+
+        try:
+            result = simulation.simulate(3, "loopback", 2, 0.34, 10.0, memory=False)
+        finally:
+            if transport is None:
+                os.environ.pop(Cleepbus.TRANSPORT_ENV, None)
+            else:
+                os.environ[Cleepbus.TRANSPORT_ENV] = transport
+
+        self.assertIsNotNone(result["discovery"])
+        self.assertIsNotNone(result["storm"])
+        self.assertEqual(result["churned"], 1)
+        self.assertIsNotNone(result["churn_leave"])
+        self.assertIsNotNone(result["churn_rejoin"])
+
+    def test_other_bus_is_not_discovered(self, mock_zmq):
+        bus1 = self.make_bus("uuid1")
+        other = LoopbackBus(
+            Mock(), Mock(), Mock(), Mock(), False, Mock(), registry=self.registry
+        )
+        other.context = self.context
+        other.start({"uuid": "uuid2"}, "OTHERBUS", "CLEEP")
+
+        self.assertFalse(bus1.node_socket.poll())
+
+
+@patch("backend.pyrebus.zmq")
+class TestsUnicastNode(unittest.TestCase):
+    SEED = "tcp://10.0.0.2:5680"
+
+    def setUp(self):
+        logging.basicConfig(level=logging.FATAL)
+        self.node = UnicastNode(
+            "TESTBUS", FakeContext(), [self.SEED], address="10.0.0.1"
+        )
+        self.node._connect = Mock(side_effect=lambda endpoint: Mock())
+        self.node.groups.add("CLEEP")
+        self.seed_dealer = Mock()
+        self.node.pending[self.SEED] = self.seed_dealer
+
+    def hello(self, peer_uuid, endpoint, **extra):
+        hello = {
+            "name": "TESTBUS",
+            "endpoint": endpoint,
+            "headers": {"uuid": "uuid2"},
+            "groups": ["CLEEP"],
+            "peers": [],
+        }
+        hello.update(extra)
+        self.node._handle_message(
+            [peer_uuid.bytes, b"HELLO", json.dumps(hello).encode("utf-8")]
+        )
+
+    def events(self):
+        events = []
+        while self.node.socket().poll():
+            events.append(self.node.recv())
+        return events
+
+    def test_hello_from_seed(self, mock_zmq):
+        peer_uuid = uuid.uuid4()
+
+        self.hello(peer_uuid, self.SEED, via="tcp://10.0.0.1:5680")
+
+        self.assertEqual(self.node.pending, {})
+        self.assertIs(self.node.peers[peer_uuid]["dealer"], self.seed_dealer)
+        self.assertEqual(self.node.peers[peer_uuid]["seed"], self.SEED)
+        self.assertEqual(self.node.peer_address(peer_uuid), self.SEED)
+        reply = json.loads(self.seed_dealer.send_multipart.call_args.args[0][1])
+        self.assertEqual(reply["seed"], "tcp://10.0.0.1:5680")
+        self.assertEqual(reply["endpoint"], "tcp://10.0.0.1:5680")
+        self.assertEqual(
+            self.events(),
+            [
+                [
+                    b"ENTER",
+                    peer_uuid.bytes,
+                    b"TESTBUS",
+                    b'{"uuid": "uuid2"}',
+                    self.SEED.encode("utf-8"),
+                ],
+                [b"JOIN", peer_uuid.bytes, b"TESTBUS", b"CLEEP"],
+            ],
+        )
+
+    def test_hello_resolves_seed_with_other_endpoint(self, mock_zmq):
+        peer_uuid = uuid.uuid4()
+
+        self.hello(peer_uuid, "tcp://192.168.1.2:5680", seed=self.SEED)
+
+        self.assertEqual(self.node.pending, {})
+        self.seed_dealer.close.assert_called()
+        self.assertEqual(self.node.peers[peer_uuid]["seed"], self.SEED)
+
+    def test_hello_gossip(self, mock_zmq):
+        self.hello(
+            uuid.uuid4(),
+            self.SEED,
+            peers=["tcp://10.0.0.1:5680", "tcp://10.0.0.3:5680"],
+        )
+
+        self.assertEqual(list(self.node.pending.keys()), ["tcp://10.0.0.3:5680"])
+        dealer = self.node.pending["tcp://10.0.0.3:5680"]
+        hello = json.loads(dealer.send_multipart.call_args.args[0][1])
+        self.assertEqual(hello["via"], "tcp://10.0.0.3:5680")
+        self.assertEqual(hello["peers"], [self.SEED])
+
+    def test_hello_ignored(self, mock_zmq):
+        self.hello(uuid.uuid4(), self.SEED, name="OTHERBUS")
+        self.hello(self.node.uuid(), self.SEED, via=self.SEED)
+
+        self.assertEqual(self.node.peers, {})
+        self.assertEqual(self.node.pending, {})
+        self.assertEqual(self.events(), [])
+
+    def test_messages(self, mock_zmq):
+        peer_uuid = uuid.uuid4()
+        self.hello(peer_uuid, self.SEED)
+        self.events()
+
+        self.node._handle_message([peer_uuid.bytes, b"WHISPER", b"data"])
+        self.node._handle_message([peer_uuid.bytes, b"SHOUT", b"CLEEP", b"data"])
+        self.node._handle_message([peer_uuid.bytes, b"SHOUT", b"OTHER", b"data"])
+        self.node._handle_message([uuid.uuid4().bytes, b"WHISPER", b"data"])
+
+        self.assertEqual(
+            self.events(),
+            [
+                [b"WHISPER", peer_uuid.bytes, b"TESTBUS", b"data"],
+                [b"SHOUT", peer_uuid.bytes, b"TESTBUS", b"CLEEP", b"data"],
+            ],
+        )
+
+    def test_bye_retries_seed(self, mock_zmq):
+        peer_uuid = uuid.uuid4()
+        self.hello(peer_uuid, self.SEED)
+        self.events()
+
+        self.node._handle_message([peer_uuid.bytes, b"BYE"])
+
+        self.assertEqual(self.node.peers, {})
+        self.assertEqual(list(self.node.pending.keys()), [self.SEED])
+        self.assertEqual(self.events(), [[b"EXIT", peer_uuid.bytes, b"TESTBUS"]])
+
+    def test_heartbeat(self, mock_zmq):
+        alive = uuid.uuid4()
+        silent = uuid.uuid4()
+        self.hello(alive, "tcp://10.0.0.3:5680")
+        self.hello(silent, self.SEED)
+        self.events()
+        self.node.peers[silent]["last_seen"] = time.time() - 60
+        dealer = self.node.peers[alive]["dealer"]
+
+        self.node._heartbeat(time.time())
+
+        self.assertEqual(list(self.node.peers.keys()), [alive])
+        dealer.send_multipart.assert_called_with([b"PING"], flags=ANY)
+        self.assertEqual(self.events(), [[b"EXIT", silent.bytes, b"TESTBUS"]])
+        hello = json.loads(
+            self.node.pending[self.SEED].send_multipart.call_args.args[0][1]
+        )
+        self.assertEqual(hello["via"], self.SEED)
+
+    def test_stop_sends_bye_before_closing_dealers(self, mock_zmq):
+        remote = UnicastNode("TESTBUS", FakeContext(), [], address="10.0.0.2")
+        remote._connect = Mock(side_effect=lambda endpoint: Mock())
+        remote._handle_message(
+            [
+                self.node.uuid().bytes,
+                b"HELLO",
+                json.dumps(
+                    {
+                        "name": "TESTBUS",
+                        "endpoint": "tcp://10.0.0.1:5680",
+                        "headers": {},
+                        "groups": [],
+                        "peers": [],
+                    }
+                ).encode("utf-8"),
+            ]
+        )
+        while remote.socket().poll():
+            remote.recv()
+        self.hello(remote.uuid(), self.SEED)
+        self.node.peers[remote.uuid()]["dealer"] = FakeDealer(
+            remote, self.node.uuid(), mock_zmq.LINGER
+        )
+        self.node.router = Mock()
+
+        self.node._close()
+
+        self.assertEqual(remote.recv(), [b"EXIT", self.node.uuid().bytes, b"TESTBUS"])
+        self.assertEqual(remote.peers, {})
+
+    def test_commands(self, mock_zmq):
+        peer_uuid = uuid.uuid4()
+        self.hello(peer_uuid, self.SEED)
+        dealer = self.node.peers[peer_uuid]["dealer"]
+
+        self.node._handle_command([b"WHISPER", peer_uuid.bytes, b"data"])
+        dealer.send_multipart.assert_called_with([b"WHISPER", b"data"], flags=ANY)
+        self.node._handle_command([b"SHOUT", b"CLEEP", b"data"])
+        dealer.send_multipart.assert_called_with(
+            [b"SHOUT", b"CLEEP", b"data"], flags=ANY
+        )
+        self.node._handle_command([b"JOIN", b"floor1"])
+        self.assertIn("floor1", self.node.groups)
+        dealer.send_multipart.assert_called_with([b"JOIN", b"floor1"], flags=ANY)
+        self.assertFalse(self.node._handle_command([b"$TERM"]))
+
+
+if __name__ == "__main__":
+    # coverage run --include="**/backend/**/*.py" --concurrency=thread test_cleepbus.py; coverage report -m -i
+    unittest.main()
+
+
+class TestsCompactPeerInfos(unittest.TestCase):
+    def setUp(self):
+        self.pool = PeerInfosPool()
+
+    def test_share_extra(self):
+        extra1 = self.pool.share_extra(json.loads('{"version": "1.0.0", "apps": "[]"}'))
+        extra2 = self.pool.share_extra(json.loads('{"version": "1.0.0", "apps": "[]"}'))
+        extra3 = self.pool.share_extra({"version": "2.0.0"})
+
+        self.assertIs(extra1, extra2)
+        self.assertIsNot(extra1, extra3)
+        self.assertEqual(len(self.pool), 2)
+        self.assertDictEqual(extra1, {"version": "1.0.0", "apps": "[]"})
+
+        # entries are released with peers
+        del extra1, extra2, extra3
+        self.assertEqual(len(self.pool), 0)
+
+    def test_share_extra_unhashable(self):
+        extra = self.pool.share_extra({"list": [1, 2]})
+
+        self.assertDictEqual(extra, {"list": [1, 2]})
+        self.assertEqual(len(self.pool), 0)
+
+    def test_shared_extra_is_read_only(self):
+        extra = self.pool.share_extra({"field": "value"})
+
+        with self.assertRaises(TypeError):
+            extra["field"] = "other"
+        with self.assertRaises(TypeError):
+            extra.update({"field": "other"})
+        with self.assertRaises(TypeError):
+            extra.pop("field")
+
+        copied = copy.deepcopy(extra)
+        copied["field"] = "other"
+        self.assertIs(type(copied), dict)
+        self.assertEqual(extra["field"], "value")
+        self.assertEqual(json.loads(json.dumps(extra)), {"field": "value"})
+
+    def test_apps(self):
+        peer_infos = CompactPeerInfos(uuid="uuid1")
+        self.assertEqual(peer_infos.apps, ())
+
+        peer_infos.extra = self.pool.share_extra({"apps": '["system", "audio"]'})
+        self.assertEqual(peer_infos.apps, ("system", "audio"))
+        self.assertEqual(SharedExtra({"apps": "invalid"}).apps, ())
+
+    def test_compact_peer_infos_extra_copy_on_write(self):
+        shared = self.pool.share_extra({"apps": '["system"]', "version": "1.0.0"})
+        peer_infos1 = CompactPeerInfos(uuid="uuid1", extra=shared)
+        peer_infos2 = CompactPeerInfos(uuid="uuid2", extra=shared)
+
+        # reading does not copy shared extra infos
+        self.assertEqual(peer_infos1.extra["version"], "1.0.0")
+        self.assertIs(peer_infos1.to_dict(True)["extra"], shared)
+        self.assertIs(peer_infos1._extra, shared)
+        with self.assertRaises(TypeError):
+            peer_infos1.extra["version"] = "2.0.0"
+
+        peer_infos1.update_extra({"version": "2.0.0"})
+
+        self.assertDictEqual(
+            peer_infos1.extra, {"apps": '["system"]', "version": "2.0.0"}
+        )
+        self.assertIs(type(peer_infos1.extra), dict)
+        self.assertEqual(peer_infos1.apps, ())
+        self.assertEqual(shared["version"], "1.0.0")
+        self.assertIs(peer_infos2._extra, shared)
+        self.assertEqual(peer_infos2.apps, ("system",))
+
+    def test_compact_peer_infos(self):
+        peer_infos = CompactPeerInfos(uuid="uuid1", hostname="host", port=8080)
+        peer_infos.online = True
+
+        self.assertDictEqual(vars(peer_infos), {})
+        self.assertEqual(peer_infos.to_dict()["port"], 8080)
+        self.assertTrue(peer_infos.to_dict()["online"])
+        other = CompactPeerInfos()
+        other.fill_from_dict(peer_infos.to_dict())
+        self.assertDictEqual(other.to_dict(True), peer_infos.to_dict(True))
+
+
+class TestsAdaptiveTimeout(unittest.TestCase):
+    def setUp(self):
+        self.timeouts = AdaptiveTimeout(8.0, 3.5, 30.0, 3.0)
+
+    def test_get_timeout_default(self):
+        self.assertEqual(self.timeouts.get_timeout("peer", "command"), 8.0)
+        for _ in range(AdaptiveTimeout.MIN_SAMPLES - 1):
+            self.timeouts.add_sample("peer", "command", 0.1)
+        self.assertEqual(self.timeouts.get_timeout("peer", "command"), 8.0)
+
+    def test_get_timeout_from_samples(self):
+        for _ in range(AdaptiveTimeout.MIN_SAMPLES):
+            self.timeouts.add_sample("peer", "fast", 0.1)
+            self.timeouts.add_sample("peer", "slow", 4.0)
+
+        # clamped to min and max
+        self.assertEqual(self.timeouts.get_timeout("peer", "fast"), 3.5)
+        self.assertEqual(self.timeouts.get_timeout("peer", "slow"), 12.0)
+        self.timeouts.add_sample("peer", "slow", 20.0)
+        self.assertEqual(self.timeouts.get_timeout("peer", "slow"), 30.0)
+
+    def test_get_timeout_unknown_command_of_known_peer(self):
+        for _ in range(AdaptiveTimeout.MIN_SAMPLES):
+            self.timeouts.add_sample("peer", "fast", 0.1)
+
+        self.assertEqual(self.timeouts.get_timeout("peer", "other"), 8.0)
+
+    def test_add_timeout(self):
+        self.timeouts.add_timeout("peer", "command", 8.0)
+        self.assertEqual(self.timeouts.get_timeout("peer", "command"), 16.0)
+        self.timeouts.add_timeout("peer", "command", 16.0)
+        self.assertEqual(self.timeouts.get_timeout("peer", "command"), 30.0)
+
+        # timed out durations are kept in samples once enough samples are collected
+        for _ in range(AdaptiveTimeout.MIN_SAMPLES):
+            self.timeouts.add_sample("peer", "command", 0.1)
+        self.assertEqual(self.timeouts.get_timeout("peer", "command"), 30.0)
+
+    def test_add_timeout_with_enough_samples(self):
+        for _ in range(AdaptiveTimeout.MIN_SAMPLES):
+            self.timeouts.add_sample("peer", "command", 1.0)
+        self.assertEqual(self.timeouts.get_timeout("peer", "command"), 3.5)
+
+        self.timeouts.add_timeout("peer", "command", 3.5)
+
+        self.assertEqual(self.timeouts.get_timeout("peer", "command"), 10.5)
+        self.timeouts.add_sample("peer", "command", 1.0)
+        self.assertEqual(self.timeouts.get_timeout("peer", "command"), 10.5)
+
+    def test_forget(self):
+        for _ in range(AdaptiveTimeout.MIN_SAMPLES):
+            self.timeouts.add_sample("peer", "command", 4.0)
+            self.timeouts.add_sample("other", "command", 4.0)
+        self.timeouts.add_timeout("peer", "timedout", 8.0)
+
+        self.timeouts.forget("peer")
+
+        self.assertEqual(self.timeouts.get_timeout("peer", "command"), 8.0)
+        self.assertEqual(self.timeouts.get_timeout("peer", "timedout"), 8.0)
+        self.assertEqual(self.timeouts.get_timeout("other", "command"), 12.0)
+
+    @patch.object(AdaptiveTimeout, "MAX_KEYS", 2)
+    def test_max_keys(self):
+        self.timeouts.add_timeout("peer", "first", 8.0)
+        self.timeouts.add_timeout("peer", "second", 8.0)
+        self.timeouts.add_timeout("peer", "first", 8.0)
+        self.timeouts.add_timeout("peer", "third", 8.0)
+
+        # least recently used key is dropped
+        self.assertEqual(self.timeouts.get_timeout("peer", "second"), 8.0)
+        self.assertEqual(self.timeouts.get_timeout("peer", "first"), 16.0)
+
+
+class TestsPercentile(unittest.TestCase):
+    def test_percentile(self):
+        ordered = [0.1, 0.2, 0.3, 0.4, 1.0]
+
+        self.assertEqual(percentile(ordered, 0), 0.1)
+        self.assertEqual(percentile(ordered, 50), 0.3)
+        self.assertEqual(percentile(ordered, 99), 1.0)
+        self.assertEqual(percentile(ordered, 100), 1.0)
+        self.assertEqual(percentile([2.0], 99), 2.0)
+
+    @patch("backend.busprofiler.time")
+    def test_profiler_summary_percentiles(self, mock_time):
+        profiler = BusProfiler()
+        profiler.enable()
+        for duration in (0.001, 0.002, 0.003, 0.004, 0.01):
+            profiler.begin()
+            mock_time.perf_counter.return_value = 1.0
+            start = profiler.start()
+            mock_time.perf_counter.return_value = 1.0 + duration
+            profiler.record("poll", start)
+
+        summary = profiler.get_summary()["poll"]
+        self.assertEqual(summary["count"], 5)
+        self.assertAlmostEqual(summary["p50"], 0.003)
+        self.assertAlmostEqual(summary["p99"], 0.01)
+
+
+class TestsTokenBucket(unittest.TestCase):
+    def test_burst(self):
+        bucket = TokenBucket(1.0, 3, 100.0)
+
+        self.assertEqual(
+            [bucket.consume(100.0) for _ in range(4)], [True] * 3 + [False]
+        )
+
+    def test_refill(self):
+        bucket = TokenBucket(2.0, 3, 100.0)
+        for _ in range(3):
+            bucket.consume(100.0)
+
+        self.assertFalse(bucket.consume(100.2))
+        self.assertTrue(bucket.consume(100.5))
+        self.assertFalse(bucket.consume(100.5))
+
+    def test_refill_is_capped_to_burst(self):
+        bucket = TokenBucket(10.0, 2, 100.0)
+
+        self.assertEqual([bucket.consume(200.0) for _ in range(3)], [True, True, False])
+
+    def test_clock_going_backward(self):
+        bucket = TokenBucket(1.0, 1, 100.0)
+        bucket.consume(100.0)
+
+        self.assertFalse(bucket.consume(50.0))
+        self.assertTrue(bucket.consume(101.0))
+
+
+class TestsBusTracer(unittest.TestCase):
+    def setUp(self):
+        self.tracer = BusTracer()
+
+    def test_new_context(self):
+        root = self.tracer.new_context()
+        child = self.tracer.new_context(root)
+
+        self.assertEqual(len(root["trace_id"]), 32)
+        self.assertIsNone(root["parent_id"])
+        self.assertEqual(child["trace_id"], root["trace_id"])
+        self.assertEqual(child["parent_id"], root["span_id"])
+        self.assertNotEqual(child["span_id"], root["span_id"])
+
+    def test_new_context_uses_current_context(self):
+        root = self.tracer.new_context()
+        self.tracer.activate(root)
+
+        self.assertEqual(self.tracer.new_context()["parent_id"], root["span_id"])
+        self.tracer.activate(None)
+        self.assertIsNone(self.tracer.get_current())
+        self.assertIsNone(self.tracer.new_context()["parent_id"])
+
+    def test_current_context_is_thread_local(self):
+        self.tracer.activate(self.tracer.new_context())
+        contexts = []
+
+        thread = threading.Thread(
+            target=lambda: contexts.append(self.tracer.get_current())
+        )
+        thread.start()
+        thread.join()
+
+        self.assertEqual(contexts, [None])
+        self.assertIsNotNone(self.tracer.get_current())
+
+    @patch("backend.bustracer.time")
+    def test_record_and_get_spans(self, mock_time):
+        mock_time.time.return_value = 10.5
+        first = self.tracer.new_context()
+        second = self.tracer.new_context()
+
+        self.tracer.record(first, "send", "my.event", 10.0, "peer", size=12)
+        self.tracer.record(second, "receive", "my.event", 10.25)
+
+        spans = self.tracer.get_spans(first["trace_id"])
+        self.assertEqual(len(spans), 1)
+        self.assertEqual(spans[0]["kind"], "send")
+        self.assertEqual(spans[0]["peer"], "peer")
+        self.assertEqual(spans[0]["size"], 12)
+        self.assertEqual(spans[0]["duration"], 0.5)
+        self.assertEqual(len(self.tracer.get_spans()), 2)
+        # returned spans are copies
+        spans[0]["kind"] = "changed"
+        self.assertEqual(self.tracer.get_spans()[0]["kind"], "send")
+
+    def test_spans_are_bounded(self):
+        context = self.tracer.new_context()
+        for index in range(BusTracer.BUFFER_SIZE + 1):
+            self.tracer.record(context, "send", f"event{index}", 0.0)
+
+        spans = self.tracer.get_spans()
+        self.assertEqual(len(spans), BusTracer.BUFFER_SIZE)
+        self.assertEqual(spans[0]["name"], "event1")
+
+
+class TestsEventMatcher(unittest.TestCase):
+    def test_exact_names(self):
+        matcher = EventMatcher(["system.device.reboot"])
+
+        self.assertTrue(matcher.match("system.device.reboot"))
+        self.assertFalse(matcher.match("system.device.reboot.now"))
+        self.assertFalse(matcher.match("system.device"))
+
+    def test_glob_is_anchored(self):
+        matcher = EventMatcher(["sensors.*", "gpios.gpio.o?"])
+
+        self.assertTrue(matcher.match("sensors.temperature.update"))
+        self.assertFalse(matcher.match("my.sensors.temperature"))
+        self.assertFalse(matcher.match("sensors"))
+        self.assertTrue(matcher.match("gpios.gpio.on"))
+        self.assertFalse(matcher.match("gpios.gpio.off"))
+
+    def test_regex_is_anchored(self):
+        matcher = EventMatcher([r"re:system\.(device|alert)\..*", r"re:audio\.volume"])
+
+        self.assertTrue(matcher.match("system.alert.fire"))
+        self.assertFalse(matcher.match("my.system.alert.fire"))
+        self.assertTrue(matcher.match("audio.volume"))
+        self.assertFalse(matcher.match("audio.volume.update"))
+
+    def test_regex_is_not_glob(self):
+        matcher = EventMatcher(["re:sensors.*"])
+
+        # "." matches any char in regular expression, unlike glob syntax
+        self.assertTrue(matcher.match("sensorsXtemperature"))
+        self.assertFalse(EventMatcher(["sensors.*"]).match("sensorsXtemperature"))
+
+    def test_invalid_regex(self):
+        with self.assertRaises(re.error):
+            EventMatcher(["re:system.(device"])
+
+    def test_match_all_and_empty(self):
+        self.assertTrue(EventMatcher(["*"]).match("any.event"))
+        self.assertFalse(EventMatcher([]).match("any.event"))
+        self.assertFalse(EventMatcher(None).match("any.event"))
+
+    @patch.object(EventMatcher, "CACHE_SIZE", 2)
+    def test_cache_is_bounded(self):
+        matcher = EventMatcher(["sensors.*"])
+
+        for index in range(5):
+            self.assertTrue(matcher.match(f"sensors.{index}"))
+        self.assertLessEqual(len(matcher._EventMatcher__cache), 2)